@@ -10,65 +10,470 @@ Run on the command line, e.g.: ::
 .. note:: This module has dependencies not required by the CAQE web application. To install these dependencies, run ``pip install -r analysis_requirements.txt``.
 """
 import argparse
-import copy
+import datetime
 import json
+import numbers
+import os
+import re
 
+import numpy as np
 import pandas as pd
 import seaborn as sns
+from sqlalchemy import or_
 
-from caqe.models import Condition
+from caqe.models import Condition, Participant, Trial
 from caqe import app
+from caqe import db
 
+# The number of trials fetched from the database at a time
+YIELD_PER = 1000
 
-def get_ratings_data(output_file=None):
+# The default number of rows per chunk of the chunked exports
+CHUNK_SIZE = 100000
+
+# Incremental exports only include trials completed at least this many seconds ago, so that trials whose transactions
+# are still in progress are not skipped. It should also cover the clock difference between the web and analysis hosts.
+INCREMENTAL_EXPORT_LAG_SEC = 60
+
+# The suffix of the watermark file of an incremental export, which is stored next to the export
+WATERMARK_SUFFIX = '.watermark.json'
+WATERMARK_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# The file names of the chunks of a Feather export (see `save_ratings_data_to_feather`)
+FEATHER_PART_FORMAT = 'part-%05d.feather'
+FEATHER_PART_PATTERN = r'part-\d+\.feather$'
+
+# The columns of the ratings data that are copied from the trial, its condition, and its participant
+TRIAL_COLUMNS = ['test_id',
+                 'trial_id',
+                 'condition_id',
+                 'participant_id',
+                 'participant_crowd_worker_id',
+                 'participant_platform',
+                 'participant_passed_hearing_test',
+                 'participant_hearing_test_attempts',
+                 'participant_hearing_test_last_attempt',
+                 'participant_pre_test_survey',
+                 'participant_post_test_survey',
+                 'participant_hearing_response_estimation']
+
+# The columns of the ratings data, in alphabetical order like the DataFrame built from row dictionaries used to be
+RATINGS_COLUMNS = sorted(TRIAL_COLUMNS + ['data', 'stimulus', 'rating'])
+
+
+def get_ratings_data(output_file=None, incremental=False):
     """
-    Get the ratings data from the database as a DataFrame
+    Get the ratings data from the database as a DataFrame, with one row per stimulus rating.
+
+    The trials are read with a single query joining their conditions and participants, which is streamed from the
+    database in batches of `YIELD_PER` rows, and the DataFrame is built column by column.
 
     Parameters
     ----------
     output_file : str
         A filepath to an output CSV file (default is None)
+    incremental : bool
+        Only get the trials that were completed since the last incremental export to `output_file`, and append them
+        to it (see `save_ratings_data_to_csv`). (default is False)
 
     Returns
     -------
     ratings : pandas.DataFrame
-        All of the rating data from the dictionary.
-
-    """
-    conditions = Condition.query.all()
-    ratings = []
-    for c in conditions:
-        for t in c.trials.all():
-            t_data = json.loads(t.data)
-            trial_ratings = t_data['ratings']
-            del t_data['ratings']
-            row = {'test_id': c.test_id,
-                   'trial_id': t.id,
-                   'condition_id': c.id,
-                   'participant_id': t.participant_id,
-                   'participant_crowd_worker_id': t.participant.crowd_worker_id,
-                   'participant_platform': t.participant.platform,
-                   'participant_passed_hearing_test': t.participant_passed_hearing_test,
-                   'participant_hearing_test_attempts': t.participant.hearing_test_attempts,
-                   'participant_hearing_test_last_attempt': t.participant.hearing_test_last_attempt,
-                   'participant_pre_test_survey': t.participant.pre_test_survey,
-                   'participant_post_test_survey': t.participant.post_test_survey,
-                   'participant_hearing_response_estimation': t.participant.hearing_response_estimation,
-                   'data': json.dumps(t_data)}
-            for k, v in trial_ratings.items():
-                r = copy.deepcopy(row)
-                r['stimulus'] = k
-                r['rating'] = float(v)
-                ratings.append(r)
-
-    ratings = pd.DataFrame.from_records(ratings)
+        All of the rating data from the dictionary, or only the new rating data if `incremental`.
+
+    """
+    if incremental:
+        if output_file is None:
+            raise Exception('Argument `output_file` must be defined for an incremental export')
+        watermark, offset = _get_export_window(output_file)
+    else:
+        watermark, offset = None, 0
+
+    columns = _new_columns()
+    for trial in _query_trials(watermark).yield_per(YIELD_PER):
+        _append_trial(columns, trial)
+
+    ratings = _columns_to_frame(columns, offset)
 
     if output_file is not None:
-        ratings.to_csv(output_file)
+        if incremental:
+            with open(output_file, 'a' if offset > 0 else 'w') as f:
+                ratings.to_csv(f, header=(offset == 0))
+            _save_watermark(output_file, watermark, offset + len(ratings),
+                            _get_last_trial_id(watermark['last_trial_id'], ratings))
+        else:
+            ratings.to_csv(output_file)
 
     return ratings
 
 
+def iter_ratings_data(chunk_size=CHUNK_SIZE, watermark=None, offset=0):
+    """
+    Get the ratings data from the database (see `get_ratings_data`) as a sequence of DataFrames, so that it never has to
+    be in memory as a whole.
+
+    Parameters
+    ----------
+    chunk_size : int
+        The number of rows per DataFrame. The rows of a trial are never split, so a DataFrame may have slightly more
+        rows. (default is 100000)
+    watermark : dict, optional
+        Only get the trials completed in the export window of the watermark (see `_query_trials`)
+    offset : int
+        The index of the first row. (default is 0)
+
+    Returns
+    -------
+    generator of pandas.DataFrame
+        The DataFrames, indexed consecutively across the sequence. There is at least one (possibly empty) DataFrame.
+    """
+    columns = _new_columns()
+    first_offset = offset
+    for trial in _query_trials(watermark).yield_per(YIELD_PER):
+        _append_trial(columns, trial)
+        if len(columns['rating']) >= chunk_size:
+            chunk = _columns_to_frame(columns, offset)
+            offset += len(chunk)
+            columns = _new_columns()
+            yield chunk
+
+    if offset == first_offset or len(columns['rating']) > 0:
+        yield _columns_to_frame(columns, offset)
+
+
+def save_ratings_data_to_csv(output_file, chunk_size=CHUNK_SIZE, incremental=False):
+    """
+    Save the ratings data to a CSV file in chunks of `chunk_size` rows (see `iter_ratings_data`). The file is the same
+    as the one written by `get_ratings_data`.
+
+    In incremental mode, only the trials that were completed since the last incremental export are appended to the
+    file. The export window is tracked by a watermark file next to the output file (see `_get_export_window`); if it
+    does not exist, all the trials are exported.
+
+    Parameters
+    ----------
+    output_file : str
+        A filepath to the output CSV file
+    chunk_size : int
+        The number of rows per chunk. (default is 100000)
+    incremental : bool
+        Append the trials completed since the last incremental export. (default is False)
+
+    Returns
+    -------
+    n_rows : int
+        The number of rows written
+    """
+    if incremental:
+        watermark, offset = _get_export_window(output_file)
+        last_trial_id = watermark['last_trial_id']
+    else:
+        watermark, offset = None, 0
+        last_trial_id = None
+
+    n_rows = 0
+    with open(output_file, 'a' if offset > 0 else 'w') as f:
+        for chunk in iter_ratings_data(chunk_size, watermark, offset):
+            chunk.to_csv(f, header=(offset + n_rows == 0))
+            n_rows += len(chunk)
+            last_trial_id = _get_last_trial_id(last_trial_id, chunk)
+
+    if incremental:
+        _save_watermark(output_file, watermark, offset + n_rows, last_trial_id)
+    return n_rows
+
+
+def _get_export_window(output_file):
+    """
+    Get the export window of the next incremental export to `output_file`: the trials completed after the end of the
+    window of the last export (if the output file and its watermark file exist), and at least
+    `INCREMENTAL_EXPORT_LAG_SEC` seconds ago, so that trials that are still being committed are left for the next
+    export. The window also includes the earlier completed trials with a greater id than any exported trial, which
+    were committed too late for the last export.
+
+    Parameters
+    ----------
+    output_file : str
+
+    Returns
+    -------
+    watermark : dict
+        The window's 'completed_after' (None for all trials) and 'completed_until' times, and the 'last_trial_id'
+        (the greatest id of the exported trials, None if unknown)
+    offset : int
+        The number of rows already in the output file
+    """
+    completed_until = datetime.datetime.now() - datetime.timedelta(seconds=INCREMENTAL_EXPORT_LAG_SEC)
+    watermark_file = output_file + WATERMARK_SUFFIX
+    if not os.path.exists(output_file) or not os.path.exists(watermark_file):
+        return {'completed_after': None, 'completed_until': completed_until, 'last_trial_id': None}, 0
+
+    with open(watermark_file) as f:
+        last_watermark = json.load(f)
+    completed_after = datetime.datetime.strptime(last_watermark['completed_until'], WATERMARK_DATETIME_FORMAT)
+    return {'completed_after': completed_after,
+            'completed_until': max(completed_after, completed_until),
+            'last_trial_id': last_watermark.get('last_trial_id', None)}, last_watermark['n_rows']
+
+
+def _save_watermark(output_file, watermark, n_rows, last_trial_id):
+    """
+    Save the watermark of an incremental export to `output_file`, once its rows have been written.
+
+    Parameters
+    ----------
+    output_file : str
+    watermark : dict
+        The export window (see `_get_export_window`)
+    n_rows : int
+        The total number of rows in the output file
+    last_trial_id : int
+        The greatest id of the trials in the output file (see `_get_last_trial_id`), None if unknown
+
+    Returns
+    -------
+    None
+    """
+    watermark_file = output_file + WATERMARK_SUFFIX
+    with open(watermark_file + '.tmp', 'w') as f:
+        json.dump({'completed_until': watermark['completed_until'].strftime(WATERMARK_DATETIME_FORMAT),
+                   'last_trial_id': last_trial_id,
+                   'n_rows': n_rows}, f, indent=2, sort_keys=True)
+    os.rename(watermark_file + '.tmp', watermark_file)
+
+
+def _get_last_trial_id(last_trial_id, ratings):
+    """
+    Get the greatest trial id of an export, after `ratings` has been exported.
+
+    Parameters
+    ----------
+    last_trial_id : int
+        The greatest id of the trials exported before, None if unknown
+    ratings : pandas.DataFrame
+        The exported ratings data
+
+    Returns
+    -------
+    last_trial_id : int
+    """
+    if len(ratings) == 0:
+        return last_trial_id
+    max_trial_id = int(ratings['trial_id'].max())
+    return max_trial_id if last_trial_id is None else max(last_trial_id, max_trial_id)
+
+
+def save_ratings_data_to_feather(output_directory, chunk_size=CHUNK_SIZE):
+    """
+    Save the ratings data to Feather files with typed columns (see `type_ratings_data`), which load much faster than
+    the CSV file. Feather files cannot be appended to, so each chunk of `chunk_size` rows (see `iter_ratings_data`) is
+    written to its own file in `output_directory` (named `FEATHER_PART_FORMAT`), and only one chunk is in memory at a
+    time. Load the files with `read_ratings_data_from_feather`.
+
+    Requires the `feather-format` package.
+
+    Parameters
+    ----------
+    output_directory : str
+        A path to the output directory, which is created if it does not exist. The files of a previous export in it
+        are replaced.
+    chunk_size : int
+        The number of rows per file. (default is 100000)
+
+    Returns
+    -------
+    n_rows : int
+        The number of rows written
+    """
+    import feather
+
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    for filename in _get_feather_parts(output_directory):
+        os.remove(os.path.join(output_directory, filename))
+
+    n_rows = 0
+    for i, chunk in enumerate(iter_ratings_data(chunk_size)):
+        chunk = type_ratings_data(_explode_trial_data(chunk))
+        feather.write_dataframe(chunk.reset_index(drop=True), os.path.join(output_directory, FEATHER_PART_FORMAT % i))
+        n_rows += len(chunk)
+    return n_rows
+
+
+def read_ratings_data_from_feather(output_directory):
+    """
+    Load the ratings data saved by `save_ratings_data_to_feather`.
+
+    Requires the `feather-format` package.
+
+    Parameters
+    ----------
+    output_directory : str
+        The output directory of `save_ratings_data_to_feather`
+
+    Returns
+    -------
+    ratings : pandas.DataFrame
+    """
+    import feather
+
+    ratings = pd.concat([feather.read_dataframe(os.path.join(output_directory, filename))
+                         for filename in _get_feather_parts(output_directory)], ignore_index=True)
+    # the types of a column may differ between the files, e.g. if a file only has participants that passed the
+    # hearing test, or the categories of the categorical columns
+    return type_ratings_data(ratings)
+
+
+def _get_feather_parts(output_directory):
+    return sorted([filename for filename in os.listdir(output_directory)
+                   if re.match(FEATHER_PART_PATTERN, filename) is not None])
+
+
+def type_ratings_data(ratings):
+    """
+    Convert the columns of the ratings data to types that Feather can store: the stimulus and platform are
+    categorical, the hearing test outcome is boolean (or 1.0, 0.0, and NaN if it is missing for some participants),
+    and the time of the last hearing test attempt is a datetime (NaT if there was none). Each other column with mixed
+    values (e.g. the 'data_<key>' columns, see `_explode_trial_data`) is converted to float if all its values are
+    numbers or booleans, and to text otherwise, keeping the missing values as NaN.
+
+    Parameters
+    ----------
+    ratings : pandas.DataFrame
+
+    Returns
+    -------
+    ratings : pandas.DataFrame
+    """
+    ratings = ratings.copy()
+    for name in ('stimulus', 'participant_platform'):
+        ratings[name] = ratings[name].astype('category')
+    if ratings['participant_passed_hearing_test'].isnull().any():
+        ratings['participant_passed_hearing_test'] = ratings['participant_passed_hearing_test'].astype(float)
+    else:
+        ratings['participant_passed_hearing_test'] = ratings['participant_passed_hearing_test'].astype(bool)
+    ratings['participant_hearing_test_last_attempt'] = pd.to_datetime(ratings['participant_hearing_test_last_attempt'],
+                                                                      errors='coerce')
+    ratings['rating'] = ratings['rating'].astype(float)
+
+    for name in ratings.columns:
+        if ratings[name].dtype != object:
+            continue
+        values = ratings[name].dropna()
+        if all([isinstance(value, (bool, np.bool_, numbers.Number)) for value in values]):
+            ratings[name] = ratings[name].astype(float)
+        elif not all([isinstance(value, basestring) for value in values]):
+            ratings[name] = [value if pd.isnull(value) or isinstance(value, basestring) else unicode(value)
+                             for value in ratings[name]]
+    return ratings
+
+
+def _explode_trial_data(ratings):
+    """
+    Replace the JSON-encoded 'data' column of the ratings data by a 'data_<key>' column per key of the trial data.
+    Nested values stay JSON-encoded.
+
+    Parameters
+    ----------
+    ratings : pandas.DataFrame
+
+    Returns
+    -------
+    ratings : pandas.DataFrame
+    """
+    # the rows of a trial share the same data, so each distinct value is only parsed once
+    parsed = {}
+    records = []
+    for value in ratings['data']:
+        if value not in parsed:
+            parsed[value] = dict([('data_' + k, json.dumps(v) if isinstance(v, (list, dict)) else v)
+                                  for k, v in json.loads(value).items()])
+        records.append(parsed[value])
+
+    data = pd.DataFrame.from_records(records, index=ratings.index)
+    return pd.concat([ratings.drop('data', axis=1), data], axis=1)
+
+
+def _new_columns():
+    return dict([(name, []) for name in RATINGS_COLUMNS])
+
+
+def _append_trial(columns, trial):
+    """
+    Append the rows of the ratings of a trial to the column lists of the ratings data.
+
+    Parameters
+    ----------
+    columns : dict of list
+        The column lists keyed by column name
+    trial : sqlalchemy.util.KeyedTuple
+        A row of `_query_trials`
+
+    Returns
+    -------
+    None
+    """
+    t_data = json.loads(trial.data)
+    trial_ratings = t_data['ratings']
+    del t_data['ratings']
+    n_ratings = len(trial_ratings)
+
+    for name in TRIAL_COLUMNS:
+        columns[name].extend([getattr(trial, name)] * n_ratings)
+    columns['data'].extend([json.dumps(t_data)] * n_ratings)
+    for k, v in trial_ratings.items():
+        columns['stimulus'].append(k)
+        columns['rating'].append(float(v))
+
+
+def _columns_to_frame(columns, offset=0):
+    n_rows = len(columns['rating'])
+    return pd.DataFrame(columns, columns=RATINGS_COLUMNS, index=pd.RangeIndex(offset, offset + n_rows))
+
+
+def _query_trials(watermark=None):
+    """
+    Query the trials with the columns of their conditions and participants that are part of the ratings data.
+
+    Parameters
+    ----------
+    watermark : dict, optional
+        Only query the trials completed until its 'completed_until' time, and after its 'completed_after' time or with
+        an id greater than its 'last_trial_id' (unless None, see `_get_export_window`)
+
+    Returns
+    -------
+    sqlalchemy.orm.Query
+        Rows of `TRIAL_COLUMNS` and the trial's 'data', ordered by condition and trial
+    """
+    query = db.session.query(Condition.test_id.label('test_id'),
+                            Trial.id.label('trial_id'),
+                            Condition.id.label('condition_id'),
+                            Trial.participant_id.label('participant_id'),
+                            Participant.crowd_worker_id.label('participant_crowd_worker_id'),
+                            Participant.platform.label('participant_platform'),
+                            Trial.participant_passed_hearing_test.label('participant_passed_hearing_test'),
+                            Participant.hearing_test_attempts.label('participant_hearing_test_attempts'),
+                            Participant.hearing_test_last_attempt.label('participant_hearing_test_last_attempt'),
+                            Participant.pre_test_survey.label('participant_pre_test_survey'),
+                            Participant.post_test_survey.label('participant_post_test_survey'),
+                            Participant.hearing_response_estimation.label('participant_hearing_response_estimation'),
+                            Trial.data.label('data')). \
+        select_from(Trial). \
+        join(Condition, Trial.condition_id == Condition.id). \
+        join(Participant, Trial.participant_id == Participant.id). \
+        order_by(Condition.id, Trial.id)
+
+    if watermark is not None:
+        if watermark['completed_after'] is not None:
+            is_new = Trial.datetime_completed > watermark['completed_after']
+            if watermark['last_trial_id'] is not None:
+                is_new = or_(is_new, Trial.id > watermark['last_trial_id'])
+            query = query.filter(is_new)
+        query = query.filter(Trial.datetime_completed <= watermark['completed_until'])
+    return query
+
+
 def plot_mushra_boxplots(data, size=5, output_file=None):
     """
     Plot the MUSHRA ratings as a grid of boxplots. If `output_file` is defined, then save the plot to file.
@@ -105,6 +510,13 @@ if __name__ == '__main__':
 
     ch = sp.add_parser('save-data-to-csv', help='Save ratings data to a csv file.')
     ch.add_argument('output_file', type=str, help='Path to output file location')
+    ch.add_argument('--chunk-size', type=int, help='The number of rows written at a time.', default=CHUNK_SIZE)
+    ch.add_argument('--incremental', action='store_true', help='Append the trials completed since the last '
+                                                               'incremental export to the file.')
+
+    ch = sp.add_parser('save-data-to-feather', help='Save ratings data with typed columns to Feather files.')
+    ch.add_argument('output_directory', type=str, help='Path to output directory, with one Feather file per chunk')
+    ch.add_argument('--chunk-size', type=int, help='The number of rows per file.', default=CHUNK_SIZE)
 
     args = parser.parse_args()
 
@@ -112,5 +524,7 @@ if __name__ == '__main__':
         data = get_ratings_data()
         plot_mushra_boxplots(data, size=args.size, output_file=args.output_file)
     elif args.command == 'save-data-to-csv':
-        get_ratings_data(args.output_file)
+        save_ratings_data_to_csv(args.output_file, chunk_size=args.chunk_size, incremental=args.incremental)
+    elif args.command == 'save-data-to-feather':
+        save_ratings_data_to_feather(args.output_directory, chunk_size=args.chunk_size)
 
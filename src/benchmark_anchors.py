@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the STFTs of the source separation anchors (see `preprocess.generate_source_separation_anchors`) computed for
+all channels together (`preprocess.batch_stft` and `preprocess.batch_istft`) to the STFTs computed with librosa for
+each channel, on random signals. Prints the time of both and the largest difference of their results.
+
+Run on the command line, e.g.: ::
+
+    $ python benchmark_anchors.py --duration 30 --channels 2
+
+"""
+import argparse
+import timeit
+
+import numpy as np
+import librosa
+
+import preprocess
+
+
+def librosa_anchor_stfts(x, n_fft):
+    """
+    The STFTs of the anchors, computed with librosa for each channel (the former anchor generation).
+    """
+    X = np.array([librosa.stft(x[i], n_fft=n_fft, hop_length=n_fft/2) for i in range(x.shape[0])])
+    X_mono = np.mean(X, axis=0)
+    y = np.array([librosa.istft(_X, hop_length=n_fft/2) for _X in X])
+    artifacts = librosa.istft(X_mono, hop_length=n_fft/2)
+    return X, y, artifacts
+
+
+def batch_anchor_stfts(x, n_fft):
+    """
+    The STFTs of the anchors, computed for all channels together (the anchor generation).
+    """
+    X = preprocess.batch_stft(x, n_fft, n_fft/2)
+    X_mono = np.mean(X, axis=0)
+    y = preprocess.batch_istft(np.concatenate([X, X_mono.reshape((1,) + X_mono.shape)]), n_fft/2)
+    return X, y[:-1], y[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the STFTs of the source separation anchors.')
+    parser.add_argument('--duration', type=float, default=10., help='The duration of the signals in seconds.')
+    parser.add_argument('--sr', type=int, default=44100, help='The sampling rate.')
+    parser.add_argument('--channels', type=int, default=2, help='The number of channels.')
+    parser.add_argument('--repeat', type=int, default=5, help='The number of timed runs of each implementation.')
+    args = parser.parse_args()
+
+    x = np.random.RandomState(0).randn(args.channels, int(args.duration * args.sr)).astype(np.float32)
+    n_fft = int(2**np.round(np.log2(args.sr * 0.046)))
+
+    results = {}
+    for name, func in [('librosa', librosa_anchor_stfts), ('batch', batch_anchor_stfts)]:
+        results[name] = func(x, n_fft)
+        run_time = min(timeit.repeat(lambda: func(x, n_fft), repeat=args.repeat, number=1))
+        print('%-8s %8.1f ms' % (name, run_time * 1000))
+
+    for i, result_name in enumerate(['STFT', 'inverse STFT', 'artifacts']):
+        print('Largest difference of the %s: %g' % (result_name,
+                                                     np.abs(results['librosa'][i] - results['batch'][i]).max()))
+
+
+if __name__ == '__main__':
+    main()
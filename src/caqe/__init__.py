@@ -4,10 +4,10 @@ import logging
 from flask import Flask
 import os
 from flask_bootstrap import Bootstrap
-from flask.ext.sqlalchemy import SQLAlchemy
 from werkzeug.contrib.fixers import ProxyFix
 
 import caqe.configuration as configuration
+from caqe.database import PooledSQLAlchemy
 
 __version__ = '0.1.1a1'
 __title__ = 'CAQE'
@@ -41,7 +41,7 @@ elif configuration.APP_MODE == 'EVALUATION':
 
 
 Bootstrap(app)
-db = SQLAlchemy(app)
+db = PooledSQLAlchemy(app)
 
 # MAKE SURE TO CREATE THE DATABASE - E.G. db.create_all()
 
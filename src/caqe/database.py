@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Database engine setup. The connection pool of the engine is configured by the `SQLALCHEMY_POOL_*` configuration
+variables, and it records how long requests wait for a connection (see `pool_stats`), so that the number of web workers
+can be sized against the connection limit of the database.
+"""
+import time
+import threading
+
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+# Per-process statistics of the connection pool (see `TimedQueuePool`)
+pool_stats = {'checkouts': 0, 'waits': 0, 'wait_time': 0., 'max_wait_time': 0., 'timeouts': 0, 'disconnects': 0}
+
+# Checking out a connection slower than this counts as having waited for it
+WAIT_THRESHOLD_SEC = 0.001
+
+
+class TimedQueuePool(QueuePool):
+    """
+    A `QueuePool` that records the number of checkouts, and how long they waited for a connection to be returned to
+    the pool or to be opened (see `pool_stats`).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self._timing = threading.local()
+
+    def _do_get(self):
+        # `QueuePool._do_get` calls itself when it loses a race for an overflow connection
+        if getattr(self._timing, 'active', False):
+            return super(TimedQueuePool, self)._do_get()
+        self._timing.active = True
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            pool_stats['timeouts'] += 1
+            raise
+        finally:
+            self._timing.active = False
+            wait_time = time.time() - start
+            pool_stats['checkouts'] += 1
+            if wait_time > WAIT_THRESHOLD_SEC:
+                pool_stats['waits'] += 1
+                pool_stats['wait_time'] += wait_time
+                pool_stats['max_wait_time'] = max(pool_stats['max_wait_time'], wait_time)
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Check that a connection is alive when it is checked out of the pool. If it is not (e.g. the database server closed
+    it), the pool replaces it with a new connection.
+    """
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+    except Exception:
+        pool_stats['disconnects'] += 1
+        raise exc.DisconnectionError()
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    `SQLAlchemy` with a configurable and instrumented connection pool.
+
+    * `SQLALCHEMY_POOL_SIZE`, `SQLALCHEMY_MAX_OVERFLOW`, `SQLALCHEMY_POOL_TIMEOUT`, and `SQLALCHEMY_POOL_RECYCLE` are
+      applied by Flask-SQLAlchemy.
+    * If `SQLALCHEMY_POOL_PRE_PING`, connections are checked when they are checked out (see `ping_connection`).
+    * If `SQLALCHEMY_PGBOUNCER`, connections are not pooled by the engine, since PgBouncer pools them. (psycopg2 does
+      not prepare statements, so there are no server-side statements to invalidate when PgBouncer switches the server
+      connection.)
+    * Otherwise, the pool of server databases is a `TimedQueuePool`.
+    """
+
+    def apply_driver_hacks(self, app, info, options):
+        super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if app.config['SQLALCHEMY_POOL_PRE_PING']:
+            options['pool_events'] = [(ping_connection, 'checkout')]
+        if info.drivername.startswith('sqlite'):
+            # Flask-SQLAlchemy already picks the pool of SQLite databases
+            return
+        if app.config['SQLALCHEMY_PGBOUNCER']:
+            options['poolclass'] = NullPool
+            for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(option, None)
+        else:
+            options.setdefault('poolclass', TimedQueuePool)
+
+
+def get_pool_status(pool):
+    """
+    Get the current state of a connection pool.
+
+    Parameters
+    ----------
+    pool : sqlalchemy.pool.Pool
+
+    Returns
+    -------
+    status : dict
+        The 'size' of the pool, and the number of 'checked_out', 'checked_in', and 'overflow' connections. The
+        counts are None if the pool does not keep connections (e.g. `NullPool`).
+    """
+    if isinstance(pool, QueuePool):
+        return {'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow()}
+    return {'size': None, 'checked_out': None, 'checked_in': None, 'overflow': None}
@@ -5,34 +5,74 @@ Contains functions related to the experimental design of the listening test
 """
 import copy
 import json
+import hashlib
 import logging
 import random
 import datetime
 import itertools
-from collections import defaultdict
+import time
+from collections import defaultdict, namedtuple
 
-from sqlalchemy import func
+from sqlalchemy import func, case, exists, select, literal_column
+from sqlalchemy.orm import joinedload
 
 import caqe.utilities as utilities
 
-from .models import Condition, Participant, Trial, Test, Group
+from .models import Condition, ConditionProgress, ConditionReservation, ConfigSnapshot, Participant, Trial, Test, \
+    Group
 from caqe import db
 from caqe import app
 
 logger = logging.getLogger(__name__)
 
+# Per-process cache of the number of available conditions (see `get_available_condition_count`)
+_availability_cache = {'count': None, 'expires': 0.}
+availability_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+# The number of times we try to reserve conditions for a participant before giving up
+RESERVATION_ATTEMPTS = 3
+
+# Per-process cache of the parsed condition, group, and test data keyed by condition id (see `get_cached_conditions`).
+# The cached data is shared between requests and must not be modified. The whole cache expires every
+# `CONDITION_CACHE_TTL_SEC` seconds, so that worker processes pick up conditions that were reinserted by another process.
+CachedCondition = namedtuple('CachedCondition', ['id', 'test_id', 'group_id', 'data', 'group_data', 'test_data'])
+_condition_cache = {}
+_condition_cache_expiry = {'expires': 0.}
+condition_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+# The remaining trials of the study (see `get_rating_demand`)
+RatingDemand = namedtuple('RatingDemand', ['remaining_trials', 'active_reservations', 'passed_trials',
+                                           'failed_trials'])
+
+# Per-process cache of the parsed configuration snapshots keyed by id (see `get_test_data`)
+_config_snapshot_cache = {}
+
+# Per-process caches of the encrypted audio URLs, keyed by (participant_id, condition_group_id, s_id, e_id, URL), and
+# of the decrypted audio URL keys (see `encrypt_audio_stimuli` and `decode_audio_key`)
+encrypted_audio_url_cache = utilities.LRUCache(app.config['AUDIO_URL_CACHE_SIZE'])
+decrypted_audio_key_cache = utilities.LRUCache(app.config['AUDIO_URL_CACHE_SIZE'])
+
+# The number of rows per executemany when bulk inserting groups and conditions
+BULK_INSERT_BATCH_SIZE = 1000
+
 
 # Configure and insert conditions
-def insert_tests_and_conditions(config=None):
+def insert_tests_and_conditions(config=None, incremental=False):
     """
     This is where you configure and define the listening test. If you need to change HTML content based on
     the testing condition, you configure it here as well, overriding the default values in `CONFIGURATION`.
     Running this doctest initializes the development database.
 
+    The groups and conditions are bulk inserted in a single transaction.
+
     Parameters
     ----------
     config : flask.Config
         The application configuration
+    incremental : bool, optional
+        If True, only insert the tests and condition groups that are not in the database yet, e.g. to add condition
+        groups to a running experiment. Tests are matched by their test-specific variables and condition groups by
+        their data (excluding their conditions). Default is False.
 
     Returns
     -------
@@ -55,32 +95,214 @@ def insert_tests_and_conditions(config=None):
     """
     if config is None:
         config = app.config
-        
+
+    invalidate_condition_cache()
+
+    # store app config variables as well for reference. These are shared by all tests, so each test only stores its
+    # test-specific variables.
+    config_snapshot = get_or_insert_config_snapshot(config)
+
+    existing_tests = []
+    existing_group_datas = defaultdict(set)
+    if incremental:
+        existing_tests = Test.query.order_by(Test.id).all()
+        for test_id, group_data in db.session.query(Condition.test_id, Group.data).join(Group).distinct():
+            existing_group_datas[test_id].add(json.dumps(json.loads(group_data), sort_keys=True))
+
+    # insert the tests (there are only a few) and collect the new groups
+    new_groups = []
     for test_dict in config['TESTS']:
-        # store app config variables as well for reference
-        test_config = copy.deepcopy(config)
-        del test_config['TESTS']
-        del test_config['PERMANENT_SESSION_LIFETIME']  # a flask variable
-        test_config.update(test_dict['test_config_variables'])
-        test = Test(json.dumps(test_config))
-        db.session.add(test)
-        db.session.commit()
+        test = _find_test(existing_tests, test_dict['test_config_variables'])
+        if test is None:
+            test = Test(json.dumps(test_dict['test_config_variables']), config_snapshot_id=config_snapshot.id)
+            db.session.add(test)
+            db.session.flush()
 
         for condition_group in test_dict['condition_groups']:
-            conditions = condition_group['conditions']
-            del condition_group['conditions']
-            group = Group(data=json.dumps(condition_group))
-            db.session.add(group)
-            db.session.commit()
-            for condition_dict in conditions:
-                c = Condition(test_id=test.id, group_id=group.id, data=json.dumps(condition_dict))
-                db.session.add(c)
-                db.session.commit()
+            group_data = dict([(k, v) for k, v in condition_group.items() if k != 'conditions'])
+            if json.dumps(group_data, sort_keys=True) in existing_group_datas[test.id]:
+                continue
+            new_groups.append((test.id, json.dumps(group_data), condition_group['conditions']))
+
+    group_ids = _bulk_insert_groups([group_data for _, group_data, _ in new_groups])
+
+    condition_rows = []
+    for group_id, (test_id, _, conditions) in zip(group_ids, new_groups):
+        for condition_dict in conditions:
+            condition_rows.append({'test_id': test_id, 'group_id': group_id, 'data': json.dumps(condition_dict)})
+    _bulk_insert(Condition.__table__, condition_rows)
+
+    # add the (empty) trial counts of the new conditions
+    has_progress = exists().where(ConditionProgress.condition_id == Condition.id)
+    db.session.execute(ConditionProgress.__table__.insert().from_select(
+        ['condition_id', 'passed_count', 'failed_count'],
+        select([Condition.id, literal_column('0'), literal_column('0')]).where(~has_progress)))
+
+    db.session.commit()
+    logger.info('Inserted %d condition groups and %d conditions' % (len(group_ids), len(condition_rows)))
+
+
+def _find_test(tests, test_config_variables):
+    """
+    Find the test in `tests` with the test-specific variables `test_config_variables`, or None.
+    """
+    test_config_variables = json.loads(json.dumps(test_config_variables))
+    for test in tests:
+        test_data = json.loads(test.data)
+        if test.config_snapshot_id is None:
+            # tests inserted before configuration snapshots store the full configuration
+            if all([test_data.get(k) == v for k, v in test_config_variables.items()]):
+                return test
+        elif test_data == test_config_variables:
+            return test
+    return None
+
+
+def _bulk_insert(table, rows):
+    """
+    Insert `rows` into `table` with batched executemany statements, without committing.
+    """
+    for i in range(0, len(rows), BULK_INSERT_BATCH_SIZE):
+        db.session.execute(table.insert(), rows[i:(i + BULK_INSERT_BATCH_SIZE)])
+
+
+def _bulk_insert_groups(group_datas):
+    """
+    Bulk insert groups with the JSON-encoded `group_datas`, without committing, and return their ids (in order).
+    """
+    if len(group_datas) == 0:
+        return []
+
+    max_group_id = db.session.query(func.max(Group.id)).scalar() or 0
+    _bulk_insert(Group.__table__, [{'data': group_data} for group_data in group_datas])
+
+    # resolve the ids of the groups we just inserted all at once
+    inserted_groups = db.session.query(Group.id, Group.data).filter(Group.id > max_group_id).order_by(Group.id).all()
+    if [group_data for _, group_data in inserted_groups] != group_datas:
+        raise Exception('Could not resolve the ids of the inserted groups. Were groups inserted concurrently?')
+    return [group_id for group_id, _ in inserted_groups]
+
+
+def get_or_insert_config_snapshot(config):
+    """
+    Get the configuration snapshot of `config`, inserting it if there is no snapshot of this version yet.
+
+    Parameters
+    ----------
+    config : flask.Config
+        The application configuration
+
+    Returns
+    -------
+    config_snapshot : caqe.models.ConfigSnapshot
+    """
+    snapshot_config = dict(config)
+    del snapshot_config['TESTS']
+    del snapshot_config['PERMANENT_SESSION_LIFETIME']  # a flask variable
+    data = json.dumps(snapshot_config, sort_keys=True)
+    version = hashlib.sha1(data).hexdigest()
+
+    config_snapshot = ConfigSnapshot.query.filter_by(version=version).first()
+    if config_snapshot is None:
+        config_snapshot = ConfigSnapshot(version, data)
+        db.session.add(config_snapshot)
+        db.session.commit()
+    return config_snapshot
+
+
+def get_test_data(test):
+    """
+    Get the test variables of a test, i.e. its test-specific variables merged over the variables of its configuration
+    snapshot. The parsed snapshot is cached per process.
+
+    Parameters
+    ----------
+    test : caqe.models.Test
+
+    Returns
+    -------
+    test_data : dict
+    """
+    test_data = json.loads(test.data)
+    if test.config_snapshot_id is None:
+        # tests inserted before configuration snapshots store the full configuration
+        return test_data
+
+    if test.config_snapshot_id not in _config_snapshot_cache:
+        _config_snapshot_cache[test.config_snapshot_id] = json.loads(test.config_snapshot.data)
+
+    merged_data = dict(_config_snapshot_cache[test.config_snapshot_id])
+    merged_data.update(test_data)
+    return merged_data
+
+
+def rebuild_condition_progress():
+    """
+    Rebuild the per-condition trial counts (`ConditionProgress`) from the trial table. Run this once on databases that
+    were created before the counts were maintained (e.g. ``python create_db.py --rebuild-condition-progress``).
+
+    Returns
+    -------
+    None
+    """
+    passed_count = func.sum(case([(Trial.participant_passed_hearing_test == True, 1)], else_=0))
+    trial_count = func.count(Trial.id)
+    counts = dict([(condition_id, (passed, total - passed)) for condition_id, passed, total in
+                   db.session.query(Trial.condition_id, passed_count, trial_count).group_by(Trial.condition_id)])
+
+    ConditionProgress.query.delete()
+    for (condition_id,) in db.session.query(Condition.id):
+        passed, failed = counts.get(condition_id, (0, 0))
+        db.session.add(ConditionProgress(condition_id, passed_count=passed, failed_count=failed))
+    db.session.commit()
+
+
+def record_trial_progress(condition_id, participant_passed_hearing_test):
+    """
+    Increment the trial count of a condition. Call this in the same transaction as the `Trial` insert, after adding the
+    trial to the session. The progress row of each condition is created with the condition (see
+    `insert_tests_and_conditions`). If it is missing (e.g. in databases created before the counts were maintained), it
+    is inserted with the counts of the trial table, including this trial.
+
+    Parameters
+    ----------
+    condition_id : int
+    participant_passed_hearing_test : bool
+
+    Returns
+    -------
+    None
+    """
+    if participant_passed_hearing_test:
+        count_name = 'passed_count'
+    else:
+        count_name = 'failed_count'
+    count_column = getattr(ConditionProgress, count_name)
+
+    # increment in SQL so that concurrent submissions do not overwrite each other
+    updated = ConditionProgress.query.filter_by(condition_id=condition_id). \
+        update({count_name: count_column + 1}, synchronize_session=False)
+    if updated == 0:
+        logger.warning('Condition %d has no progress row. Inserting it from the trial table. Run '
+                       '`create_db.py --rebuild-condition-progress` to insert the rows of all conditions.' % condition_id)
+        # count this trial as well
+        db.session.flush()
+        trial_count = db.session.query(func.count(Trial.id)).filter(Trial.condition_id == Condition.id). \
+            correlate(Condition).as_scalar()
+        passed_count = _passed_trial_count()
+        has_progress = exists().where(ConditionProgress.condition_id == Condition.id)
+        inserted = db.session.execute(ConditionProgress.__table__.insert().from_select(
+            ['condition_id', 'passed_count', 'failed_count'],
+            select([Condition.id, passed_count, trial_count - passed_count]).
+            where(Condition.id == condition_id).where(~has_progress))).rowcount
+        if inserted == 0:
+            raise Exception('Condition %d does not exist.' % condition_id)
 
 
 def get_available_conditions(limit_to_condition_ids=None):
     """
-    Get conditions available without regard to participant.
+    Get conditions available without regard to participant. A condition is available if the number of its trials by
+    participants that passed the hearing test plus its active reservations is less than `TRIALS_PER_CONDITION`.
 
     Parameters
     ----------
@@ -92,10 +314,8 @@ def get_available_conditions(limit_to_condition_ids=None):
     conditions: list of Condition
         The available conditions
     """
-    finished_conditions = db.session.query(Trial.condition_id).filter(Trial.participant_passed_hearing_test == True). \
-        group_by(Trial.condition_id).having(func.count('*') >= app.config['TRIALS_PER_CONDITION']).subquery()
-
-    conditions = db.session.query(Condition).filter(Condition.id.notin_(finished_conditions))
+    conditions = db.session.query(Condition).outerjoin(ConditionProgress). \
+        filter(_condition_fill() < app.config['TRIALS_PER_CONDITION'])
 
     if limit_to_condition_ids is not None:
         conditions = conditions.filter(Condition.id.in_(limit_to_condition_ids))
@@ -105,9 +325,90 @@ def get_available_conditions(limit_to_condition_ids=None):
     return conditions
 
 
-def assign_conditions(participant, limit_to_condition_ids=None):
+def _condition_fill():
+    """
+    SQL expression of the number of trials by participants that passed the hearing test plus the number of active
+    reservations of a condition. The query must be outer joined with `ConditionProgress`.
+    """
+    # use the maintained trial counts instead of aggregating the trial table. Only the trials of conditions without a
+    # progress row (see `record_trial_progress`) are counted in the trial table.
+    active_reservations = db.session.query(func.count(ConditionReservation.id)). \
+        filter(ConditionReservation.condition_id == Condition.id). \
+        filter(ConditionReservation.expires > datetime.datetime.now()). \
+        correlate(Condition).as_scalar()
+    return func.coalesce(ConditionProgress.passed_count, _passed_trial_count()) + active_reservations
+
+
+def _passed_trial_count():
+    """
+    SQL expression of the number of trials of a condition by participants that passed the hearing test, counted in the
+    trial table.
+    """
+    return db.session.query(func.count(Trial.id)). \
+        filter(Trial.condition_id == Condition.id). \
+        filter(Trial.participant_passed_hearing_test == True). \
+        correlate(Condition).as_scalar()
+
+
+def get_rating_demand():
+    """
+    Get the number of trials still needed to complete the study, i.e. the unfilled slots of all conditions (see
+    `get_available_conditions`), along with the counts of active reservations and completed trials.
+
+    Returns
+    -------
+    demand : RatingDemand
+    """
+    fill = _condition_fill()
+    remaining_trials = db.session.query(func.sum(app.config['TRIALS_PER_CONDITION'] - fill)). \
+        select_from(Condition).outerjoin(ConditionProgress). \
+        filter(fill < app.config['TRIALS_PER_CONDITION']).scalar()
+    active_reservations = db.session.query(func.count(ConditionReservation.id)). \
+        filter(ConditionReservation.expires > datetime.datetime.now()).scalar()
+    passed_trials, failed_trials = db.session.query(func.sum(ConditionProgress.passed_count),
+                                                    func.sum(ConditionProgress.failed_count)).one()
+    return RatingDemand(int(remaining_trials or 0),
+                        int(active_reservations or 0),
+                        int(passed_trials or 0),
+                        int(failed_trials or 0))
+
+
+def get_available_condition_count():
     """
-    Assign experimental conditions for a participant's trial.
+    Get the number of conditions available without regard to participant. The count is cached per process for
+    `AVAILABILITY_CACHE_TTL_SEC` seconds, or until `invalidate_availability_cache` is called, so that the preview page
+    does not query the database on every load.
+
+    Returns
+    -------
+    count : int
+    """
+    if _availability_cache['count'] is not None and time.time() < _availability_cache['expires']:
+        availability_cache_stats['hits'] += 1
+        return _availability_cache['count']
+
+    availability_cache_stats['misses'] += 1
+    count = get_available_conditions().count()
+    _availability_cache['count'] = count
+    _availability_cache['expires'] = time.time() + app.config['AVAILABILITY_CACHE_TTL_SEC']
+    return count
+
+
+def invalidate_availability_cache():
+    """
+    Invalidate this process's cached count of available conditions, e.g. after trials have been saved.
+
+    Returns
+    -------
+    None
+    """
+    _availability_cache['count'] = None
+    availability_cache_stats['invalidations'] += 1
+
+
+def _select_conditions(participant, limit_to_condition_ids=None):
+    """
+    Select (but do not reserve) experimental conditions for a participant's trial.
 
     Parameters
     ----------
@@ -118,55 +419,62 @@ def assign_conditions(participant, limit_to_condition_ids=None):
     Returns
     -------
     condition_ids : list of int
+        None if there are no conditions left for the participant.
+    condition_group_ids : list of int
+        None if there are no conditions left for the participant.
     """
     # Ideal assignment in our scenario:
     # If the participant passed the listening test:
-    # Assign a participant the first condition (in order of index) that has
+    # Assign a participant the least-filled conditions (i.e. with the fewest trials and reservations) that have
     #   A) not been assigned to them before
     #   B) has not received the required number of ratings by people that have passed the listening test
     # If the participant has not passed the listening test:
-    #   Same as above. This may give us a bit more ratings from lower condition indices for people that have not passed
-    #   the listening test, but I think that is ok.
-
-    # construct our subqueries
-    # conditions which have the required number of trials with hearing_test passed participants
-    conditions = get_available_conditions(limit_to_condition_ids)
+    #   Same as above. Their trials do not count towards the fill, so this may give us a bit more ratings of the
+    #   least-filled conditions from people that have not passed the listening test, but I think that is ok.
 
-    # the conditions the participant has already done
-    participant_conditions = db.session.query(Trial.condition_id).join(Participant). \
-        filter(Participant.id == participant.id).subquery()
+    # the conditions the participant has already done (backed by the trial(participant_id, condition_id) index)
+    participant_conditions = db.session.query(Trial.id). \
+        filter(Trial.participant_id == participant.id). \
+        filter(Trial.condition_id == Condition.id). \
+        correlate(Condition).exists()
 
-    conditions = conditions.filter(Condition.id.notin_(participant_conditions))
+    # resolve the available conditions for this participant in a single query, only loading the columns we need
+    conditions = get_available_conditions(limit_to_condition_ids). \
+        filter(~participant_conditions). \
+        with_entities(Condition.id, Condition.test_id, Condition.group_id, _condition_fill().label('fill')).all()
 
-    # find which group has the most conditions for this participant
+    if len(conditions) == 0:
+        logger.info('No hits left for %r' % participant)
+        return None, None
+
+    # find which group has the most conditions for this participant (breaking ties by the least-filled group)
+    group_counts = defaultdict(int)
+    group_fill = {}
+    group_ids = []
+    for c in conditions:
+        if c.group_id not in group_counts:
+            group_ids.append(c.group_id)
+            group_fill[c.group_id] = c.fill
+        group_counts[c.group_id] += 1
+        group_fill[c.group_id] = min(group_fill[c.group_id], c.fill)
 
     if app.config['TEST_CONDITION_GROUP_ORDER_RANDOMIZED']:
-        group_id = db.session.query(Condition.group_id).filter(Condition.id.in_([c.id for c in conditions.all()])). \
-            group_by(Condition.group_id). \
-            order_by(func.random()).first()[0]
+        group_id = random.choice(group_ids)
     else:
-        group_id = db.session.query(Condition.group_id).filter(Condition.id.in_([c.id for c in conditions.all()])). \
-            group_by(Condition.group_id). \
-            order_by(func.count(Condition.group_id).desc()).first()[0]
+        group_id = max(group_ids, key=lambda g_id: (group_counts[g_id], -group_fill[g_id]))
     condition_group_ids = [group_id,]
 
-    # limit to one group
-    conditions = conditions.filter(Condition.group_id == group_id).order_by(Condition.id).all()
-
-    if conditions is None or len(conditions) == 0:
-        logger.info('No hits left for %r' % participant)
-        return None
+    # limit to one group, preferring the least-filled conditions so that conditions fill evenly
+    conditions = sorted([c for c in conditions if c.group_id == group_id], key=lambda c: c.fill)
+    fill = dict([(c.id, c.fill) for c in conditions])
 
     if app.config['LIMIT_SUBJECT_TO_ONE_TASK_TYPE']:
-        previous_trial = participant.trials.first()
-        try:
-            if previous_trial.condition.test_id != conditions[0].test_id:
-                # If the participant is supposed to be limited to one task type, and we are out of all task of that type
-                logger.info('Subject limited to ont task type. No hits left for %r' % participant)
-                return None
-        except AttributeError:
-            # no previous trials
-            pass
+        previous_test_id = db.session.query(Condition.test_id).join(Trial). \
+            filter(Trial.participant_id == participant.id).first()
+        if previous_test_id is not None and previous_test_id[0] != conditions[0].test_id:
+            # If the participant is supposed to be limited to one task type, and we are out of all task of that type
+            logger.info('Subject limited to ont task type. No hits left for %r' % participant)
+            return None, None
 
     if app.config['TEST_CONDITION_ORDER_RANDOMIZED']:  # i.e. randomize the condition order within a test
         # determine what test we are on
@@ -175,22 +483,204 @@ def assign_conditions(participant, limit_to_condition_ids=None):
         # randomize the order of the conditions within that test
         condition_ids = [c.id for c in conditions if c.test_id == current_test_id]
         random.shuffle(condition_ids)
+        condition_ids.sort(key=fill.get)
         condition_ids = condition_ids[:app.config['CONDITIONS_PER_EVALUATION']]
 
         # if there are not enough conditions left from this test, add more from the next.
         if len(condition_ids) < app.config['CONDITIONS_PER_EVALUATION']:
             more_cids = [c.id for c in conditions if c.test_id == current_test_id + 1]
             random.shuffle(more_cids)
+            more_cids.sort(key=fill.get)
             condition_ids += more_cids[:(app.config['CONDITIONS_PER_EVALUATION'] - len(condition_ids))]
     else:
         condition_ids = [c.id for c in conditions[:app.config['CONDITIONS_PER_EVALUATION']]]
 
-    logger.info('Participant %r assigned conditions: %r in groups: %r' % (participant,
-                                                                          condition_ids,
-                                                                          condition_group_ids))
     return condition_ids, condition_group_ids
 
 
+def assign_conditions(participant, limit_to_condition_ids=None):
+    """
+    Assign experimental conditions for a participant's trial and reserve them (see `reserve_conditions`) so that
+    concurrent participants are not assigned more trials of a condition than `TRIALS_PER_CONDITION`.
+
+    Parameters
+    ----------
+    participant : caqe.models.Participant
+    limit_to_condition_ids : list, optional
+        List of integer ids.
+
+    Returns
+    -------
+    condition_ids : list of int
+        None if there are no conditions left for the participant.
+    condition_group_ids : list of int
+        None if there are no conditions left for the participant.
+    """
+    # the participant is starting over, so release their previous reservations. Also reclaim any expired ones.
+    release_reservations(participant.id)
+    release_expired_reservations()
+    db.session.commit()
+
+    for _attempt in range(RESERVATION_ATTEMPTS):
+        condition_ids, condition_group_ids = _select_conditions(participant, limit_to_condition_ids)
+        if condition_ids is None:
+            return None, None
+
+        # another participant may have reserved the last slots of these conditions in the meantime
+        condition_ids = reserve_conditions(participant, condition_ids)
+        if len(condition_ids) > 0:
+            logger.info('Participant %r assigned conditions: %r in groups: %r' % (participant,
+                                                                                  condition_ids,
+                                                                                  condition_group_ids))
+            return condition_ids, condition_group_ids
+
+    logger.info('Could not reserve conditions for %r' % participant)
+    return None, None
+
+
+def reserve_conditions(participant, condition_ids):
+    """
+    Atomically reserve a slot of each condition in `condition_ids` for the participant. Reservations count towards
+    the availability of a condition until they are released (see `release_reservations`) or expire after
+    `CONDITION_RESERVATION_DURATION_IN_SECONDS`.
+
+    Parameters
+    ----------
+    participant : caqe.models.Participant
+    condition_ids : list of int
+
+    Returns
+    -------
+    reserved_condition_ids : list of int
+        The ids of the conditions that were still available and are now reserved (in the order of `condition_ids`)
+
+    Note
+    ----
+    Concurrent reservations of the same conditions are serialized by locking their `ConditionProgress` rows (in
+    condition order to avoid deadlocks). SQLite does not support row locks, and its transactions only take the database
+    write lock when they first write, so on SQLite we write to the rows first (without changing them) to take the lock
+    before recounting.
+    """
+    progress_rows = db.session.query(ConditionProgress).filter(ConditionProgress.condition_id.in_(condition_ids))
+    if db.engine.dialect.name == 'sqlite':
+        progress_rows.update({ConditionProgress.passed_count: ConditionProgress.passed_count},
+                             synchronize_session=False)
+    else:
+        progress_rows.with_entities(ConditionProgress.condition_id). \
+            order_by(ConditionProgress.condition_id). \
+            with_for_update().all()
+
+    # recount now that we hold the locks
+    available_ids = set([c_id for (c_id,) in get_available_conditions(condition_ids).with_entities(Condition.id)])
+    reserved_condition_ids = [c_id for c_id in condition_ids if c_id in available_ids]
+
+    duration = app.config['CONDITION_RESERVATION_DURATION_IN_SECONDS']
+    if duration is None:
+        duration = app.config['MTURK_ASSIGNMENT_DURATION_IN_SECONDS']
+    expires = datetime.datetime.now() + datetime.timedelta(seconds=duration)
+    for c_id in reserved_condition_ids:
+        db.session.add(ConditionReservation(c_id, participant.id, expires))
+    db.session.commit()
+
+    return reserved_condition_ids
+
+
+def release_reservations(participant_id, condition_ids=None):
+    """
+    Release the participant's condition reservations, e.g. once their trials have been saved. This does not commit the
+    session, so that it can be part of the same transaction as the `Trial` inserts.
+
+    Parameters
+    ----------
+    participant_id : int
+    condition_ids : list of int, optional
+        Only release the reservations of these conditions. If None, release all of the participant's reservations.
+
+    Returns
+    -------
+    None
+    """
+    reservations = ConditionReservation.query.filter(ConditionReservation.participant_id == participant_id)
+    if condition_ids is not None:
+        reservations = reservations.filter(ConditionReservation.condition_id.in_(condition_ids))
+    reservations.delete(synchronize_session=False)
+
+
+def release_expired_reservations():
+    """
+    Delete expired condition reservations. Expired reservations already no longer count towards availability, so this
+    only keeps the reservation table small. This does not commit the session.
+
+    Returns
+    -------
+    None
+    """
+    ConditionReservation.query.filter(ConditionReservation.expires <= datetime.datetime.now()). \
+        delete(synchronize_session=False)
+
+
+def get_cached_conditions(condition_ids):
+    """
+    Get the parsed data of conditions (and their groups and tests) from the per-process cache, loading any that are
+    not cached yet with a single query. The cache is cleared every `CONDITION_CACHE_TTL_SEC` seconds, or when
+    `invalidate_condition_cache` is called.
+
+    Parameters
+    ----------
+    condition_ids : list of int
+
+    Returns
+    -------
+    conditions : list of CachedCondition
+        The cached conditions in the order of `condition_ids`. Do not modify the data of the cached conditions.
+    """
+    if time.time() >= _condition_cache_expiry['expires']:
+        invalidate_condition_cache()
+        _condition_cache_expiry['expires'] = time.time() + app.config['CONDITION_CACHE_TTL_SEC']
+
+    missing_ids = [c_id for c_id in condition_ids if c_id not in _condition_cache]
+    condition_cache_stats['hits'] += len(condition_ids) - len(missing_ids)
+    condition_cache_stats['misses'] += len(missing_ids)
+
+    if len(missing_ids) > 0:
+        conditions = Condition.query.filter(Condition.id.in_(missing_ids)). \
+            options(joinedload('test'), joinedload('group')).all()
+
+        # parse each test and group only once, even if it is shared by several conditions
+        test_datas = {}
+        group_datas = {}
+        for condition in conditions:
+            if condition.test_id not in test_datas:
+                test_datas[condition.test_id] = get_test_data(condition.test)
+            if condition.group_id not in group_datas:
+                group_datas[condition.group_id] = json.loads(condition.group.data)
+            _condition_cache[condition.id] = CachedCondition(id=condition.id,
+                                                             test_id=condition.test_id,
+                                                             group_id=condition.group_id,
+                                                             data=json.loads(condition.data),
+                                                             group_data=group_datas[condition.group_id],
+                                                             test_data=test_datas[condition.test_id])
+
+    return [_condition_cache[c_id] for c_id in condition_ids]
+
+
+def invalidate_condition_cache():
+    """
+    Clear this process's cache of parsed condition data and its caches of the encrypted audio URLs of the conditions,
+    e.g. after the tests and conditions have been (re)inserted. Other processes clear their caches when they expire
+    (see `CONDITION_CACHE_TTL_SEC`).
+
+    Returns
+    -------
+    None
+    """
+    _condition_cache.clear()
+    _config_snapshot_cache.clear()
+    encrypted_audio_url_cache.clear()
+    decrypted_audio_key_cache.clear()
+    condition_cache_stats['invalidations'] += 1
+
+
 def get_test_configurations(condition_ids, participant_id):
     """
     Generate template configuration variables from the list of experimental conditions.
@@ -204,24 +694,24 @@ def get_test_configurations(condition_ids, participant_id):
     -------
     test_configuration : list of list of dict
         A list of dictionaries containing all the configuration variables for each test, including a list of conditions
-        and their variables
+        and their variables. The test variables are shared with the condition cache and must not be modified.
     """
     test_configurations = []
 
     current_test_id = None
     test_config = None
-    for c_id in condition_ids:
-        condition = Condition.query.filter_by(id=c_id).first()
+    for condition in get_cached_conditions(condition_ids):
         if condition.test_id != current_test_id:
             if test_config is not None:
                 test_configurations.append(test_config)
             current_test_id = condition.test_id
-            test_config = {'test': json.loads(condition.test.data),
+            test_config = {'test': condition.test_data,
                            'conditions': [],
                            'condition_groups': {}}
 
-        condition_data = json.loads(condition.data)
-        condition_group_data = json.loads(condition.group.data)
+        # copy the cached data since we modify it below
+        condition_data = copy.deepcopy(condition.data)
+        condition_group_data = copy.deepcopy(condition.group_data)
 
         if app.config['STIMULUS_ORDER_RANDOMIZED']:
             random.shuffle(condition_group_data['stimulus_files'])
@@ -331,12 +821,20 @@ def encrypt_audio_stimuli(audio_stimuli, participant_id, condition_group_id):
     """
 
     def encode_url(url, _s_id, _e_id):
-        adict = {'s_id': _s_id,
-                 'p_id': participant_id,
-                 'g_id': condition_group_id,
-                 'e_id': _e_id,
-                 'URL': url}
-        return '/audio/' + utilities.encrypt_data(adict) + '.wav'
+        cache_key = (participant_id, condition_group_id, _s_id, _e_id, url)
+        encrypted_url = encrypted_audio_url_cache.get(cache_key)
+        if encrypted_url is None:
+            adict = {'s_id': _s_id,
+                     'p_id': participant_id,
+                     'g_id': condition_group_id,
+                     'e_id': _e_id,
+                     'URL': url}
+            audio_file_key = utilities.encrypt_data(adict)
+            encrypted_url = '/audio/' + audio_file_key + '.wav'
+            encrypted_audio_url_cache.set(cache_key, encrypted_url)
+            # we already know what the key decrypts to, so there is no need to decrypt it when it is requested
+            decrypted_audio_key_cache.set(audio_file_key, json.loads(json.dumps(adict)))
+        return encrypted_url
 
     audio_stimuli = copy.deepcopy(audio_stimuli)
 
@@ -358,7 +856,30 @@ def _decode_url(encrypted_url):
     encrypted_data = encrypted_url[7:]
     # remove .wav
     encrypted_data = encrypted_data[:-4]
-    return utilities.decrypt_data(str(encrypted_data))
+    return decode_audio_key(encrypted_data)
+
+
+def decode_audio_key(audio_file_key):
+    """
+    Decrypt an audio URL key (see `encrypt_audio_stimuli`). The decrypted keys are cached per process.
+
+    Parameters
+    ----------
+    audio_file_key : str
+        The encrypted key of an audio URL, i.e. without the '/audio/' prefix and the '.wav' extension
+
+    Returns
+    -------
+    audio_file_dict : dict
+        The decrypted dictionary with the keys 's_id', 'p_id', 'g_id', 'e_id', and 'URL'. This is shared with the
+        cache and must not be modified.
+    """
+    audio_file_key = str(audio_file_key)
+    audio_file_dict = decrypted_audio_key_cache.get(audio_file_key)
+    if audio_file_dict is None:
+        audio_file_dict = utilities.decrypt_data(audio_file_key)
+        decrypted_audio_key_cache.set(audio_file_key, audio_file_dict)
+    return audio_file_dict
 
 
 def decrypt_audio_stimuli(condition_data):
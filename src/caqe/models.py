@@ -105,6 +105,33 @@ class Participant(db.Model):
         self.passed_hearing_test = passed_hearing_test
 
 
+class ConfigSnapshot(db.Model):
+    """
+    A snapshot of the application configuration at the time the tests were inserted. Tests that were inserted with the
+    same configuration share a snapshot.
+
+    Attributes
+    ----------
+    id : int
+        Primary key
+    version : str
+        SHA-1 hash of `data`, which identifies the snapshot
+    data : str
+        JSON-encoded string of the application configuration variables
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.String(40), unique=True)
+    data = db.Column(db.Text)
+    tests = db.relationship('Test', backref='config_snapshot', lazy='dynamic')
+
+    def __init__(self, version, data):
+        self.version = version
+        self.data = data
+
+    def __repr__(self):
+        return "<ConfigSnapshot id=%r, version=%r>" % (self.id, self.version)
+
+
 class Test(db.Model):
     """
     An experimental test. Many conditions may share these properties.
@@ -114,17 +141,23 @@ class Test(db.Model):
     id: int
         Primary key
     data: str
-        JSON-encoded string of formatted test variables
+        JSON-encoded string of formatted test variables. If `config_snapshot_id` is defined, these are only the
+        test-specific variables, which override the variables of the configuration snapshot (see
+        `caqe.experiment.get_test_data`).
+    config_snapshot_id: int, optional
+        Foreign key to the ConfigSnapshot the test variables are based on
     """
     id = db.Column(db.Integer, primary_key=True)
     data = db.Column(db.Text)
+    config_snapshot_id = db.Column(db.Integer, db.ForeignKey('config_snapshot.id'))
     conditions = db.relationship('Condition', backref='test', lazy='dynamic')
 
-    def __init__(self, data):
+    def __init__(self, data, config_snapshot_id=None):
         self.data = data
+        self.config_snapshot_id = config_snapshot_id
 
     def __repr__(self):
-        return "<Test id=%r, data=%r>" % (self.id, self.data)
+        return "<Test id=%r, config_snapshot_id=%r, data=%r>" % (self.id, self.config_snapshot_id, self.data)
 
 
 class Group(db.Model):
@@ -178,6 +211,71 @@ class Condition(db.Model):
         return "<Condition id=%r, test_id=%r, group_id=%r, data=%r>" % (self.id, self.test_id, self.group_id, self.data)
 
 
+class ConditionProgress(db.Model):
+    """
+    Denormalized trial counts of a condition. These are maintained in the same transaction as the `Trial` inserts so
+    that condition availability can be determined without aggregating the trial table.
+
+    Attributes
+    ----------
+    condition_id : int
+        Primary key and foreign key to the Condition
+    passed_count : int
+        The number of completed trials by participants that passed the hearing test
+    failed_count : int
+        The number of completed trials by participants that did not pass the hearing test
+    """
+    condition_id = db.Column(db.Integer, db.ForeignKey('condition.id'), primary_key=True)
+    passed_count = db.Column(db.Integer, default=0, nullable=False, index=True)
+    failed_count = db.Column(db.Integer, default=0, nullable=False)
+    condition = db.relationship('Condition', backref=db.backref('progress', uselist=False))
+
+    def __init__(self, condition_id, passed_count=0, failed_count=0):
+        self.condition_id = condition_id
+        self.passed_count = passed_count
+        self.failed_count = failed_count
+
+    def __repr__(self):
+        return "<ConditionProgress condition_id=%r, passed_count=%r, failed_count=%r>" % (self.condition_id,
+                                                                                          self.passed_count,
+                                                                                          self.failed_count)
+
+
+class ConditionReservation(db.Model):
+    """
+    A participant's reservation of a trial of a condition, i.e. a lease on one of the `TRIALS_PER_CONDITION` slots of
+    the condition between assignment and the submission of the trial.
+
+    Attributes
+    ----------
+    id : int
+        Primary key
+    condition_id : int
+        Foreign key to the reserved Condition
+    participant_id : int
+        Foreign key to the Participant holding the reservation
+    expires : DateTime
+        The reservation no longer counts towards the availability of the condition after this time
+    """
+    __table_args__ = (db.Index('ix_condition_reservation_condition_id_expires', 'condition_id', 'expires'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    condition_id = db.Column(db.Integer, db.ForeignKey('condition.id'))
+    participant_id = db.Column(db.Integer, db.ForeignKey('participant.id'), index=True)
+    expires = db.Column(db.DateTime, index=True)
+
+    def __init__(self, condition_id, participant_id, expires):
+        self.condition_id = condition_id
+        self.participant_id = participant_id
+        self.expires = expires
+
+    def __repr__(self):
+        return "<ConditionReservation id=%r, condition_id=%r, participant_id=%r, expires=%r>" % (self.id,
+                                                                                               self.condition_id,
+                                                                                               self.participant_id,
+                                                                                               self.expires)
+
+
 class Trial(db.Model):
     """
     A trial in an experiment
@@ -196,14 +294,23 @@ class Trial(db.Model):
         JSON-encoded string of data from the crowdsourcing site (e.g. workerId, assignmentId, HITId, etc. from MTurk)
     participant_passed_hearing_test: bool, optional
         Participant passed hearing test at time of trial
+
+    Note
+    ----
+    The composite indexes back the condition assignment queries in `caqe.experiment`, i.e. counting the completed
+    trials of a condition and checking whether a participant has already completed a condition. The index of
+    `datetime_completed` backs the incremental exports of `analysis.py`.
     """
+    __table_args__ = (db.Index('ix_trial_condition_id_passed', 'condition_id', 'participant_passed_hearing_test'),
+                      db.Index('ix_trial_participant_id_condition_id', 'participant_id', 'condition_id'))
+
     id = db.Column(db.Integer, primary_key=True)
     participant_id = db.Column(db.Integer, db.ForeignKey('participant.id'))
     condition_id = db.Column(db.Integer, db.ForeignKey('condition.id'))
     crowd_data = db.Column(db.Text)
     data = db.Column(db.Text)
     participant_passed_hearing_test = db.Column(db.Boolean)
-    datetime_completed = db.Column(db.DateTime)
+    datetime_completed = db.Column(db.DateTime, index=True)
 
     def __init__(self, participant_id, condition_id, data, crowd_data=None, participant_passed_hearing_test=None):
         self.participant_id = participant_id
@@ -221,3 +328,78 @@ class Trial(db.Model):
                 self.condition_id,
                 self.participant_passed_hearing_test,
                 self.datetime_completed)
+
+
+class Bonus(db.Model):
+    """
+    An entry of the bonus ledger, i.e. a bonus that is owed to a crowd worker for an assignment. The bonuses are computed
+    and recorded first, and then granted (see `caqe.turk_admin`), so that an interrupted payout can be resumed without
+    paying any bonus twice.
+
+    Attributes
+    ----------
+    id : int
+        Primary key
+    kind : str
+        The kind of bonus, e.g. 'consistency' or 'first_trial'
+    trial_id : int
+        Foreign key to the Trial the bonus is for. For bonuses of several trials (e.g. of an assignment), the first of
+        them.
+    participant_id : int
+        Foreign key to the Participant receiving the bonus
+    worker_id : str
+        The crowdsourcing site ID of the worker, e.g. Amazon MTurk's workerId
+    assignment_id : str
+        The crowdsourcing site ID of the assignment, e.g. Amazon MTurk's assignmentId
+    amount : float
+        The bonus amount in dollars
+    reason : str
+        The message to send the worker with the bonus
+    request_token : str
+        Unique token of the grant request, so that a retried request does not grant the bonus again
+    status : str
+        'pending', 'paid', or 'failed'
+    attempts : int
+        The number of payouts that attempted to grant the bonus
+    error : str, optional
+        The error of the last failed attempt
+    datetime_created : DateTime
+    datetime_paid : DateTime, optional
+    """
+    __table_args__ = (db.UniqueConstraint('kind', 'trial_id', name='uq_bonus_kind_trial_id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    trial_id = db.Column(db.Integer, db.ForeignKey('trial.id'))
+    participant_id = db.Column(db.Integer, db.ForeignKey('participant.id'), index=True)
+    worker_id = db.Column(db.String(256))
+    assignment_id = db.Column(db.String(256))
+    amount = db.Column(db.Float, nullable=False)
+    reason = db.Column(db.Text)
+    request_token = db.Column(db.String(64), unique=True)
+    status = db.Column(db.String(16), default='pending', nullable=False, index=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    error = db.Column(db.Text)
+    datetime_created = db.Column(db.DateTime)
+    datetime_paid = db.Column(db.DateTime)
+
+    def __init__(self, kind, trial_id, participant_id, worker_id, assignment_id, amount, reason, request_token=None):
+        self.kind = kind
+        self.trial_id = trial_id
+        self.participant_id = participant_id
+        self.worker_id = worker_id
+        self.assignment_id = assignment_id
+        self.amount = amount
+        self.reason = reason
+        self.request_token = request_token if request_token is not None else uuid.uuid4().hex
+        self.status = 'pending'
+        self.attempts = 0
+        self.datetime_created = datetime.datetime.now()
+
+    def __repr__(self):
+        return "<Bonus id=%r, kind=%r, trial_id=%r, worker_id=%r, amount=%r, status=%r>" % (self.id,
+                                                                                           self.kind,
+                                                                                           self.trial_id,
+                                                                                           self.worker_id,
+                                                                                           self.amount,
+                                                                                           self.status)
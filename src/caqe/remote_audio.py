@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Proxy for audio stimuli on an external file host (see `EXTERNAL_FILE_HOST`). Requests are passed through to the file
+host (including their byte ranges) over pooled connections, and fetched files are kept in a size-bounded,
+least-recently-used cache on local disk. The last use of a cached file is tracked by its access time, so that its
+modification time, from which the ETag and Last-Modified validators of its responses are built, never changes. Files are fetched into the cache by a fixed number of background threads per
+process (see `EXTERNAL_FILE_FETCH_THREADS`).
+"""
+import os
+import time
+import uuid
+import errno
+import calendar
+import hashlib
+import Queue
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import Response
+from werkzeug.http import parse_date
+
+from caqe import app
+
+logger = logging.getLogger(__name__)
+
+# The size of the chunks in which files are streamed from the file host
+CHUNK_SIZE = 64 * 1024
+
+# Upstream response headers that are passed through to the client
+PASSTHROUGH_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified')
+
+# Connections to the file host are pooled and reused by all requests of the process
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+# The maximum number of URLs waiting to be fetched into the cache by this process. Further URLs are not queued, since
+# they are fetched the next time they are requested.
+FETCH_QUEUE_SIZE = 256
+
+# The URLs that are currently queued or being fetched into the cache by this process, and the threads fetching them
+_fetching_urls = set()
+_fetching_lock = threading.Lock()
+_fetch_queue = Queue.Queue(FETCH_QUEUE_SIZE)
+_fetch_threads = []
+
+
+def get_cache_path(url):
+    """
+    Get the path of the cached copy of `url` (whether or not it exists).
+
+    Parameters
+    ----------
+    url : str or unicode
+
+    Returns
+    -------
+    path : str
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    extension = os.path.splitext(url)[1]
+    return os.path.join(app.config['EXTERNAL_FILE_CACHE_DIRECTORY'], hashlib.sha1(url).hexdigest() + extension)
+
+
+def get_cached_file(url):
+    """
+    Get the path of the cached copy of `url` and mark it as recently used.
+
+    Parameters
+    ----------
+    url : str
+
+    Returns
+    -------
+    path : str
+        None if the cache is disabled or `url` is not cached.
+    """
+    if app.config['EXTERNAL_FILE_CACHE_DIRECTORY'] is None:
+        return None
+
+    path = get_cache_path(url)
+    try:
+        # the access time is the last use time of the LRU eviction, and the modification time is kept
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        return None
+    return path
+
+
+def proxy_file(url, headers=None):
+    """
+    Stream `url` from the file host, passing through the request's Range and If-Range headers.
+
+    Parameters
+    ----------
+    url : str
+    headers : dict, optional
+        The headers of the client's request
+
+    Returns
+    -------
+    flask.Response
+    """
+    upstream_headers = {'Accept-Encoding': 'identity'}
+    if headers is not None:
+        for name in ('Range', 'If-Range'):
+            if headers.get(name, None) is not None:
+                upstream_headers[name] = headers[name]
+
+    upstream = _session.get(url, headers=upstream_headers, stream=True, timeout=app.config['EXTERNAL_FILE_TIMEOUT_SEC'])
+    rv = Response(_iter_upstream(upstream), upstream.status_code, direct_passthrough=True)
+    for name in PASSTHROUGH_HEADERS:
+        if name in upstream.headers:
+            rv.headers[name] = upstream.headers[name]
+    return rv
+
+
+def _iter_upstream(upstream):
+    try:
+        for chunk in upstream.raw.stream(CHUNK_SIZE, decode_content=False):
+            yield chunk
+    finally:
+        upstream.close()
+
+
+def fetch_file_in_background(url):
+    """
+    Queue `url` to be fetched into the cache by the background threads of this process, unless it is already queued
+    or being fetched, or the queue is full (see `FETCH_QUEUE_SIZE`).
+
+    Parameters
+    ----------
+    url : str
+
+    Returns
+    -------
+    None
+    """
+    with _fetching_lock:
+        if url in _fetching_urls:
+            return
+        # start the threads on first use, so that they are started in the worker process, not in a preloading parent
+        while len(_fetch_threads) < app.config['EXTERNAL_FILE_FETCH_THREADS']:
+            thread = threading.Thread(target=_fetch_files)
+            thread.daemon = True
+            thread.start()
+            _fetch_threads.append(thread)
+        try:
+            _fetch_queue.put_nowait(url)
+        except Queue.Full:
+            logger.info('Not caching %s - the fetch queue is full' % url)
+            return
+        _fetching_urls.add(url)
+
+
+def _fetch_files():
+    while True:
+        url = _fetch_queue.get()
+        try:
+            fetch_file(url)
+        except Exception as e:
+            logger.warning('Error fetching %s into the cache - %r' % (url, e))
+        finally:
+            with _fetching_lock:
+                _fetching_urls.discard(url)
+            _fetch_queue.task_done()
+
+
+def fetch_file(url):
+    """
+    Download `url` into the cache and evict the least recently used files if the cache exceeds
+    `EXTERNAL_FILE_CACHE_MAX_BYTES`.
+
+    Parameters
+    ----------
+    url : str
+
+    Returns
+    -------
+    path : str
+        The path of the cached file
+    """
+    cache_directory = app.config['EXTERNAL_FILE_CACHE_DIRECTORY']
+    try:
+        os.makedirs(cache_directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    path = get_cache_path(url)
+    # download to a temporary file and rename it, so that other processes never see a partial file
+    temp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    upstream = _session.get(url, stream=True, timeout=app.config['EXTERNAL_FILE_TIMEOUT_SEC'])
+    try:
+        upstream.raise_for_status()
+        with open(temp_path, 'wb') as f:
+            for chunk in upstream.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+        # keep the file host's modification time, so that the cached copies of all processes have the same validators
+        last_modified = parse_date(upstream.headers.get('Last-Modified', None))
+        if last_modified is not None:
+            os.utime(temp_path, (time.time(), calendar.timegm(last_modified.utctimetuple())))
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        upstream.close()
+
+    logger.info('Cached %s as %s' % (url, path))
+    evict_files(cache_directory, app.config['EXTERNAL_FILE_CACHE_MAX_BYTES'])
+    return path
+
+
+def evict_files(cache_directory, max_bytes):
+    """
+    Remove the least recently used files (by access time, see `get_cached_file`) from `cache_directory` until its size
+    is at most `max_bytes`.
+
+    Parameters
+    ----------
+    cache_directory : str
+    max_bytes : int
+
+    Returns
+    -------
+    None
+    """
+    files = []
+    for filename in os.listdir(cache_directory):
+        if filename.endswith('.tmp'):
+            continue
+        path = os.path.join(cache_directory, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # removed by another process
+            continue
+        files.append((stat.st_atime, stat.st_size, path))
+
+    total_bytes = sum([size for _, size, _ in files])
+    for _, size, path in sorted(files):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            logger.info('Evicted %s from the cache' % path)
+        except OSError:
+            pass
+        total_bytes -= size
@@ -4,17 +4,33 @@
 Amazon Mechanical Turk administration. Use this module to post, approve, expire, and bonus HITs.
 """
 import json
+import math
 import datetime
+import httplib
+import os
+import uuid
+import itertools
+import random
+import socket
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
-from boto.mturk.connection import MTurkConnection, MTurkRequestError
+from sqlalchemy import cast, func
+from sqlalchemy.dialects import postgresql
+from boto.mturk.connection import MTurkConnection, MTurkRequestError, HIT
 from boto.mturk.qualification import Qualifications, NumberHitsApprovedRequirement, \
     PercentAssignmentsApprovedRequirement
 from boto.mturk.price import Price
 from boto.mturk.question import ExternalQuestion
 
+import caqe.experiment as experiment
 import caqe.models as models
 from caqe import app
+from caqe import db
 
 try:
     from secret_keys import AWS_ACCESS_KEY_ID, AWS_SECRET_KEY
@@ -24,6 +40,55 @@ except ImportError:
     raise ImportError('In order to run Amazon Mechanical Turk administration tasks, you must provide your credentials '
                       'in `secret_keys.py`.')
 
+# The number of threads that fetch HITs and assignments concurrently
+FETCH_WORKERS = 8
+
+# The page size of MTurk search requests (the maximum allowed by MTurk)
+PAGE_SIZE = 100
+
+# Request the assignment counts of HITs, so that HITs whose assignments did not change can be skipped
+HIT_RESPONSE_GROUPS = ['Minimal', 'HITDetail', 'HITAssignmentSummary']
+
+# HITs are created by this many threads, at most `CREATE_HITS_RATE` per second on average (in bursts of up to
+# `CREATE_HITS_BURST`), to stay below the MTurk request rate limit
+CREATE_HITS_WORKERS = 8
+CREATE_HITS_RATE = 5.
+CREATE_HITS_BURST = 10
+
+# The autoscaler (see `TurkAdmin.autoscale`) adjusts the HITs at this interval
+AUTOSCALE_INTERVAL_SEC = 300
+
+# The kinds of bonuses in the bonus ledger (see `caqe.models.Bonus`)
+BONUS_CONSISTENCY = 'consistency'
+BONUS_FIRST_TRIAL = 'first_trial'
+
+# The number of threads that grant bonuses concurrently
+BONUS_WORKERS = 8
+
+# Bonuses are no longer granted after this many failed payouts
+MAX_BONUS_ATTEMPTS = 3
+
+# Retrying throttled and failed MTurk requests (see `_call_with_backoff`)
+MAX_REQUEST_ATTEMPTS = 6
+BACKOFF_BASE_SEC = 1.
+BACKOFF_MAX_SEC = 30.
+
+# The statuses of the bonuses in the bonus ledger
+BONUS_PENDING = 'pending'
+BONUS_PAID = 'paid'
+BONUS_FAILED = 'failed'
+
+# The state of the study and of its HITs observed by the autoscaler (see `TurkAdmin.get_autoscale_status`)
+AutoscaleStatus = namedtuple('AutoscaleStatus', ['remaining_trials', 'needed_assignments', 'available_assignments',
+                                                 'pending_assignments', 'in_flight_assignments', 'completed_trials',
+                                                 'assignable_hits'])
+
+# The trials of an assignment of a participant
+AssignmentTrials = namedtuple('AssignmentTrials', ['participant_id', 'worker_id', 'assignment_id', 'trial_ids'])
+
+# Each thread that sends MTurk requests has its own connection
+_thread_local = threading.local()
+
 
 def turk_connect():
     """
@@ -36,42 +101,800 @@ def turk_connect():
     """
     return MTurkConnection(aws_access_key_id=AWS_ACCESS_KEY_ID,
                            aws_secret_access_key=AWS_SECRET_KEY,
-                           host=app.config['MTURK_HOST'])
+                           host=app.config['MTURK_HOST'],
+                           port=app.config['MTURK_PORT'],
+                           is_secure=app.config['MTURK_IS_SECURE'])
 
 
-def calculate_tsr(ratings, stimuli=('S1', 'S2', 'S3', 'S4', 'S5', 'S6', 'S7', 'S8')):
+def calculate_tsr(ratings, stimuli=None):
     """
-    Calculate the Transitivity Satisfaction Rate (TSR) for a group of ratings.
+    Calculate the Transitivity Satisfaction Rate (TSR) for a group of ratings, i.e. the fraction of the preference
+    chains i > j > k (of distinct stimuli) for which i > k also holds.
 
     Parameters
     ----------
     ratings : dict
         Ratings dictionary
-    stimuli : tuple of str
-        Tuple of stimulus identifiers in order.
+    stimuli : tuple of str, optional
+        Tuple of stimulus identifiers in order. Default is all the stimuli of the ratings, in sorted order.
 
     Returns
     -------
     float
-        The TSR.
+        The TSR. NaN if there are no preference chains.
+    n_pass : int
+        The number of transitive preference chains
+    n_test : int
+        The number of preference chains
+    m : np.ndarray
+        The preference matrix, where m[i, j] is 1 if stimulus i was preferred over stimulus j
     """
+    tsr, n_pass, n_test, m = calculate_tsr_batch([ratings], stimuli)
+    return tsr[0], n_pass[0], n_test[0], m[0].astype(float)
+
+
+def calculate_tsr_batch(ratings_list, stimuli=None):
+    """
+    Calculate the Transitivity Satisfaction Rate (TSR) of each group of ratings in `ratings_list` at once (see
+    `calculate_tsr`).
+
+    The preference chains are counted with matrix products of the boolean preference matrices: (m m)[i, k] is the
+    number of stimuli j with i > j > k, so the number of chains is the sum of m m off its diagonal, and the number of
+    transitive chains is the sum of (m m) * m.
+
+    Parameters
+    ----------
+    ratings_list : list of dict
+        Ratings dictionaries
+    stimuli : tuple of str, optional
+        Tuple of stimulus identifiers in order. Default is all the stimuli of the ratings, in sorted order.
+
+    Returns
+    -------
+    tsr : np.ndarray
+        The TSR of each group of ratings. NaN if there are no preference chains.
+    n_pass : np.ndarray
+    n_test : np.ndarray
+    m : np.ndarray
+        The boolean preference matrices, indexed by group, preferred stimulus, and other stimulus
+    """
+    if stimuli is None:
+        # the TSR does not depend on the order of the stimuli, nor on stimuli that were not rated
+        stimuli = sorted(set([stimulus for ratings in ratings_list for r in ratings.values()
+                              for stimulus in r['stimuli'][:2]]))
+    stimulus_indexes = dict([(stimulus, i) for i, stimulus in enumerate(stimuli)])
     n = len(stimuli)
-    m = np.zeros([n, n])
-    for k, r in ratings.items():
-        m[stimuli.index(r['stimuli'][0]), stimuli.index(r['stimuli'][1])] = r['selection'] == 'A'
-        m[stimuli.index(r['stimuli'][1]), stimuli.index(r['stimuli'][0])] = not (r['selection'] == 'A')
-    n_test = 0
-    n_pass = 0
-    for i in range(0, n - 1):
-        for j in range(0, n - 1):
-            for k in range(0, n - 1):
-                if i == j or j == k:
-                    continue
-                if m[i, j] == 1 and m[j, k] == 1:
-                    n_test += 1
-                    if m[i, k] == 1:
-                        n_pass += 1
-    return float(n_pass) / n_test, n_pass, n_test, m
+
+    # the matrix entries of each rating, in rating order so that later ratings of a pair overwrite earlier ones
+    entries = []
+    for t, ratings in enumerate(ratings_list):
+        for r in ratings.values():
+            try:
+                a = stimulus_indexes[r['stimuli'][0]]
+                b = stimulus_indexes[r['stimuli'][1]]
+            except KeyError as e:
+                raise ValueError('%s is not in stimuli' % e)
+            selected_a = r['selection'] == 'A'
+            entries.append((t, a, b, selected_a))
+            entries.append((t, b, a, not selected_a))
+
+    m = np.zeros([len(ratings_list), n, n], dtype=bool)
+    if len(entries) > 0:
+        t, i, j, preferred = np.array(entries, dtype=int).T
+        m[t, i, j] = preferred
+    m[:, np.arange(n), np.arange(n)] = False
+
+    m_int = m.astype(np.int64)
+    chains = np.einsum('tij,tjk->tik', m_int, m_int)
+    n_test = chains.sum(axis=(1, 2)) - np.trace(chains, axis1=1, axis2=2)
+    n_pass = (chains * m_int).sum(axis=(1, 2))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tsr = np.where(n_test > 0, n_pass / n_test.astype(float), np.nan)
+    return tsr, n_pass, n_test, m
+
+
+def calculate_assignment_tsrs(participant_id=None, stimuli=None):
+    """
+    Calculate the Transitivity Satisfaction Rate (TSR) of the pairwise comparisons of each assignment in the database,
+    or of each assignment of a participant, at once. The comparisons of an assignment are those of all its trials
+    (see `get_comparisons`).
+
+    Parameters
+    ----------
+    participant_id : int, optional
+        Only calculate the TSRs of the assignments of this participant
+    stimuli : tuple of str, optional
+        Tuple of stimulus identifiers in order. Default is all the stimuli of the ratings, in sorted order.
+
+    Returns
+    -------
+    assignments : list of AssignmentTrials
+        The assignments, in the order of their first trial
+    tsr : np.ndarray
+        The TSR of each assignment. NaN if there are no preference chains.
+    """
+    query = db.session.query(models.Trial.id,
+                             models.Trial.participant_id,
+                             models.Trial.crowd_data,
+                             models.Trial.data,
+                             models.Participant.crowd_worker_id). \
+        join(models.Participant, models.Trial.participant_id == models.Participant.id). \
+        order_by(models.Trial.id)
+    if participant_id is not None:
+        query = query.filter(models.Trial.participant_id == participant_id)
+
+    assignments = []
+    ratings_list = []
+    assignment_indexes = {}
+    for trial_id, trial_participant_id, crowd_data, data, worker_id in query.yield_per(1000):
+        assignment_id = get_assignment_id(crowd_data)
+        key = (trial_participant_id, assignment_id)
+        if assignment_id is None or key not in assignment_indexes:
+            # trials without an assignment are scored on their own
+            assignment_indexes[key] = len(assignments)
+            assignments.append(AssignmentTrials(trial_participant_id, worker_id, assignment_id, []))
+            ratings_list.append({})
+        i = assignment_indexes[key]
+        assignments[i].trial_ids.append(trial_id)
+        for k, comparison in get_comparisons(json.loads(data)['ratings']).items():
+            ratings_list[i]['%d_%s' % (trial_id, k)] = comparison
+
+    return assignments, calculate_tsr_batch(ratings_list, stimuli)[0]
+
+
+def get_comparisons(ratings):
+    """
+    Get the pairwise comparisons of the ratings of a trial in the format of `calculate_tsr`.
+
+    Parameters
+    ----------
+    ratings : dict
+        The ratings of a trial. Either the ratings of a pairwise trial, i.e. {stimulus_a: 1, stimulus_b: 0} if
+        stimulus_a was preferred, or comparisons in the format of `calculate_tsr`, which are returned as is.
+
+    Returns
+    -------
+    comparisons : dict
+        Comparisons with the 'stimuli' and the 'selection' ('A' or 'B'), keyed by a comparison key
+    """
+    if all([isinstance(v, dict) for v in ratings.values()]):
+        return ratings
+    if len(ratings) != 2:
+        return {}
+    stimulus_a, stimulus_b = sorted(ratings.keys())
+    return {'%s_%s' % (stimulus_a, stimulus_b): {'stimuli': [stimulus_a, stimulus_b],
+                                                 'selection': 'A' if int(ratings[stimulus_a]) == 1 else 'B'}}
+
+
+def get_assignment_id(crowd_data):
+    """
+    Get the assignment ID from the crowd data of a trial.
+
+    Parameters
+    ----------
+    crowd_data : str
+        JSON-encoded crowd data
+
+    Returns
+    -------
+    assignment_id : str
+        None if the trial has no valid assignment ID (e.g. it was previewed or submitted outside of MTurk)
+    """
+    try:
+        assignment_id = json.loads(crowd_data)['assignment_id']
+    except (TypeError, ValueError, KeyError):
+        return None
+    if assignment_id is None or assignment_id == 'ASSIGNMENT_ID_NOT_AVAILABLE':
+        return None
+    return assignment_id
+
+
+def compute_consistency_bonuses(max_price, threshold, reason, already_bonused_ids=(), persist=True):
+    """
+    Compute the consistency bonuses of all the assignments that have not been bonused yet (see
+    `TurkAdmin.give_consistency_bonus`), and record them in the ledger. The consistencies of all assignments are
+    calculated in one batch (see `calculate_assignment_tsrs`). Each bonus is recorded under the first trial of its
+    assignment, and an assignment is skipped if any of its trials is already in the ledger or in `already_bonused_ids`.
+
+    Parameters
+    ----------
+    max_price : float
+        The maximum bonus amount in dollars
+    threshold : float
+        Consistency must exceed this value before a bonus is paid out
+    reason : str
+        The message to send the workers when they receive the bonus
+    already_bonused_ids : set, optional
+        Set of trial ids that have already been bonused outside of the ledger (e.g. per trial, as consistency bonuses
+        used to be paid). The assignments with any of these trials are not bonused again.
+    persist : bool, optional
+        Record the bonuses in the ledger. Default is True.
+
+    Returns
+    -------
+    bonuses : list of caqe.models.Bonus
+        The new bonuses
+    trials_wo_valid_asgnmts : list of int
+        The ids of the trials that would receive a bonus, but do not have a valid assignment ID
+    """
+    assignments, tsr = calculate_assignment_tsrs()
+    consistency = np.nan_to_num(tsr)
+    prices = np.round(np.abs(((consistency - threshold) / (1.0 - threshold)) * max_price * (consistency > threshold)), 2)
+
+    ledger_trial_ids = set([trial_id for trial_id, in db.session.query(models.Bonus.trial_id).
+                           filter(models.Bonus.kind == BONUS_CONSISTENCY)])
+    bonuses = []
+    trials_wo_valid_asgnmts = []
+    for assignment, price in zip(assignments, prices):
+        if price <= 0.0 or any([trial_id in ledger_trial_ids or trial_id in already_bonused_ids
+                                for trial_id in assignment.trial_ids]):
+            continue
+        if assignment.assignment_id is None:
+            trials_wo_valid_asgnmts.extend(assignment.trial_ids)
+            continue
+        bonuses.append(models.Bonus(BONUS_CONSISTENCY,
+                                    assignment.trial_ids[0],
+                                    assignment.participant_id,
+                                    assignment.worker_id,
+                                    assignment.assignment_id,
+                                    float(price),
+                                    reason))
+
+    if persist:
+        db.session.add_all(bonuses)
+        db.session.commit()
+    return bonuses, trials_wo_valid_asgnmts
+
+
+def _assignment_id_expression():
+    """
+    SQL expression of the assignment ID in the crowd data of a trial, extracted by the database.
+
+    Returns
+    -------
+    sqlalchemy.sql.ColumnElement
+        None if the database cannot extract values from JSON
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return func.json_extract_path_text(cast(models.Trial.crowd_data, postgresql.JSON), 'assignment_id')
+    elif dialect == 'sqlite' and sqlite3.sqlite_version_info >= (3, 38):
+        # the JSON functions are built into SQLite since 3.38
+        return func.json_extract(models.Trial.crowd_data, '$.assignment_id')
+    return None
+
+
+def get_first_trials_with_assignments():
+    """
+    Get the first trial with a valid assignment ID of each participant (see `get_assignment_id`) in one query. If
+    the database can extract values from JSON, only these trials are read, otherwise all trials are read and the
+    assignment IDs are extracted from their crowd data.
+
+    Returns
+    -------
+    first_trials : list of tuple
+        The trial id, participant id, worker id, and assignment id of the first trial of each participant, ordered by
+        participant id
+    participant_ids_wo_valid_asgnmts : list of int
+        The ids of the participants with trials, but without a valid assignment ID in any of them
+    """
+    assignment_id = _assignment_id_expression()
+    if assignment_id is not None:
+        first_trial = func.row_number().over(partition_by=models.Trial.participant_id,
+                                             order_by=models.Trial.id).label('first_trial')
+        trials = db.session.query(models.Trial.id.label('trial_id'),
+                                  models.Trial.participant_id.label('participant_id'),
+                                  assignment_id.label('assignment_id'),
+                                  first_trial). \
+            filter(assignment_id != None). \
+            filter(assignment_id != 'ASSIGNMENT_ID_NOT_AVAILABLE').subquery()
+        query = db.session.query(trials.c.trial_id,
+                                 trials.c.participant_id,
+                                 models.Participant.crowd_worker_id,
+                                 trials.c.assignment_id). \
+            join(models.Participant, trials.c.participant_id == models.Participant.id). \
+            filter(trials.c.first_trial == 1). \
+            order_by(trials.c.participant_id)
+        first_trials = [tuple(row) for row in query]
+    else:
+        query = db.session.query(models.Trial.id,
+                                 models.Trial.participant_id,
+                                 models.Participant.crowd_worker_id,
+                                 models.Trial.crowd_data). \
+            join(models.Participant, models.Trial.participant_id == models.Participant.id). \
+            order_by(models.Trial.participant_id, models.Trial.id)
+        first_trials = []
+        for trial_id, participant_id, worker_id, crowd_data in query.yield_per(1000):
+            if len(first_trials) > 0 and first_trials[-1][1] == participant_id:
+                continue
+            trial_assignment_id = get_assignment_id(crowd_data)
+            if trial_assignment_id is not None:
+                first_trials.append((trial_id, participant_id, worker_id, trial_assignment_id))
+
+    participant_ids = set([participant_id for participant_id, in
+                           db.session.query(models.Trial.participant_id).distinct()])
+    participant_ids.difference_update([t[1] for t in first_trials])
+    return first_trials, sorted(participant_ids)
+
+
+def compute_first_trial_bonuses(price, reason, persist=True):
+    """
+    Compute the first trial bonuses of all the participants that are not in the bonus ledger yet (see
+    `TurkAdmin.give_bonus_to_all_first_completed_trials`), and record them in the ledger.
+
+    Parameters
+    ----------
+    price : float
+        The bonus amount in dollars
+    reason : str
+        The message to send the workers when they receive the bonus
+    persist : bool, optional
+        Record the bonuses in the ledger. Default is True.
+
+    Returns
+    -------
+    bonuses : list of caqe.models.Bonus
+        The new bonuses
+    participant_ids_wo_valid_asgnmts : list of int
+        The ids of the participants that do not have a valid assignment ID in any of their trials
+    """
+    first_trials, participant_ids_wo_valid_asgnmts = get_first_trials_with_assignments()
+    ledger_participant_ids = set([participant_id for participant_id, in
+                                  db.session.query(models.Bonus.participant_id).
+                                 filter(models.Bonus.kind == BONUS_FIRST_TRIAL)])
+    bonuses = [models.Bonus(BONUS_FIRST_TRIAL, trial_id, participant_id, worker_id, assignment_id, price, reason)
+               for trial_id, participant_id, worker_id, assignment_id in first_trials
+               if participant_id not in ledger_participant_ids]
+    if persist:
+        db.session.add_all(bonuses)
+        db.session.commit()
+    return bonuses, [p for p in participant_ids_wo_valid_asgnmts if p not in ledger_participant_ids]
+
+
+def _get_thread_connection():
+    """
+    Get the MTurk connection of the current thread. Connections are not shared between threads.
+
+    Returns
+    -------
+    boto.MTurkConnection
+    """
+    connection = getattr(_thread_local, 'connection', None)
+    if connection is None:
+        connection = turk_connect()
+        _thread_local.connection = connection
+    return connection
+
+
+def _is_retryable(e):
+    """
+    Check whether a failed MTurk request may succeed when it is retried, i.e. it was throttled or failed due to a
+    server or network error.
+
+    Parameters
+    ----------
+    e : Exception
+
+    Returns
+    -------
+    bool
+    """
+    if isinstance(e, MTurkRequestError):
+        body = e.body or ''
+        return e.status >= 500 or 'Throttl' in body or 'ServiceUnavailable' in body
+    return isinstance(e, (socket.error, httplib.HTTPException))
+
+
+def _call_with_backoff(func, *args, **kwargs):
+    """
+    Call `func`, retrying with exponential backoff (and jitter) while it fails with a retryable error (see
+    `_is_retryable`), up to `MAX_REQUEST_ATTEMPTS` times.
+
+    Parameters
+    ----------
+    func : function
+    args, kwargs
+        The arguments of `func`
+
+    Returns
+    -------
+    The return value of `func`
+    """
+    for attempt in itertools.count(1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= MAX_REQUEST_ATTEMPTS or not _is_retryable(e):
+                raise
+            delay = min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** (attempt - 1))
+            time.sleep(delay * (0.5 + random.random() / 2))
+
+
+def _grant_bonus(bonus):
+    """
+    Grant a bonus of the ledger with the connection of the current thread.
+
+    Parameters
+    ----------
+    bonus : tuple
+        The id, worker id, assignment id, amount, reason, and request token of the bonus
+
+    Returns
+    -------
+    bonus_id : int
+    error : str
+        None if the bonus was granted
+    """
+    bonus_id, worker_id, assignment_id, amount, reason, request_token = bonus
+    # `MTurkConnection.grant_bonus` does not support the request token, which makes retries idempotent
+    params = Price(amount).get_as_params('BonusAmount', 1)
+    params['WorkerId'] = worker_id
+    params['AssignmentId'] = assignment_id
+    params['Reason'] = reason
+    params['UniqueRequestToken'] = request_token
+    try:
+        _call_with_backoff(_get_thread_connection()._process_request, 'GrantBonus', params)
+    except MTurkRequestError as e:
+        if 'DuplicateRequest' in (e.body or ''):
+            # granted by an earlier attempt whose response was lost
+            return bonus_id, None
+        return bonus_id, str(e)
+    except Exception as e:
+        return bonus_id, repr(e)
+    return bonus_id, None
+
+
+def iter_pages(func, *args, **kwargs):
+    """
+    Iterate over the items of all the pages of a paginated MTurk request, e.g. `MTurkConnection.get_assignments`.
+    Pages are requested on demand, and the iteration stops at the first page that is not full.
+
+    Parameters
+    ----------
+    func : function
+        The request. Must accept the `page_size` and `page_number` keyword arguments.
+    args, kwargs
+        The other arguments of `func`
+
+    Returns
+    -------
+    generator
+    """
+    for page_number in itertools.count(1):
+        page = _call_with_backoff(func, *args, page_size=PAGE_SIZE, page_number=page_number, **kwargs)
+        for item in page:
+            yield item
+        if len(page) < PAGE_SIZE:
+            break
+
+
+def iter_hit_assignments(hit_id, status=None, connection=None):
+    """
+    Iterate over the assignments of a HIT, page by page.
+
+    Parameters
+    ----------
+    hit_id : str
+    status : str, optional
+        Only get the assignments with this status ('Submitted', 'Approved', or 'Rejected')
+    connection : boto.MTurkConnection, optional
+        Default is the connection of the current thread.
+
+    Returns
+    -------
+    generator of boto.Assignment
+    """
+    if connection is None:
+        connection = _get_thread_connection()
+    return iter_pages(connection.get_assignments, hit_id, status=status)
+
+
+def _fetch_hits_page(page_number):
+    """
+    Get a page of all HITs, including their assignment counts, with the connection of the current thread.
+    """
+    return _call_with_backoff(_get_thread_connection().search_hits,
+                              page_size=PAGE_SIZE,
+                              page_number=page_number,
+                              response_groups=HIT_RESPONSE_GROUPS)
+
+
+def _fetch_hit_assignments(args):
+    """
+    Get all the assignments of a HIT with the connection of the current thread.
+
+    Parameters
+    ----------
+    args : tuple
+        The HIT and the assignment status, if any
+
+    Returns
+    -------
+    hit : boto.HIT
+    assignments : list of boto.Assignment
+    """
+    hit, status = args
+    return hit, list(iter_hit_assignments(hit.HITId, status))
+
+
+def _approve_assignment(assignment_id):
+    """
+    Approve an assignment with the connection of the current thread.
+
+    Returns
+    -------
+    assignment_id : str
+    error : str
+        None if the assignment was approved
+    """
+    try:
+        _call_with_backoff(_get_thread_connection().approve_assignment, assignment_id, 'Thank you!')
+    except Exception as e:
+        return assignment_id, str(e)
+    return assignment_id, None
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket rate limiter. Tokens are added at `rate` per second, up to `capacity` tokens, and each
+    request takes one token, waiting for it if necessary. A request that has to wait reserves the next token (the
+    bucket goes into debt), so waiting requests get their tokens in turn and do not hold the lock while they wait.
+
+    Parameters
+    ----------
+    rate : float
+        The average number of requests per second
+    capacity : int, optional
+        The maximum number of requests in a burst. Default is `rate` (at least 1).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1., self.rate))
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1.
+            wait = -self._tokens / self.rate
+        if wait > 0.:
+            time.sleep(wait)
+
+
+def _rate_limited(bucket, func, *args, **kwargs):
+    """
+    Call `func` once a token is available in `bucket`.
+    """
+    bucket.acquire()
+    return func(*args, **kwargs)
+
+
+def _create_hit(args):
+    """
+    Create a HIT with the connection of the current thread, retrying with backoff if it is throttled (see
+    `_call_with_backoff`).
+
+    Parameters
+    ----------
+    args : tuple
+        The index of the HIT in its batch, the parameters of the CreateHIT request, and the `TokenBucket` that limits
+        the request rate
+
+    Returns
+    -------
+    index : int
+    hit_id : str
+        None if the HIT was not created
+    error : str
+        None if the HIT was created
+    """
+    index, params, bucket = args
+    # `MTurkConnection.create_hit` does not support the request token, which makes retries idempotent
+    try:
+        hits = _call_with_backoff(_rate_limited, bucket, _get_thread_connection()._process_request, 'CreateHIT',
+                                  dict(params), [('HIT', HIT)])
+    except MTurkRequestError as e:
+        if 'DuplicateRequest' in (e.body or ''):
+            # created by an earlier attempt whose response was lost
+            return index, None, None
+        return index, None, str(e)
+    except Exception as e:
+        return index, None, repr(e)
+    return index, hits[0].HITId, None
+
+
+def read_create_hits_journal(path):
+    """
+    Read the progress journal of `TurkAdmin.create_hits`. The journal is a JSON-lines file with a header line for each
+    batch of HITs, followed by a line for each HIT of the batch that was created.
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    batch : dict
+        The header of the last batch, i.e. its 'batch' id, 'num_hits', and the parameters of its CreateHIT requests.
+        None if the journal does not exist or is empty.
+    created : dict
+        The HITId of each created HIT of the last batch, keyed by its index in the batch. The HITId is None if the HIT
+        was created by a request whose response was lost.
+    """
+    batch = None
+    created = {}
+    if not os.path.exists(path):
+        return batch, created
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line may be incomplete if we were interrupted while writing it
+                continue
+            if 'index' not in record:
+                batch = record
+                created = {}
+            elif batch is not None and record['batch'] == batch['batch']:
+                created[record['index']] = record['hit_id']
+    return batch, created
+
+
+def _open_journal(path):
+    """
+    Open a journal file for appending. An incomplete last line (if we were interrupted while writing it) is terminated,
+    so that the next record is not appended to it.
+    """
+    f = open(path, 'a+')
+    f.seek(0, os.SEEK_END)
+    if f.tell() > 0:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != '\n':
+            f.seek(0, os.SEEK_END)
+            f.write('\n')
+    return f
+
+
+def _append_to_journal(f, record):
+    """
+    Append a record to a journal file, and make sure it is on disk before moving on.
+    """
+    f.write(json.dumps(record) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class MTurkMirror(object):
+    """
+    A local SQLite mirror of the state of the HITs and assignments on MTurk (see `TurkAdmin.refresh_mirror`), which can
+    be queried without paging through MTurk.
+
+    Parameters
+    ----------
+    path : str, optional
+        The path of the SQLite database. Default is defined by the CAQE configuration.
+    """
+    HIT_FIELDS = ('HITId', 'HITTypeId', 'HITStatus', 'CreationTime', 'Expiration', 'MaxAssignments',
+                  'NumberOfAssignmentsPending', 'NumberOfAssignmentsAvailable', 'NumberOfAssignmentsCompleted')
+    SUMMARY_FIELDS = ('HITStatus', 'NumberOfAssignmentsPending', 'NumberOfAssignmentsAvailable',
+                      'NumberOfAssignmentsCompleted')
+    ASSIGNMENT_FIELDS = ('AssignmentId', 'HITId', 'WorkerId', 'AssignmentStatus', 'AcceptTime', 'SubmitTime')
+
+    def __init__(self, path=None):
+        if path is None:
+            path = app.config['MTURK_MIRROR_DATABASE']
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hits (%s, PRIMARY KEY (HITId))' %
+                                ', '.join(self.HIT_FIELDS))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS assignments (%s, PRIMARY KEY (AssignmentId))' %
+                                ', '.join(self.ASSIGNMENT_FIELDS))
+        self.connection.execute('CREATE INDEX IF NOT EXISTS ix_assignments_HITId ON assignments (HITId)')
+        self.connection.commit()
+
+    @staticmethod
+    def hit_summary(hit):
+        """
+        Get the fields of a HIT that change whenever its assignments change. An assignment being accepted, returned,
+        submitted, approved, or rejected changes the assignment counts.
+
+        Parameters
+        ----------
+        hit : boto.HIT
+
+        Returns
+        -------
+        tuple of str
+        """
+        return tuple([str(getattr(hit, f, None)) for f in MTurkMirror.SUMMARY_FIELDS])
+
+    def get_hit_summaries(self):
+        """
+        Returns
+        -------
+        summaries : dict
+            The summary (see `hit_summary`) of each mirrored HIT, keyed by HITId
+        """
+        rows = self.connection.execute('SELECT HITId, %s FROM hits' % ', '.join(self.SUMMARY_FIELDS))
+        return dict([(row[0], tuple([str(v) for v in row[1:]])) for row in rows])
+
+    def update_hit(self, hit, assignments=None):
+        """
+        Write the state of a HIT and, optionally, of its assignments.
+
+        Parameters
+        ----------
+        hit : boto.HIT
+        assignments : list of boto.Assignment, optional
+        """
+        self.connection.execute('INSERT OR REPLACE INTO hits VALUES (%s)' % ', '.join(['?'] * len(self.HIT_FIELDS)),
+                                [getattr(hit, f, None) for f in self.HIT_FIELDS])
+        if assignments is not None:
+            self.connection.executemany('INSERT OR REPLACE INTO assignments VALUES (%s)' %
+                                        ', '.join(['?'] * len(self.ASSIGNMENT_FIELDS)),
+                                        [[getattr(a, f, None) for f in self.ASSIGNMENT_FIELDS] for a in assignments])
+
+    def mark_hits_disposed(self, hit_ids):
+        """
+        Mark HITs that are no longer listed on MTurk as disposed.
+
+        Parameters
+        ----------
+        hit_ids : list of str
+        """
+        self.connection.executemany("UPDATE hits SET HITStatus = 'Disposed' WHERE HITId = ?",
+                                    [(hit_id,) for hit_id in hit_ids])
+
+    def commit(self):
+        self.connection.commit()
+
+    def get_assignments(self, status=None, hit_types=None):
+        """
+        Get the mirrored assignments.
+
+        Parameters
+        ----------
+        status : str, optional
+            Only get the assignments with this status
+        hit_types : list of str, optional
+            Only get the assignments of HITs of these types
+
+        Returns
+        -------
+        assignments : list of dict
+        """
+        query = 'SELECT %s FROM assignments JOIN hits USING (HITId) WHERE 1 = 1' % \
+                ', '.join(['assignments.%s' % f for f in self.ASSIGNMENT_FIELDS])
+        params = []
+        if status is not None:
+            query += ' AND AssignmentStatus = ?'
+            params.append(status)
+        if hit_types is not None:
+            query += ' AND HITTypeId IN (%s)' % ', '.join(['?'] * len(hit_types))
+            params.extend(hit_types)
+        return [dict(zip(self.ASSIGNMENT_FIELDS, row)) for row in self.connection.execute(query, params)]
+
+    def count_assignments(self):
+        """
+        Returns
+        -------
+        counts : dict
+            The number of mirrored assignments with each status
+        """
+        return dict(self.connection.execute('SELECT AssignmentStatus, COUNT(*) FROM assignments '
+                                            'GROUP BY AssignmentStatus'))
+
+    def close(self):
+        self.connection.close()
 
 
 def confirm_reference():
@@ -86,37 +909,247 @@ class TurkAdmin(object):
     def __init__(self, debug=False):
         self.connection = turk_connect()
         self._hit_type_id = None
+        self._hit_types = {}
         self.debug = debug
         print app.config['MTURK_HOST']
 
         self.all_hit_types = [self.hit_type_id, ]
 
-    def create_hits(self, num_hits, configuration=None, hit_type_id=None):
+    def create_hits(self, num_hits, configuration=None, hit_type_id=None, journal=None, rate=CREATE_HITS_RATE,
+                    n_workers=CREATE_HITS_WORKERS):
         """
-        Create `num_audio_hits` according to the parameters specified in `hit_params`
+        Create `num_hits` according to the parameters specified in `configuration`. The HITs are created concurrently,
+        limited to `rate` requests per second, and throttled requests are retried with exponential backoff.
+
+        Each created HIT is recorded in the progress journal (see `read_create_hits_journal`), and each HIT request
+        carries a unique request token, so if some HITs could not be created (or creating them was interrupted),
+        calling this again resumes the unfinished batch without creating any HIT twice.
 
         Parameters
         ----------
         num_hits: int
         configuration: dict
         hit_type_id: int, optional
+        journal : str, optional
+            The path of the progress journal. Default is defined by the CAQE configuration.
+        rate : float, optional
+            The maximum average number of HIT requests per second
+        n_workers : int, optional
+            The number of concurrent HIT requests
 
         Returns
         -------
-        None
+        hit_ids : list of str
+            The ids of the HITs created by this call
         """
         if configuration is None:
             configuration = app.config
+        if journal is None:
+            journal = configuration['MTURK_CREATE_HITS_JOURNAL']
+
+        batch, created = read_create_hits_journal(journal)
+        if batch is not None and len(created) < batch['num_hits']:
+            if batch['num_hits'] != num_hits:
+                raise Exception('The journal `%s` has an unfinished batch of %d HITs (%d created). Finish it by '
+                                'creating %d HITs, or use another journal.' %
+                                (journal, batch['num_hits'], len(created), batch['num_hits']))
+            print 'Resuming batch %s: %d of %d HITs were already created.' % (batch['batch'], len(created), num_hits)
+            new_batch = False
+        else:
+            if hit_type_id is None:
+                hit_type_id = self.hit_type_id
+            question = ExternalQuestion(configuration['MTURK_QUESTION_URL'],
+                                        frame_height=configuration['MTURK_FRAME_HEIGHT'])
+            batch = {'batch': uuid.uuid4().hex,
+                     'num_hits': num_hits,
+                     'datetime_created': datetime.datetime.now().isoformat(),
+                     'params': {'HITTypeId': hit_type_id,
+                                'Question': question.get_as_xml(),
+                                'LifetimeInSeconds': configuration['MTURK_LIFETIME_IN_SECONDS'],
+                                'MaxAssignments': configuration['MTURK_MAX_ASSIGNMENTS']}}
+            created = {}
+            new_batch = True
+
+        bucket = TokenBucket(rate, CREATE_HITS_BURST)
+        requests = []
+        for i in range(batch['num_hits']):
+            if i not in created:
+                params = dict(batch['params'])
+                params['UniqueRequestToken'] = '%s-%d' % (batch['batch'], i)
+                requests.append((i, params, bucket))
+        if len(requests) == 0:
+            return []
+
+        hit_ids = []
+        n_failed = 0
+        pool = ThreadPool(min(n_workers, len(requests)))
+        with _open_journal(journal) as f:
+            if new_batch:
+                _append_to_journal(f, batch)
+            try:
+                for index, hit_id, error in pool.imap_unordered(_create_hit, requests):
+                    if error is None:
+                        _append_to_journal(f, {'batch': batch['batch'], 'index': index, 'hit_id': hit_id})
+                        if hit_id is not None:
+                            hit_ids.append(hit_id)
+                    else:
+                        n_failed += 1
+                        print 'HIT %d of batch %s could not be created: %s' % (index, batch['batch'], error)
+            finally:
+                pool.close()
+                pool.join()
+        if n_failed > 0:
+            print '%d HITs could not be created. Create %d HITs again to resume the batch.' % (n_failed, num_hits)
+        return hit_ids
+
+    def get_autoscale_status(self, hit_types=None, n_workers=FETCH_WORKERS):
+        """
+        Get the remaining demand of the study and the assignments in flight on MTurk.
 
-        if hit_type_id is None:
-            hit_type_id = self.hit_type_id
-        question = ExternalQuestion(configuration['MTURK_QUESTION_URL'],
-                                    frame_height=configuration['MTURK_FRAME_HEIGHT'])
-        for _i in range(num_hits):
-            self.connection.create_hit(hit_type=hit_type_id,
-                                       question=question,
-                                       lifetime=configuration['MTURK_LIFETIME_IN_SECONDS'],
-                                       max_assignments=configuration['MTURK_MAX_ASSIGNMENTS'], )
+        Each assignment is an evaluation of `CONDITIONS_PER_EVALUATION` conditions, and only the trials of
+        participants that pass the hearing test count towards the `TRIALS_PER_CONDITION` of a condition, so the
+        assignments needed to fill the remaining trials are scaled by the observed hearing test pass rate. The trials of
+        participants holding reservations are not part of the remaining trials (see `experiment.get_rating_demand`), so
+        the accepted assignments with reservations are not counted as in flight either.
+
+        Parameters
+        ----------
+        hit_types : list of str, optional
+        n_workers : int, optional
+            The number of concurrent requests
+
+        Returns
+        -------
+        status : AutoscaleStatus
+        """
+        if hit_types is None:
+            hit_types = self.all_hit_types
+        demand = experiment.get_rating_demand()
+        completed_trials = demand.passed_trials + demand.failed_trials
+        pass_rate = float(demand.passed_trials) / completed_trials if demand.passed_trials > 0 else 1.
+        conditions_per_evaluation = app.config['CONDITIONS_PER_EVALUATION']
+        needed_assignments = int(math.ceil(demand.remaining_trials / float(conditions_per_evaluation) / pass_rate))
+
+        hits = self.filter_hits(self.get_all_hits(n_workers), hit_types)
+        assignable_hits = [hit for hit in hits if hit.HITStatus == 'Assignable']
+        available_assignments = sum([int(hit.NumberOfAssignmentsAvailable) for hit in assignable_hits])
+        pending_assignments = sum([int(hit.NumberOfAssignmentsPending) for hit in hits])
+        reserved_assignments = int(math.ceil(demand.active_reservations / float(conditions_per_evaluation)))
+        in_flight_assignments = available_assignments + max(0, pending_assignments - reserved_assignments)
+
+        return AutoscaleStatus(demand.remaining_trials,
+                               needed_assignments,
+                               available_assignments,
+                               pending_assignments,
+                               in_flight_assignments,
+                               completed_trials,
+                               assignable_hits)
+
+    def autoscale(self, interval=AUTOSCALE_INTERVAL_SEC, max_iterations=None, hit_types=None, journal=None):
+        """
+        Keep just enough assignments in flight to complete the study, until it is complete. Every `interval` seconds,
+        the remaining demand is compared with the assignments in flight (see `get_autoscale_status`):
+
+        * If there are too few, HITs with the missing assignments are created (see `create_hits`).
+        * If there are too many, the newest HITs whose available assignments are not needed are expired, so that
+          workers do not accept HITs for which there are no more conditions.
+
+        All needed assignments are posted at once, so that as many workers as possible can work in parallel.
+
+        Parameters
+        ----------
+        interval : float, optional
+            The number of seconds between adjustments
+        max_iterations : int, optional
+            Stop after this many adjustments, even if the study is not complete
+        hit_types : list of str, optional
+        journal : str, optional
+            The path of the progress journal of `create_hits`. Default is defined by the CAQE configuration.
+
+        Returns
+        -------
+        None
+        """
+        if journal is None:
+            journal = app.config['MTURK_CREATE_HITS_JOURNAL']
+        last_completed_trials = None
+        last_time = None
+        for iteration in itertools.count(1):
+            status = self.get_autoscale_status(hit_types)
+            now = time.time()
+            if last_time is not None:
+                completion_rate = (status.completed_trials - last_completed_trials) / ((now - last_time) / 3600.)
+                eta = ' ETA %.1f h.' % (status.remaining_trials / completion_rate) if completion_rate > 0 else ''
+                print '%.1f trials/h.%s' % (completion_rate, eta),
+            last_completed_trials, last_time = status.completed_trials, now
+            print '%d trials remaining: %d assignments needed, %d in flight (%d available, %d pending).' % \
+                  (status.remaining_trials, status.needed_assignments, status.in_flight_assignments,
+                   status.available_assignments, status.pending_assignments)
+
+            batch, created = read_create_hits_journal(journal)
+            surplus = status.in_flight_assignments - status.needed_assignments
+            if batch is not None and len(created) < batch['num_hits']:
+                # finish the interrupted batch before deciding on new HITs
+                self.create_hits(batch['num_hits'], journal=journal)
+            elif surplus < 0:
+                self.top_up_hits(-surplus, journal)
+            elif surplus > 0:
+                self.expire_surplus_hits(status.assignable_hits, surplus)
+
+            if status.remaining_trials == 0 and len(status.assignable_hits) == 0:
+                print 'The study is complete.'
+                break
+            if max_iterations is not None and iteration >= max_iterations:
+                break
+            time.sleep(interval)
+
+    def top_up_hits(self, num_assignments, journal=None):
+        """
+        Create HITs with `num_assignments` assignments in total, spread evenly over as few HITs as the
+        `MTURK_MAX_ASSIGNMENTS` per HIT allow.
+
+        Parameters
+        ----------
+        num_assignments : int
+        journal : str, optional
+            The path of the progress journal of `create_hits`
+
+        Returns
+        -------
+        hit_ids : list of str
+        """
+        num_hits = int(math.ceil(num_assignments / float(app.config['MTURK_MAX_ASSIGNMENTS'])))
+        configuration = dict(app.config)
+        configuration['MTURK_MAX_ASSIGNMENTS'] = int(math.ceil(num_assignments / float(num_hits)))
+        print 'Creating %d HITs with %d assignments each.' % (num_hits, configuration['MTURK_MAX_ASSIGNMENTS'])
+        return self.create_hits(num_hits, configuration, journal=journal)
+
+    def expire_surplus_hits(self, hits, num_assignments):
+        """
+        Expire the newest of `hits` whose available assignments add up to at most `num_assignments`, i.e. the HITs
+        that are not needed anymore. Accepted assignments of expired HITs can still be submitted.
+
+        Parameters
+        ----------
+        hits : list of boto.HIT
+        num_assignments : int
+            The number of available assignments that are not needed
+
+        Returns
+        -------
+        hit_ids : list of str
+            The expired HITs
+        """
+        hit_ids = []
+        for hit in sorted(hits, key=lambda h: h.CreationTime, reverse=True):
+            available_assignments = int(hit.NumberOfAssignmentsAvailable)
+            if 0 < available_assignments <= num_assignments:
+                _call_with_backoff(self.connection.expire_hit, hit.HITId)
+                num_assignments -= available_assignments
+                hit_ids.append(hit.HITId)
+        if len(hit_ids) > 0:
+            print 'Expired %d HITs.' % len(hit_ids)
+        return hit_ids
 
     def register_hit(self, configuration=None):
         """
@@ -265,26 +1298,135 @@ class TurkAdmin(object):
             assignments.extend(self.connection.get_assignments(hit.HITId, page_size=page_size, page_number=page_number))
         return assignments
 
-    def get_all_assignments(self):
+    def get_all_hits(self, n_workers=FETCH_WORKERS):
+        """
+        Get all HITs, including their assignment counts. The pages after the first are fetched concurrently. The HIT
+        type of each HIT is cached (see `get_hit_type`).
+
+        Parameters
+        ----------
+        n_workers : int, optional
+            The number of concurrent requests
+
+        Returns
+        -------
+        hits : list of boto.HIT
+        """
+        first_page = _call_with_backoff(self.connection.search_hits,
+                                        page_size=PAGE_SIZE,
+                                        response_groups=HIT_RESPONSE_GROUPS)
+        hits = list(first_page)
+        n_pages = (int(first_page.TotalNumResults) + PAGE_SIZE - 1) // PAGE_SIZE
+        if n_pages > 1:
+            pool = ThreadPool(min(n_workers, n_pages - 1))
+            try:
+                for page in pool.imap(_fetch_hits_page, range(2, n_pages + 1)):
+                    hits.extend(page)
+            finally:
+                pool.close()
+                pool.join()
+        for hit in hits:
+            self._hit_types[hit.HITId] = hit.HITTypeId
+        return hits
+
+    def get_hit_type(self, hit_id):
+        """
+        Get the HITTypeId of a HIT. HIT types never change, so each HIT is only looked up once.
+
+        Parameters
+        ----------
+        hit_id : str
+
+        Returns
+        -------
+        str
+        """
+        if hit_id not in self._hit_types:
+            self._hit_types[hit_id] = _call_with_backoff(self.connection.get_hit, hit_id)[0].HITTypeId
+        return self._hit_types[hit_id]
+
+    def iter_assignments(self, hits=None, status=None, n_workers=FETCH_WORKERS):
+        """
+        Iterate over the assignments of `hits`, fetching the assignments of `n_workers` HITs concurrently.
+
+        Parameters
+        ----------
+        hits : list of boto.HIT, optional
+            Default is all HITs.
+        status : str, optional
+            Only get the assignments with this status ('Submitted', 'Approved', or 'Rejected')
+        n_workers : int, optional
+            The number of concurrent requests
+
+        Returns
+        -------
+        generator of (boto.HIT, list of boto.Assignment)
+            The assignments of each HIT, in the order in which they were fetched
+        """
+        if hits is None:
+            hits = self.get_all_hits(n_workers)
+        if len(hits) == 0:
+            return
+        pool = ThreadPool(min(n_workers, len(hits)))
+        try:
+            for hit, assignments in pool.imap_unordered(_fetch_hit_assignments, [(hit, status) for hit in hits]):
+                yield hit, assignments
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_all_assignments(self, status=None, n_workers=FETCH_WORKERS):
         """
         Get all assignments regardless of HIT type
 
+        Parameters
+        ----------
+        status : str, optional
+            Only get the assignments with this status ('Submitted', 'Approved', or 'Rejected')
+        n_workers : int, optional
+            The number of concurrent requests
+
         Returns
         -------
         assignments : list of boto.Assignment
         """
-        hits = self.connection.get_all_hits()
         assignments = []
-        for hit in hits:
-            page = 1
-            while True:
-                page_assignments = self.connection.get_assignments(hit.HITId, page_size=100, page_number=page)
-                assignments.extend(page_assignments)
-                page += 1
-                if len(page_assignments) == 0:
-                    break
+        for _hit, hit_assignments in self.iter_assignments(status=status, n_workers=n_workers):
+            assignments.extend(hit_assignments)
         return assignments
 
+    def refresh_mirror(self, mirror=None, n_workers=FETCH_WORKERS):
+        """
+        Refresh the local mirror of the HITs and assignments (see `MTurkMirror`). Only the assignments of the HITs
+        whose status or assignment counts changed since the last refresh are fetched.
+
+        Parameters
+        ----------
+        mirror : MTurkMirror, optional
+            Default is the mirror in the database defined by the CAQE configuration.
+        n_workers : int, optional
+            The number of concurrent requests
+
+        Returns
+        -------
+        n_hits : int
+            The number of HITs
+        n_refreshed : int
+            The number of HITs whose assignments were fetched
+        """
+        if mirror is None:
+            mirror = MTurkMirror()
+        summaries = mirror.get_hit_summaries()
+        hits = self.get_all_hits(n_workers)
+        changed_hits = [hit for hit in hits if summaries.get(hit.HITId) != mirror.hit_summary(hit)]
+        for hit, assignments in self.iter_assignments(changed_hits, n_workers=n_workers):
+            mirror.update_hit(hit, assignments)
+        hit_ids = set([hit.HITId for hit in hits])
+        mirror.mark_hits_disposed([hit_id for hit_id, summary in summaries.items()
+                                   if hit_id not in hit_ids and summary[0] != 'Disposed'])
+        mirror.commit()
+        return len(hits), len(changed_hits)
+
     def get_all_assignments_to_review(self, hit_type, status=('Submitted', 'Approved', 'Rejected')):
         """
         Get *all* the assignments to review for the specified HIT type
@@ -311,13 +1453,15 @@ class TurkAdmin(object):
                 break
         return assignments
 
-    def approve_all(self, hit_types=None):
+    def approve_all(self, hit_types=None, n_workers=FETCH_WORKERS):
         """
         Approve all 'Submitted' assignments
 
         Parameters
         ----------
         hit_types : list of str, optional
+        n_workers : int, optional
+            The number of concurrent requests
 
         Returns
         -------
@@ -325,25 +1469,78 @@ class TurkAdmin(object):
         """
         if hit_types is None:
             hit_types = self.all_hit_types
-        assignments = self.get_all_assignments()
-        for a in assignments:
-            if a.AssignmentStatus == 'Submitted':
-                hit = self.connection.get_hit(a.HITId)[0]
-                if hit.HITTypeId in hit_types:
-                    self.connection.approve_assignment(a.AssignmentId, 'Thank you!')
+        hits = self.filter_hits(self.get_all_hits(n_workers), hit_types)
+        assignments = self.get_submitted_assignments(hits, n_workers)
+        self.approve_assignments(assignments, n_workers)
 
-    def force_approve_all(self):
+    def force_approve_all(self, n_workers=FETCH_WORKERS):
         """
         Approve all 'Submitted' assignments
 
+        Parameters
+        ----------
+        n_workers : int, optional
+            The number of concurrent requests
+
         Returns
         -------
         None
         """
-        assignments = self.get_all_assignments()
-        for a in assignments:
-            if a.AssignmentStatus == 'Submitted':
-                self.connection.approve_assignment(a.AssignmentId, 'Thank you!')
+        assignments = self.get_submitted_assignments(self.get_all_hits(n_workers), n_workers)
+        self.approve_assignments(assignments, n_workers)
+
+    def get_submitted_assignments(self, hits, n_workers=FETCH_WORKERS):
+        """
+        Get the 'Submitted' assignments of `hits`. HITs without completed assignments are skipped.
+
+        Parameters
+        ----------
+        hits : list of boto.HIT
+        n_workers : int, optional
+            The number of concurrent requests
+
+        Returns
+        -------
+        assignments : list of boto.Assignment
+        """
+        # a HIT whose assignments are all still available has not been accepted, let alone submitted
+        hits = [hit for hit in hits
+                if getattr(hit, 'NumberOfAssignmentsAvailable', None) != getattr(hit, 'MaxAssignments', None)]
+        assignments = []
+        for _hit, hit_assignments in self.iter_assignments(hits, 'Submitted', n_workers):
+            assignments.extend(hit_assignments)
+        return assignments
+
+    @staticmethod
+    def approve_assignments(assignments, n_workers=FETCH_WORKERS):
+        """
+        Approve `assignments` concurrently.
+
+        Parameters
+        ----------
+        assignments : list of boto.Assignment
+        n_workers : int, optional
+            The number of concurrent requests
+
+        Returns
+        -------
+        n_approved : int
+        """
+        if len(assignments) == 0:
+            return 0
+        n_approved = 0
+        pool = ThreadPool(min(n_workers, len(assignments)))
+        try:
+            for assignment_id, error in pool.imap_unordered(_approve_assignment,
+                                                            [a.AssignmentId for a in assignments]):
+                if error is None:
+                    n_approved += 1
+                else:
+                    print 'Could not approve assignment %s: %s' % (assignment_id, error)
+        finally:
+            pool.close()
+            pool.join()
+        return n_approved
 
     def get_completion_times(self, assignments=None):
         """
@@ -375,63 +1572,48 @@ class TurkAdmin(object):
     def give_bonus_to_all_first_completed_trials(self,
                                                  price=app.config['MTURK_FIRST_HIT_BONUS'],
                                                  calculate_amt_only=False,
-                                                 reason=None,
-                                                 already_bonused_ids=set()):
+                                                 reason=None):
         """
         Grant bonuses for the first completed trial for each participant.
 
+        The first trial with a valid assignment of each participant is found in one query (see
+        `get_first_trials_with_assignments`), and the bonuses are recorded in the bonus ledger and then granted from the
+        ledger (see `pay_bonuses`). Participants already in the ledger are never bonused again, so running this again
+        after an interruption only grants the bonuses that have not been paid yet.
+
         Parameters
         ----------
         price : float, optional
             The bonus amount to grant in dollars. Default is defined by the CAQE configuration.
         calculate_amt_only : bool, optional
-            Only calculate the amount of the bonus, do not actual pay out the bonus.
+            Only calculate the amount of the new bonuses, do not record or pay out the bonuses.
         reason : str, optional
             The message to send the workers when they receive the bonus
-        already_bonused_ids : set, optional
-            Set of participant ids that have already been bonused
 
 
         Returns
         -------
         total_bonus: float
-            The total amount paid
+            The total amount paid (or of the new bonuses if `calculate_amt_only`)
         participants_wo_valid_asgnmts: list of caqe.models.Participant
             The participants who did not have valid assignments in their trial data (e.g. there must have been an error
-            when submitting the assignment)
+            when submitting the assignment), or whose bonus could not be granted
 
         """
         if reason is None:
             reason = "Thanks for completing our Critical Audio Listening Task HIT. This bonus is to compensate you " \
                      "for the extra time needed to complete the first assignment of the HIT."
 
-        total_bonus = 0
-        participants_wo_valid_asgnmts = []
-        participants = models.Participant.query.all()
-        for p in participants:
-            if p.id in already_bonused_ids:
-                continue
-            trials = p.trials.all()
-            if len(trials) > 0:
-                bonus_paid = False
-                for t in trials:
-                    try:
-                        print p.id
-                        crowd_data = json.loads(t.crowd_data)
-
-                        assignment_id = crowd_data['assignment_id']
-                        worker_id = p.crowd_worker_id
-                        if not calculate_amt_only:
-                            self.connection.grant_bonus(worker_id, assignment_id, Price(price), reason)
-                        total_bonus += price
-                        bonus_paid = True
-                        break
-                    except MTurkRequestError as e:
-                        print e
-                        continue
-                if not bonus_paid:
-                    participants_wo_valid_asgnmts.append(p)
-        return total_bonus, participants_wo_valid_asgnmts
+        bonuses, participant_ids = compute_first_trial_bonuses(price, reason, persist=not calculate_amt_only)
+        if calculate_amt_only:
+            total_bonus = sum([b.amount for b in bonuses])
+        else:
+            total_bonus, failed_bonuses = self.pay_bonuses(BONUS_FIRST_TRIAL)
+            participant_ids.extend([b.participant_id for b in failed_bonuses])
+
+        if len(participant_ids) == 0:
+            return total_bonus, []
+        return total_bonus, models.Participant.query.filter(models.Participant.id.in_(participant_ids)).all()
 
     def give_consistency_bonus(self,
                                max_price=app.config['MTURK_MAX_CONSISTENCY_BONUS'],
@@ -440,10 +1622,15 @@ class TurkAdmin(object):
                                reason=None,
                                already_bonused_ids=set()):
         """
-        Grant bonuses based on ratings consistency. Bonus calculated by
+        Grant bonuses based on the ratings consistency of each assignment, i.e. the transitivity satisfaction rate of
+        the pairwise comparisons of its trials (see `calculate_assignment_tsrs`). Bonus calculated by
 
         .. math:: ((consistency - threshold) / (1.0 - threshold)) * max\_price * (consistency > threshold))
 
+        The bonuses are first computed for all assignments at once and recorded in the bonus ledger (see
+        `compute_consistency_bonuses`), and then granted from the ledger (see `pay_bonuses`), so that running this again
+        after an interruption only grants the bonuses that have not been paid yet.
+
         Parameters
         ----------
         max_price : float, optional
@@ -451,45 +1638,94 @@ class TurkAdmin(object):
         threshold : bool
             Consistency must exceed this value before a bonus is paid out. Default is defined by the CAQE configuration.
         calculate_amt_only : bool, optional
-            Only calculate the amount of the bonus, do not actual pay out the bonus.
+            Only calculate the amount of the new bonuses, do not record or pay out the bonuses.
         reason : str, optional
             The message to send the workers when they receive the bonus
         already_bonused_ids : set, optional
-            Set of participant ids that have already been bonused
+            Set of trial ids that have already been bonused outside of the bonus ledger. The assignments with any of
+            these trials are not bonused again.
 
 
         Returns
         -------
         total_bonus : float
-            The total amount paid
-        participants_wo_valid_asgnmts : list of caqe.models.Participant
-            The participants who did not have valid assignments in their trial data (e.g. there must have been an error
-            when submitting the assignment)
+            The total amount paid (or of the new bonuses if `calculate_amt_only`)
+        trials_wo_valid_asgnmts : list of caqe.models.Trial
+            The trials who did not have valid assignments in their trial data (e.g. there must have been an error
+            when submitting the assignment), or whose bonus could not be granted
 
         """
         if reason is None:
             reason = "Thanks for completing our Critical Audio Listening Task HIT. This bonus is to award you for " \
                      "your consistency in ratings during the task."
-        total_bonus = 0
-        trials_wo_valid_asgnmts = []
-        trials = models.Trial.query.all()
-        for t in trials:
-            if t.id in already_bonused_ids:
-                continue
-            try:
-                crowd_data = json.loads(t.crowd_data)
-                data = json.loads(t.data)
-                assignment_id = crowd_data['assignment_id']
-                worker_id = t.participant.crowd_worker_id
-                consistency = calculate_tsr(data['rating'])[0]
-                price = round(
-                    abs(((consistency - threshold) / (1.0 - threshold)) * max_price * (consistency > threshold)), 2)
-                if not calculate_amt_only and price > 0.0:
-                    print price
-                    self.connection.grant_bonus(worker_id, assignment_id, Price(price), reason)
-                total_bonus += price
-            except MTurkRequestError as e:
-                print e
-                trials_wo_valid_asgnmts.append(t)
-        return total_bonus, trials_wo_valid_asgnmts
 
+        bonuses, trial_ids = compute_consistency_bonuses(max_price,
+                                                         threshold,
+                                                         reason,
+                                                         already_bonused_ids,
+                                                         persist=not calculate_amt_only)
+        if calculate_amt_only:
+            total_bonus = sum([b.amount for b in bonuses])
+        else:
+            total_bonus, failed_bonuses = self.pay_bonuses(BONUS_CONSISTENCY)
+            trial_ids.extend([b.trial_id for b in failed_bonuses])
+
+        if len(trial_ids) == 0:
+            return total_bonus, []
+        return total_bonus, models.Trial.query.filter(models.Trial.id.in_(trial_ids)).all()
+
+    def pay_bonuses(self, kind=None, n_workers=BONUS_WORKERS):
+        """
+        Grant the unpaid bonuses of the bonus ledger, concurrently with `n_workers` threads. Throttled requests are
+        retried with exponential backoff, and bonuses that fail are retried by later payouts, up to
+        `MAX_BONUS_ATTEMPTS` payouts. The ledger is updated as each grant completes, so an interrupted payout can be
+        resumed by calling this again.
+
+        Parameters
+        ----------
+        kind : str, optional
+            Only grant bonuses of this kind, e.g. `BONUS_CONSISTENCY`
+        n_workers : int, optional
+            The number of concurrent grant requests
+
+        Returns
+        -------
+        total_paid : float
+            The total amount granted by this payout
+        failed_bonuses : list of caqe.models.Bonus
+            The bonuses that could not be granted
+        """
+        query = models.Bonus.query.filter(models.Bonus.status != BONUS_PAID,
+                                          models.Bonus.attempts < MAX_BONUS_ATTEMPTS).order_by(models.Bonus.id)
+        if kind is not None:
+            query = query.filter(models.Bonus.kind == kind)
+        bonuses = dict([(b.id, b) for b in query])
+        if len(bonuses) == 0:
+            return 0., []
+
+        requests = [(b.id, b.worker_id, b.assignment_id, b.amount, b.reason, b.request_token)
+                    for b in bonuses.values()]
+        total_paid = 0.
+        failed_bonuses = []
+        pool = ThreadPool(min(n_workers, len(requests)))
+        try:
+            for i, (bonus_id, error) in enumerate(pool.imap_unordered(_grant_bonus, requests)):
+                bonus = bonuses[bonus_id]
+                bonus.attempts += 1
+                if error is None:
+                    bonus.status = BONUS_PAID
+                    bonus.error = None
+                    bonus.datetime_paid = datetime.datetime.now()
+                    total_paid += bonus.amount
+                else:
+                    bonus.status = BONUS_FAILED
+                    bonus.error = error
+                    failed_bonuses.append(bonus)
+                    print 'Bonus %d for worker %s failed: %s' % (bonus.id, bonus.worker_id, error)
+                db.session.commit()
+                if (i + 1) % 100 == 0:
+                    print 'Granted %d/%d bonuses' % (i + 1, len(requests))
+        finally:
+            pool.close()
+            pool.join()
+        return total_paid, failed_bonuses
@@ -5,12 +5,92 @@ Utility functions
 """
 import base64
 import json
+import threading
+from collections import OrderedDict
 
 from itsdangerous import URLSafeSerializer
 from Crypto.Cipher import AES
 
 from caqe import app
 
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded, least-recently-used cache with hit and miss counters.
+
+    Parameters
+    ----------
+    max_size : int
+        The maximum number of items. The least recently used items are evicted beyond this size.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """
+        Get the item of `key` and mark it as recently used.
+
+        Parameters
+        ----------
+        key : hashable
+        default : object, optional
+            Returned if there is no item of `key`. Default is None.
+
+        Returns
+        -------
+        object
+        """
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Set the item of `key`, evicting the least recently used item if the cache is full.
+
+        Parameters
+        ----------
+        key : hashable
+        value : object
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all items.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._items.clear()
+            self.invalidations += 1
+
+
 def sign_data(data):
     """
     Serialize and sign data (likely to be put in a session cookie).
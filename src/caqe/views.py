@@ -13,18 +13,22 @@ import functools
 import os
 import mimetypes
 import re
-import urllib2
-import io
+import mmap
+import uuid
 
 from flask import request, render_template, flash, redirect, session, make_response, \
-    safe_join, url_for, send_file, Response
+    safe_join, url_for, Response
+from werkzeug.http import http_date
+from werkzeug.wsgi import wrap_file
 
 import experiment
 
 from caqe import app
 from caqe import db
-from .models import Participant, Trial, Condition
+from .models import Participant, Trial, Condition, ConditionProgress
 import caqe.utilities as utilities
+import caqe.remote_audio as remote_audio
+import caqe.database as database
 import caqe.configuration as configuration
 
 logger = logging.getLogger(__name__)
@@ -32,94 +36,257 @@ logger = logging.getLogger(__name__)
 
 @app.after_request
 def after_request(response):
-    response.headers.add('Accept-Ranges', 'bytes')
+    response.headers.setdefault('Accept-Ranges', 'bytes')
     return response
 
 
-def send_file_partial(path):
+# The size of the chunks in which byte ranges are streamed
+AUDIO_CHUNK_SIZE = 64 * 1024
+
+
+def parse_byte_ranges(range_header, size):
     """
-    Simple wrapper around send_file which handles HTTP 206 Partial Content
-    (byte ranges)
+    Parse the byte ranges of an HTTP Range header (e.g. 'bytes=0-499', 'bytes=500-', 'bytes=-500', or
+    'bytes=0-0,-1').
 
     Parameters
     ----------
-    path : str
+    range_header : str
+    size : int
+        The size of the requested file in bytes
 
-    Notes
-    -----
-    This is code is from https://gist.github.com/lizhiwei/7885684
+    Returns
+    -------
+    ranges : list of tuple
+        The (first, last) byte positions (inclusive) of each satisfiable range, which is an empty list if none of the
+        ranges are satisfiable. None if the header is missing or malformed, in which case it should be ignored.
     """
-    range_header = request.headers.get('Range', None)
-    if not range_header: return send_file(path)
+    if not range_header or '=' not in range_header:
+        return None
 
-    size = os.path.getsize(path)
+    units, range_set = range_header.split('=', 1)
+    if units.strip().lower() != 'bytes':
+        return None
 
-    byte1, byte2 = 0, None
+    ranges = []
+    for byte_range in range_set.split(','):
+        m = re.match(r'^\s*(\d*)\s*-\s*(\d*)\s*$', byte_range)
+        if m is None or (m.group(1) == '' and m.group(2) == ''):
+            return None
 
-    m = re.search('(\d+)-(\d*)', range_header)
-    g = m.groups()
+        if m.group(1) == '':
+            # suffix range, i.e. the last N bytes
+            suffix_length = int(m.group(2))
+            if suffix_length == 0:
+                continue
+            first = max(size - suffix_length, 0)
+            last = size - 1
+        else:
+            first = int(m.group(1))
+            last = size - 1 if m.group(2) == '' else min(int(m.group(2)), size - 1)
+            if m.group(2) != '' and int(m.group(2)) < first:
+                return None
 
-    if g[0]:
-        byte1 = int(g[0])
-    if g[1]:
-        byte2 = int(g[1])
+        if first < size:
+            ranges.append((first, last))
 
-    length = size - byte1
-    if byte2 is not None:
-        length = byte2 - byte1
+    return ranges
 
-    data = None
 
+def _stream_byte_ranges(path, ranges, parts=None):
+    """
+    Stream the byte `ranges` of the file at `path` from a read-only memory map, which shares the pages of the file
+    between processes instead of copying it into each process.
+
+    Parameters
+    ----------
+    path : str
+    ranges : list of tuple
+        The (first, last) byte positions (inclusive) of each range
+    parts : list of tuple of str, optional
+        The (header, footer) of each range for a multipart response
+    """
     with open(path, 'rb') as f:
-        f.seek(byte1)
-        data = f.read(length)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for k, (first, last) in enumerate(ranges):
+                if parts is not None:
+                    yield parts[k][0]
+                for offset in xrange(first, last + 1, AUDIO_CHUNK_SIZE):
+                    yield mm[offset:min(offset + AUDIO_CHUNK_SIZE, last + 1)]
+                if parts is not None:
+                    yield parts[k][1]
+        finally:
+            mm.close()
+
+
+def send_file_partial(path, mimetype=None):
+    """
+    Send a file, handling HTTP 206 Partial Content (byte ranges), including suffix and multiple ranges, and `If-Range`
+    / `If-None-Match` conditional requests. Complete files are sent through the WSGI server's file wrapper (e.g.
+    sendfile), and byte ranges are streamed from a memory map, so the file is never read into memory as a whole.
 
-    rv = Response(data,
-                  206,
-                  mimetype=mimetypes.guess_type(path)[0],
-                  direct_passthrough=True)
-    rv.headers.add('Content-Range', 'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1, size))
+    Parameters
+    ----------
+    path : str
+    mimetype : str, optional
+        The mimetype of the file. If None, it is guessed from the file extension.
 
-    return rv
+    Returns
+    -------
+    flask.Response
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    last_modified = http_date(stat.st_mtime)
+    etag = '"%x-%x"' % (int(stat.st_mtime), size)
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0]
+
+    ranges = parse_byte_ranges(request.headers.get('Range', None), size)
+
+    # if the client's copy is not the current version of the file, ignore the range and send the complete file
+    if_range = request.headers.get('If-Range', None)
+    if ranges is not None and if_range is not None and if_range not in (etag, last_modified):
+        ranges = None
+
+    if ranges is None or size == 0:
+        rv = Response(wrap_file(request.environ, open(path, 'rb')),
+                      200,
+                      mimetype=mimetype,
+                      direct_passthrough=True)
+        rv.headers['Content-Length'] = size
+    elif len(ranges) == 0:
+        rv = Response('', 416)
+        rv.headers['Content-Range'] = 'bytes */%d' % size
+        return rv
+    elif len(ranges) == 1:
+        first, last = ranges[0]
+        rv = Response(_stream_byte_ranges(path, ranges),
+                      206,
+                      mimetype=mimetype,
+                      direct_passthrough=True)
+        rv.headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        rv.headers['Content-Length'] = last - first + 1
+    else:
+        boundary = uuid.uuid4().hex
+        parts = [('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+                  (boundary, mimetype, first, last, size), '\r\n') for first, last in ranges]
+        parts[-1] = (parts[-1][0], '\r\n--%s--\r\n' % boundary)
+        rv = Response(_stream_byte_ranges(path, ranges, parts),
+                      206,
+                      mimetype='multipart/byteranges; boundary=%s' % boundary,
+                      direct_passthrough=True)
+        rv.headers['Content-Length'] = sum([len(header) + (last - first + 1) + len(footer) for
+                                            (header, footer), (first, last) in zip(parts, ranges)])
+
+    rv.headers['Accept-Ranges'] = 'bytes'
+    rv.headers['ETag'] = etag
+    rv.headers['Last-Modified'] = last_modified
+    return rv.make_conditional(request)
+
+
+def send_external_file(url):
+    """
+    Send a file from the external file host. If the file is in the local cache, send it from there, otherwise proxy the
+    request to the file host (including its byte ranges) and fetch the file into the cache in the background.
+
+    Parameters
+    ----------
+    url : str
 
+    Returns
+    -------
+    flask.Response
+    """
+    cached_path = remote_audio.get_cached_file(url)
+    if cached_path is not None:
+        return send_file_partial(cached_path)
 
-def send_file_partial_hack(path):
+    if app.config['EXTERNAL_FILE_CACHE_DIRECTORY'] is not None:
+        remote_audio.fetch_file_in_background(url)
+    return remote_audio.proxy_file(url, request.headers)
 
-    range_header = request.headers.get('Range', None)
 
-    f = urllib2.urlopen(path)
+# The mimetypes of the compressed renditions of the audio stimuli (see `AUDIO_RENDITIONS`)
+AUDIO_RENDITION_MIMETYPES = {'flac': 'audio/flac',
+                             'mp3': 'audio/mpeg',
+                             'ogg': 'audio/ogg'}
 
-    size = int(f.info()['Content-Length'])
+# The rendition manifests read by this process, keyed by directory, with the modification time of the manifest file
+_rendition_manifests = {}
 
-    byte1, byte2 = 0, None
 
-    m = re.search('(\d+)-(\d*)', range_header)
-    g = m.groups()
+def get_audio_renditions(directory):
+    """
+    Get the rendition manifest of `directory` (see ``preprocess.py transcode``). The manifest is read again when its
+    file is modified.
 
-    if g[0]:
-        byte1 = int(g[0])
-    if g[1]:
-        byte2 = int(g[1])
+    Parameters
+    ----------
+    directory : str
 
-    length = size - byte1
-    if byte2 is not None:
-        length = byte2 - byte1
+    Returns
+    -------
+    manifest : dict
+        The rendition file paths keyed by codec, keyed by the path of each .wav file (relative to `directory`). Empty
+        if there is no manifest.
+    """
+    path = os.path.join(directory, app.config['AUDIO_RENDITION_MANIFEST'])
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return {}
+
+    cached = _rendition_manifests.get(directory, None)
+    if cached is None or cached[0] != mtime:
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.warning('Error reading the rendition manifest %s - %r' % (path, e))
+            manifest = {}
+        cached = (mtime, manifest)
+        _rendition_manifests[directory] = cached
+    return cached[1]
 
-    data = None
 
-    byte = io.BytesIO(f.read())
-    f.close()
-    byte.seek(byte1)
-    data = byte.read(length)
-    byte.close()
+def select_audio_rendition(directory, filename):
+    """
+    Select the rendition of `filename` (see `AUDIO_RENDITIONS`) that the client prefers. Only the renditions whose
+    mimetype the Accept header names explicitly are served: browsers request media with ``Accept: */*``, which does not
+    mean that they can play every codec.
 
-    rv = Response(data,
-                  206,
-                  mimetype=mimetypes.guess_type(path)[0],
-                  direct_passthrough=True)
+    Parameters
+    ----------
+    directory : str
+    filename : str
+        The path of the .wav file, relative to `directory`
 
-    rv.headers.add('Content-Range', 'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1, size))
-    return rv
+    Returns
+    -------
+    filename : str
+        The path of the rendition, relative to `directory`, which is `filename` itself if the client names none of
+        the renditions
+    mimetype : str
+        The mimetype of the rendition, or None if it is `filename` itself
+    """
+    renditions = get_audio_renditions(directory).get(filename, {})
+    candidates = [(codec, AUDIO_RENDITION_MIMETYPES[codec]) for codec in app.config['AUDIO_RENDITIONS']
+                  if codec in renditions]
+    if len(candidates) == 0:
+        return filename, None
+
+    qualities = dict([(value.lower(), quality) for value, quality in request.accept_mimetypes if '*' not in value])
+    best = None
+    for codec, mimetype in candidates:
+        # on equal quality, the rendition that comes first in `AUDIO_RENDITIONS` is preferred
+        quality = qualities.get(mimetype, 0)
+        if quality > 0 and (best is None or quality > best[0]):
+            best = (quality, codec, mimetype)
+    if best is None:
+        return filename, None
+    return renditions[best[1]], best[2]
 
 
 def nocache(view):
@@ -255,7 +422,7 @@ def audio(audio_file_key):
 
     if app.config['ENCRYPT_AUDIO_STIMULI_URLS']:
         try:
-            audio_file_dict = utilities.decrypt_data(str(audio_file_key))
+            audio_file_dict = experiment.decode_audio_key(audio_file_key)
 
             # can also assert that this file is for this specific participant and condition
             assert (audio_file_dict['p_id'] == session['participant_id'])
@@ -267,11 +434,15 @@ def audio(audio_file_key):
         filename = audio_file_key + file_format
 
     if app.config['EXTERNAL_FILE_HOST']:
-        # return send_file_partial(app.config['AUDIO_FILE_DIRECTORY']+filename)
-        return send_file_partial_hack(safe_join(app.config['AUDIO_FILE_DIRECTORY'], filename))
+        return send_external_file(safe_join(app.config['AUDIO_FILE_DIRECTORY'], filename))
 
     else:
-        return send_file_partial(safe_join(safe_join(app.root_path, app.config['AUDIO_FILE_DIRECTORY']), filename))
+        directory = safe_join(app.root_path, app.config['AUDIO_FILE_DIRECTORY'])
+        rendition_filename, mimetype = select_audio_rendition(directory, filename)
+        rv = send_file_partial(safe_join(directory, rendition_filename), mimetype)
+        if app.config['AUDIO_RENDITIONS']:
+            rv.vary.add('Accept')
+        return rv
 
 
 @app.route('/anonymous')
@@ -363,8 +534,7 @@ def begin(platform, crowd_worker_id):
                                                      'target="_blank">Chrome</a>.')
 
     # check conditions if conditions available for anyone
-    conditions = experiment.get_available_conditions()
-    if conditions.count() == 0:
+    if experiment.get_available_condition_count() == 0:
         return render_template('sorry.html', message='We\'re sorry, but there are no more tasks available.')
 
     # render preview if True
@@ -454,6 +624,28 @@ def create_participant(participant_type, crowd_worker_id):
     return pre_evaluation_tasks()
 
 
+def end_participation(participant, message):
+    """
+    Release the condition reservations of a participant that will not do the evaluation (e.g. they did not give
+    consent), so that their conditions are available to other participants right away, and display `message`.
+
+    Parameters
+    ----------
+    participant : caqe.models.Participant
+        None if the participant is unknown
+    message : str
+
+    Returns
+    -------
+    flask.Response
+    """
+    if participant is not None:
+        experiment.release_reservations(participant.id)
+        db.session.commit()
+        experiment.invalidate_availability_cache()
+    return render_template('sorry.html', message=message)
+
+
 def pre_evaluation_tasks():
     """
     Control overall flow of pre-evaluation tasks.
@@ -486,9 +678,8 @@ def pre_evaluation_tasks():
             return redirect(url_for('pre_test_survey', _external=True, scheme=app.config['PREFERRED_URL_SCHEME']))
         if not experiment.is_pre_test_survey_valid(json.loads(participant.pre_test_survey),
                                                    app.config['PRE_TEST_SURVEY_INCLUSION_CRITERIA']):
-            return render_template('sorry.html',
-                                   message='Unfortunately, you do not meet the inclusion criteria for this study. '
-                                           'Sorry.')
+            return end_participation(participant,
+                                     'Unfortunately, you do not meet the inclusion criteria for this study. Sorry.')
 
     session['state'] = 'EVALUATION'
     return redirect(url_for('evaluation', _external=True, _scheme=app.config['PREFERRED_URL_SCHEME']))
@@ -511,7 +702,8 @@ def consent():
             db.session.commit()
             return pre_evaluation_tasks()
         elif request.form['consent'] == 'disagree':
-            return render_template('sorry.html', message='Thank you for your interest in the study.')
+            return end_participation(get_current_participant(session, allow_none=True),
+                                     'Thank you for your interest in the study.')
         else:
             return render_template('consent.html')
     else:
@@ -535,9 +727,8 @@ def pre_test_survey():
         if experiment.is_pre_test_survey_valid(request.form, app.config['PRE_TEST_SURVEY_INCLUSION_CRITERIA']):
             return pre_evaluation_tasks()
         else:
-            return render_template('sorry.html',
-                                   message='Unfortunately, you do not meet the inclusion criteria for this study. '
-                                           'Sorry.')
+            return end_participation(participant,
+                                     'Unfortunately, you do not meet the inclusion criteria for this study. Sorry.')
     else:
         return render_template('pre_test_survey.html')
 
@@ -561,8 +752,8 @@ def hearing_test():
     if request.method == 'GET':
         if participant.hearing_test_attempts >= app.config['MAX_HEARING_TEST_ATTEMPTS']:
             logger.info('Max hearing test attempts reached - %r' % participant)
-            return render_template('sorry.html', message='Sorry. You have exceed the number of allowed attempts. '
-                                                         'Please try again tomorrow.')
+            return end_participation(participant, 'Sorry. You have exceed the number of allowed attempts. Please try '
+                                                  'again tomorrow.')
 
         while True:
             hearing_test_audio_index1 = random.randint(configuration.MIN_HEARING_TEST_AUDIO_INDEX,
@@ -641,11 +832,7 @@ def hearing_test_audio(example_num):
         file_num = hearing_test_audio_index % configuration.HEARING_TEST_AUDIO_FILES_PER_TONES
         logger.info('hearing_test %s - %d %d' % (example_num, num_tones, file_num))
         file_path = 'hearing_test_audio/tones%d_%d.wav' % (num_tones, file_num)
-    with open(file_path, 'rb') as f:
-        response = make_response(f.read())
-        response.headers['Content-Type'] = 'audio/wav'
-        response.headers['Accept-Ranges'] = 'bytes'
-    return response
+    return send_file_partial(file_path, 'audio/wav')
 
 
 @app.route('/evaluation', methods=['GET', 'POST'])
@@ -686,9 +873,13 @@ def evaluation():
                               json.dumps(crowd_data),
                               participant.passed_hearing_test)
                 db.session.add(trial)
+                experiment.record_trial_progress(condition_id, participant.passed_hearing_test)
                 logger.info('Results saved for %r' % trial)
 
+            # the trials now count towards the conditions, so the reservations are no longer needed
+            experiment.release_reservations(participant_id, [int(cd['conditionID']) for cd in condition_data])
             db.session.commit()
+            experiment.invalidate_availability_cache()
             session['state'] = 'POST_EVALUATION'
             return json.dumps({'error': False, 'message': 'Data is saved!', 'trial_id': utilities.sign_data(trial.id)})
         except Exception as e:
@@ -918,16 +1109,10 @@ def mturk_debug():
 @app.route('/admin/stats')
 @nocache
 def admin_stats():
-    trials = Trial.query.all()
-    conditions = Condition.query.all()
-    passed_hearing_condition_count = dict([(cond.id, 0) for cond in conditions])
-    failed_hearing_condition_count = dict([(cond.id, 0) for cond in conditions])
-
-    for trial in trials:
-        if trial.participant_passed_hearing_test:
-            passed_hearing_condition_count[trial.condition_id] += 1
-        else:
-            failed_hearing_condition_count[trial.condition_id] += 1
+    progress = db.session.query(Condition.id, ConditionProgress.passed_count, ConditionProgress.failed_count). \
+        outerjoin(ConditionProgress).all()
+    passed_hearing_condition_count = dict([(c_id, passed or 0) for c_id, passed, _ in progress])
+    failed_hearing_condition_count = dict([(c_id, failed or 0) for c_id, _, failed in progress])
 
     fieldnames = ['Condition', 'Completed Trials (passed hearing test)', 'Completed Trials (failed hearing test)']
     ids = sorted(passed_hearing_condition_count.keys())
@@ -941,6 +1126,58 @@ def admin_stats():
                            title=title)
 
 
+@app.route('/admin/cache_stats')
+@nocache
+def admin_cache_stats():
+    fieldnames = ['Cache', 'Hits', 'Misses', 'Invalidations']
+    rows = [{'Cache': 'Available conditions',
+             'Hits': experiment.availability_cache_stats['hits'],
+             'Misses': experiment.availability_cache_stats['misses'],
+             'Invalidations': experiment.availability_cache_stats['invalidations']},
+            {'Cache': 'Conditions',
+             'Hits': experiment.condition_cache_stats['hits'],
+             'Misses': experiment.condition_cache_stats['misses'],
+             'Invalidations': experiment.condition_cache_stats['invalidations']},
+            {'Cache': 'Encrypted audio URLs',
+             'Hits': experiment.encrypted_audio_url_cache.hits,
+             'Misses': experiment.encrypted_audio_url_cache.misses,
+             'Invalidations': experiment.encrypted_audio_url_cache.invalidations},
+            {'Cache': 'Decrypted audio URL keys',
+             'Hits': experiment.decrypted_audio_key_cache.hits,
+             'Misses': experiment.decrypted_audio_key_cache.misses,
+             'Invalidations': experiment.decrypted_audio_key_cache.invalidations}]
+    title = 'Cache Statistics (pid %d)' % os.getpid()
+    return render_template('table.html',
+                           fieldnames=fieldnames,
+                           rows=rows,
+                           title=title)
+
+
+@app.route('/admin/pool_stats')
+@nocache
+def admin_pool_stats():
+    status = database.get_pool_status(db.engine.pool)
+    stats = database.pool_stats
+    fieldnames = ['Statistic', 'Value']
+    rows = [{'Statistic': 'Pool', 'Value': db.engine.pool.__class__.__name__},
+            {'Statistic': 'Pool size', 'Value': status['size']},
+            {'Statistic': 'Checked out', 'Value': status['checked_out']},
+            {'Statistic': 'Checked in', 'Value': status['checked_in']},
+            {'Statistic': 'Overflow', 'Value': status['overflow']},
+            {'Statistic': 'Checkouts', 'Value': stats['checkouts']},
+            {'Statistic': 'Checkouts that waited', 'Value': stats['waits']},
+            {'Statistic': 'Mean wait (ms)',
+             'Value': '%.1f' % (1000. * stats['wait_time'] / stats['waits']) if stats['waits'] > 0 else 0},
+            {'Statistic': 'Max wait (ms)', 'Value': '%.1f' % (1000. * stats['max_wait_time'])},
+            {'Statistic': 'Timeouts', 'Value': stats['timeouts']},
+            {'Statistic': 'Disconnects', 'Value': stats['disconnects']}]
+    title = 'Database Pool Statistics (pid %d)' % os.getpid()
+    return render_template('table.html',
+                           fieldnames=fieldnames,
+                           rows=rows,
+                           title=title)
+
+
 @app.route('/bonus')
 @nocache
 def bonus():
@@ -8,13 +8,96 @@ To run: ::
 
     $ python create_db.py
 
+To add the tests and condition groups of the test configuration that are not in an existing database yet (without
+clearing it), run: ::
+
+    $ python create_db.py --incremental
+
+To rebuild the per-condition trial counts of an existing database (without clearing it), run: ::
+
+    $ python create_db.py --rebuild-condition-progress
+
+To upgrade the structure of a database that was created by an earlier version of CAQE (without clearing it), run: ::
+
+    $ python create_db.py --upgrade
+
+This creates the missing tables, adds the missing columns to the existing tables (currently only
+`test.config_snapshot_id`, which stays NULL for the existing tests), and creates the missing indexes of the existing
+tables. If the per-condition trial counts did not exist yet, they are built from the existing trials.
+`--incremental` and `--rebuild-condition-progress` run the same upgrade first.
+
 """
+import argparse
+
+from sqlalchemy import inspect
 
 from caqe import db
-db.drop_all()
-db.create_all()
 
 import caqe
 import caqe.experiment as experiment
-with caqe.app.app_context():
-    experiment.insert_tests_and_conditions()
\ No newline at end of file
+import caqe.models as models
+
+# The columns that were added to existing tables, as (table name, column name, column definition)
+ADDED_COLUMNS = [('test', 'config_snapshot_id', 'INTEGER REFERENCES config_snapshot (id)')]
+
+
+def upgrade_database():
+    """
+    Upgrade the structure of an existing database to the current models. Missing tables are created, missing columns
+    (see `ADDED_COLUMNS`) are added, and missing indexes of the existing tables are created. Existing rows are not
+    changed, but if the `ConditionProgress` table is new, it is filled from the existing trials (see
+    `caqe.experiment.rebuild_condition_progress`). Call this within the application context.
+
+    Returns
+    -------
+    None
+    """
+    inspector = inspect(db.engine)
+    existing_table_names = inspector.get_table_names()
+    db.create_all()
+    for table_name, column_name, column_definition in ADDED_COLUMNS:
+        if column_name not in [column['name'] for column in inspector.get_columns(table_name)]:
+            print('Adding column %s.%s' % (table_name, column_name))
+            db.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table_name, column_name, column_definition))
+    for table in db.metadata.sorted_tables:
+        index_names = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in index_names:
+                print('Creating index %s' % index.name)
+                index.create(db.engine)
+    if models.ConditionProgress.__tablename__ not in existing_table_names:
+        print('Building the per-condition trial counts')
+        experiment.rebuild_condition_progress()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create the CAQE database.')
+    parser.add_argument('--rebuild-condition-progress',
+                        action='store_true',
+                        help='Do not clear the database. Upgrade its structure (see --upgrade) and rebuild the '
+                             'per-condition trial counts from the existing trials.')
+    parser.add_argument('--upgrade',
+                        action='store_true',
+                        help='Do not clear the database. Create any missing tables, columns, and indexes.')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='Do not clear the database. Upgrade its structure (see --upgrade) and only insert the '
+                             'tests and condition groups that are not in the database yet.')
+    args = parser.parse_args()
+
+    if args.upgrade:
+        with caqe.app.app_context():
+            upgrade_database()
+    elif args.rebuild_condition_progress:
+        with caqe.app.app_context():
+            upgrade_database()
+            experiment.rebuild_condition_progress()
+    elif args.incremental:
+        with caqe.app.app_context():
+            upgrade_database()
+            experiment.insert_tests_and_conditions(incremental=True)
+    else:
+        db.drop_all()
+        db.create_all()
+        with caqe.app.app_context():
+            experiment.insert_tests_and_conditions()
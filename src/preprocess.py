@@ -11,16 +11,67 @@ Run on the command line, e.g.: ::
  ``pip install -r analysis_requirements.txt``.
 """
 import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import shutil
+import struct
+import subprocess
+import tempfile
+from collections import namedtuple
 
 import numpy as np
 import librosa
 
+# The ffmpeg encoder arguments and file extension of each compressed rendition codec
+RENDITION_CODECS = {'flac': (['-c:a', 'flac', '-compression_level', '8'], '.flac'),
+                    'mp3': (['-c:a', 'libmp3lame', '-b:a', '192k'], '.mp3'),
+                    'ogg': (['-c:a', 'libvorbis', '-q:a', '6'], '.ogg')}
 
-def rms_normalize(directory=None, file_list=None, suffix=None, target_rms=None):
+# The default name of the manifest that caches the statistics of the audio files in a directory (see `rms_normalize`)
+MANIFEST = '.caqe_manifest.json'
+
+# The number of samples per block of the block-wise WAV analysis and normalization
+BLOCK_SIZE = 2**18
+
+# The number of bytes of the blocks of frames that are transformed at once by `batch_stft` and `batch_istft`
+STFT_BLOCK_BYTES = 2**18
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# The sample dtype, bias, and scale (to [-1, 1]) of the supported WAV sample formats, keyed by format and bits/sample
+WAV_SAMPLE_FORMATS = {(WAVE_FORMAT_PCM, 8): ('u1', 128., 128.),
+                      (WAVE_FORMAT_PCM, 16): ('<i2', 0., 2.**15),
+                      (WAVE_FORMAT_PCM, 32): ('<i4', 0., 2.**31),
+                      (WAVE_FORMAT_IEEE_FLOAT, 32): ('<f4', 0., 1.),
+                      (WAVE_FORMAT_IEEE_FLOAT, 64): ('<f8', 0., 1.)}
+
+# The memory-mapped samples (frames x channels) of a WAV file, see `_open_wav`
+WavFile = namedtuple('WavFile', ['samples', 'sr', 'bias', 'scale'])
+
+# The default name of the rendition manifest (see `caqe.configuration.BaseConfig.AUDIO_RENDITION_MANIFEST`)
+RENDITION_MANIFEST = 'renditions.json'
+
+
+def rms_normalize(directory=None, file_list=None, suffix=None, target_rms=None, n_jobs=1, verbose=False,
+                  manifest_name=MANIFEST):
     """
     This utility performs rms normalization on a directory or list of files. Note files must be WAV files.
 
+    WAV files (8, 16, or 32 bit PCM or floating point) are analyzed and normalized block-wise in constant memory, so
+    stimuli of any length can be processed. Other files are decoded only once: if `target_rms` is given, each file is
+    normalized right after it is analyzed, and if it is `None`, the decoded samples are kept in a temporary directory
+    between the analysis of all the files and their normalization.
+
+    If `directory` is given, the statistics of the files (content hash, duration, sampling rate, RMS, and peak) are
+    cached in a manifest in `directory`, so that reruns only analyze new or changed files, and only normalize files
+    whose output is not normalized to the target RMS yet. Files whose size and modification time match the manifest
+    are not hashed again.
+
     Parameters
     ----------
     directory : str
@@ -33,6 +84,13 @@ def rms_normalize(directory=None, file_list=None, suffix=None, target_rms=None):
     target_rms : float
         The target RMS to which we normalize. If `None`, then calculate the minimum RMS of the peak normalized files
         and normalize to that.
+    n_jobs : int
+        The number of worker processes that process the files. If less than 1, the number of CPUs is used. Default is
+        1, i.e. the files are processed in this process.
+    verbose : bool
+        Print the progress. Default is False.
+    manifest_name : str
+        The file name of the manifest in `directory`. If `None`, no manifest is used. Default is '.caqe_manifest.json'.
 
     Returns
     -------
@@ -48,10 +106,6 @@ def rms_normalize(directory=None, file_list=None, suffix=None, target_rms=None):
         for path, _dirs, files in os.walk(directory):
             file_list.extend([os.path.join(path, f) for f in files if os.path.splitext(f)[1] == ".wav" or
                               os.path.splitext(f)[1] == ".WAV"])
-    pre_norm_values = np.asarray([_rms_of_file(file_name) for file_name in file_list])
-
-    if target_rms is None:
-        target_rms = min(pre_norm_values[pre_norm_values.nonzero()])
 
     if suffix is not None:
         output_file_list = []
@@ -61,16 +115,379 @@ def rms_normalize(directory=None, file_list=None, suffix=None, target_rms=None):
     else:
         output_file_list = file_list
 
-    post_norm_values = np.asarray([_normalize_file(file_list[i],
-                                                   output_file_list[i],
-                                                   target_rms) for i in range(len(file_list))])
+    if directory is not None and manifest_name is not None:
+        manifest_path = os.path.join(directory, manifest_name)
+        manifest = load_manifest(manifest_path)
+        keys = [_manifest_key(directory, f) for f in file_list]
+        output_keys = [_manifest_key(directory, f) for f in output_file_list]
+    else:
+        manifest_path = None
+        manifest = {}
+        keys = file_list
+        output_keys = output_file_list
+
+    # the files that have to be analyzed, because they are new or changed
+    stale = [i for i in range(len(file_list)) if not _is_up_to_date(manifest.get(keys[i], None), file_list[i])]
+    stale_set = set(stale)
+
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+
+    try:
+        if target_rms is None:
+            temp_directory = tempfile.mkdtemp(prefix='caqe_rms_normalize_')
+            try:
+                # only files that cannot be read block-wise are decoded and saved here by `_analyze_file`
+                temp_file_list = [os.path.join(temp_directory, '%d.npy' % i) for i in range(len(file_list))]
+                results = _map(pool,
+                               _analyze_file,
+                               [(file_list[i], temp_file_list[i]) for i in stale],
+                               [file_list[i] for i in stale],
+                               'Analyzing',
+                               verbose)
+                for i, stats in zip(stale, results):
+                    manifest[keys[i]] = stats
+
+                pre_norm_values = np.asarray([manifest[key]['rms'] for key in keys])
+                target_rms = min(pre_norm_values[pre_norm_values.nonzero()])
+
+                # files that were not analyzed in this run are decoded again
+                pending = [i for i in range(len(file_list)) if not _is_normalized(manifest, keys[i], output_keys[i],
+                                                                                  output_file_list[i], target_rms)]
+                results = _map(pool,
+                               _normalize_decoded_file,
+                               [(temp_file_list[i] if os.path.exists(temp_file_list[i]) else file_list[i],
+                                 manifest[keys[i]]['sr'],
+                                 output_file_list[i],
+                                 target_rms) for i in pending],
+                               [file_list[i] for i in pending],
+                               'Normalizing',
+                               verbose)
+            finally:
+                shutil.rmtree(temp_directory)
+        else:
+            pending = [i for i in range(len(file_list)) if i in stale_set or
+                       not _is_normalized(manifest, keys[i], output_keys[i], output_file_list[i], target_rms)]
+            results = _map(pool,
+                           _analyze_and_normalize_file,
+                           [(file_list[i], output_file_list[i], target_rms) for i in pending],
+                           [file_list[i] for i in pending],
+                           'Normalizing',
+                           verbose)
+            for i, (stats, _) in zip(pending, results):
+                manifest[keys[i]] = stats
+            results = [output_stats for _, output_stats in results]
+
+            pre_norm_values = np.asarray([manifest[key]['rms'] for key in keys])
+
+        for i, output_stats in zip(pending, results):
+            if output_keys[i] != keys[i]:
+                output_stats['source_sha1'] = manifest[keys[i]]['sha1']
+            manifest[output_keys[i]] = output_stats
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if manifest_path is not None:
+            save_manifest(manifest_path, manifest)
+
+    post_norm_values = np.asarray([manifest[key]['file_rms'] for key in output_keys])
 
     return file_list, pre_norm_values, post_norm_values
 
 
+def load_manifest(manifest_path):
+    """
+    Load the manifest of the statistics of the audio files in a directory (see `rms_normalize`).
+
+    Parameters
+    ----------
+    manifest_path : str
+
+    Returns
+    -------
+    manifest : dict
+        The statistics of each file, keyed by its path relative to the directory of the manifest. Empty if the manifest
+        does not exist.
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path, manifest):
+    """
+    Save the manifest of the statistics of the audio files in a directory, dropping the files that no longer exist.
+
+    Parameters
+    ----------
+    manifest_path : str
+    manifest : dict
+
+    Returns
+    -------
+    None
+    """
+    directory = os.path.dirname(manifest_path)
+    manifest = dict([(key, stats) for key, stats in manifest.items() if os.path.exists(os.path.join(directory, key))])
+
+    # write to a temporary file and rename it, so that an interrupted run never leaves a partial manifest
+    temp_manifest_path = manifest_path + '.tmp'
+    with open(temp_manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(temp_manifest_path, manifest_path)
+
+
+def _manifest_key(directory, file_path):
+    return os.path.relpath(file_path, directory).replace(os.sep, '/')
+
+
+def _sha1_of_file(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _is_up_to_date(stats, file_path):
+    """
+    Check whether the cached statistics of a file are of its current content. The file is only hashed if its size or
+    modification time changed, and the cached modification time is updated if the content did not change.
+
+    Parameters
+    ----------
+    stats : dict or None
+        The cached statistics of the file
+    file_path : str
+
+    Returns
+    -------
+    bool
+    """
+    if stats is None:
+        return False
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return False
+
+    if stat.st_size != stats['size']:
+        return False
+    if stat.st_mtime != stats['mtime']:
+        if _sha1_of_file(file_path) != stats['sha1']:
+            return False
+        stats['mtime'] = stat.st_mtime
+    return True
+
+
+def _is_normalized(manifest, key, output_key, output_file_path, target_rms):
+    """
+    Check whether the output file of the file at `key` in the manifest is normalized to `target_rms`.
+
+    Parameters
+    ----------
+    manifest : dict
+    key : str
+    output_key : str
+    output_file_path : str
+    target_rms : float
+
+    Returns
+    -------
+    bool
+    """
+    output_stats = manifest.get(output_key, None)
+    if output_stats is None or output_stats.get('target_rms', None) is None:
+        return False
+    if not np.isclose(output_stats['target_rms'], target_rms):
+        return False
+    if not _is_up_to_date(output_stats, output_file_path):
+        return False
+    return output_key == key or output_stats.get('source_sha1', None) == manifest[key]['sha1']
+
+
+def _stats_of_file(file_path):
+    """
+    Get the manifest statistics of a file. WAV files are analyzed block-wise (see `_analyze_wav`), other files are
+    decoded as a whole.
+
+    Parameters
+    ----------
+    file_path : str
+
+    Returns
+    -------
+    stats : dict
+    """
+    sha1 = _sha1_of_file(file_path)
+    wav = _open_wav(file_path)
+    if wav is None:
+        x, sr = librosa.load(file_path, sr=None, mono=True)
+        return _stats_of_samples(file_path, sha1, x, sr)
+
+    n_samples, peak, file_rms, rms = _analyze_wav(wav)
+    return _make_stats(file_path, sha1, n_samples, wav.sr, rms, file_rms, peak)
+
+
+def _stats_of_samples(file_path, sha1, x, sr):
+    """
+    Get the manifest statistics of a file from its decoded samples.
+
+    Parameters
+    ----------
+    file_path : str
+    sha1 : str
+        The SHA-1 hash of the content of the file
+    x : np.ndarray
+        The mono samples of the file
+    sr : int
+        The sampling rate
+
+    Returns
+    -------
+    stats : dict
+    """
+    return _make_stats(file_path,
+                       sha1,
+                       len(x),
+                       sr,
+                       _rms_of_samples(x),
+                       np.sqrt(np.mean(np.power(x, 2))),
+                       np.max(np.abs(x)) if len(x) > 0 else 0.)
+
+
+def _make_stats(file_path, sha1, n_samples, sr, rms, file_rms, peak):
+    stat = os.stat(file_path)
+    return {'sha1': sha1,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'duration': n_samples / float(sr),
+            'sr': sr,
+            'rms': float(rms),
+            'file_rms': float(file_rms),
+            'peak': float(peak)}
+
+
+def _map(pool, func, args_list, file_list, description, verbose):
+    """
+    Apply `func` to each item of `args_list`, in the processes of `pool` if it is not None, and print the progress.
+
+    Parameters
+    ----------
+    pool : multiprocessing.Pool or None
+    func : function
+    args_list : list of tuple
+        The arguments of each call
+    file_list : list of str
+        The file processed by each call, which is printed as the progress
+    description : str
+    verbose : bool
+
+    Returns
+    -------
+    results : list
+        The results in the order of `args_list`
+    """
+    if pool is None:
+        result_iter = itertools.imap(func, args_list)
+    else:
+        result_iter = pool.imap(func, args_list)
+
+    results = []
+    for i, result in enumerate(result_iter):
+        if verbose:
+            print('%s %d/%d: %s' % (description, i + 1, len(args_list), file_list[i]))
+        results.append(result)
+    return results
+
+
+def _analyze_file(args):
+    """
+    Get the statistics of an audio file (see `_stats_of_file`). Files that cannot be read block-wise are decoded and
+    their samples are saved to a .npy file for `_normalize_decoded_file`.
+
+    Parameters
+    ----------
+    args : tuple
+        The input file path and the .npy file path
+
+    Returns
+    -------
+    stats : dict
+    """
+    input_file_path, temp_file_path = args
+    if _open_wav(input_file_path) is not None:
+        return _stats_of_file(input_file_path)
+
+    sha1 = _sha1_of_file(input_file_path)
+    x, sr = librosa.load(input_file_path, sr=None, mono=True)
+    np.save(temp_file_path, x)
+    return _stats_of_samples(input_file_path, sha1, x, sr)
+
+
+def _normalize_decoded_file(args):
+    """
+    Normalize the samples saved by `_analyze_file`, or an audio file (see `_normalize_file`).
+
+    Parameters
+    ----------
+    args : tuple
+        The .npy or audio file path, the sampling rate, the output file path, and the target RMS
+
+    Returns
+    -------
+    output_stats : dict
+        The statistics of the output file, including the target RMS
+    """
+    source_file_path, sr, output_file_path, target_rms = args
+    if os.path.splitext(source_file_path)[1] == '.npy':
+        x = np.load(source_file_path, mmap_mode='r')
+        _normalize_samples(x, sr, output_file_path, target_rms)
+    else:
+        _normalize_file(source_file_path, output_file_path, target_rms)
+
+    output_stats = _stats_of_file(output_file_path)
+    output_stats['target_rms'] = target_rms
+    return output_stats
+
+
+def _analyze_and_normalize_file(args):
+    """
+    Get the statistics of an audio file and normalize it, decoding it only once if it cannot be read block-wise.
+
+    Parameters
+    ----------
+    args : tuple
+        The input file path, the output file path, and the target RMS
+
+    Returns
+    -------
+    stats : dict
+        The statistics of the input file
+    output_stats : dict
+        The statistics of the output file, including the target RMS
+    """
+    input_file_path, output_file_path, target_rms = args
+    if _open_wav(input_file_path) is not None:
+        stats = _stats_of_file(input_file_path)
+        _normalize_file(input_file_path, output_file_path, target_rms)
+    else:
+        sha1 = _sha1_of_file(input_file_path)
+        x, sr = librosa.load(input_file_path, sr=None, mono=True)
+        stats = _stats_of_samples(input_file_path, sha1, x, sr)
+        _normalize_samples(x, sr, output_file_path, target_rms)
+
+    output_stats = _stats_of_file(output_file_path)
+    output_stats['target_rms'] = target_rms
+    return stats, output_stats
+
+
 def _rms_of_file(file_path, min_val=0.001, normalize=True):
     """
-    Calculate the RMS of a file.
+    Calculate the RMS of a file. WAV files are analyzed block-wise in constant memory (see `_analyze_wav`).
 
     Parameters
     ----------
@@ -87,13 +504,37 @@ def _rms_of_file(file_path, min_val=0.001, normalize=True):
     rms : float
 
     """
+    wav = _open_wav(file_path)
+    if wav is not None:
+        return _analyze_wav(wav, min_val, normalize)[3]
+
     x, _ = librosa.load(file_path, sr=None, mono=True)
+    return _rms_of_samples(x, min_val, normalize)
+
+
+def _rms_of_samples(x, min_val=0.001, normalize=True):
+    """
+    Calculate the RMS of the samples of a file (see `_rms_of_file`).
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The mono samples. They are not modified.
+    min_val : float
+        When calculating the RMS, the signal will be bounded by the active region that is above this `min_val`
+        threshold. Default is 0.001.
+    normalize : bool
+        Peak normalize before calculating the RMS. Default is True.
 
+    Returns
+    -------
+    rms : float
+    """
     if normalize:
         divisor = np.max(np.abs(x))
         if divisor == 0:
             return 0
-        x /= divisor
+        x = x / divisor
 
     idx = np.where(np.abs(x) > min_val)[0]
     x = np.power(x[min(idx):max(idx)], 2)
@@ -104,7 +545,7 @@ def _rms_of_file(file_path, min_val=0.001, normalize=True):
 def _normalize_file(input_file_path, output_file_path, target_rms):
     """
     Normalize the audio file at `input_file_path` to root mean square `target_rms` and save at `output_file_path` as a
-     .WAV file.
+     .WAV file. WAV files are normalized block-wise in constant memory (see `_normalize_wav`).
 
     Parameters
     ----------
@@ -120,17 +561,245 @@ def _normalize_file(input_file_path, output_file_path, target_rms):
     post_norm_rms : float
         The RMS value after normalizing
     """
+    wav = _open_wav(input_file_path)
+    if wav is not None:
+        return _normalize_wav(wav, output_file_path, target_rms)
+
     x, sr = librosa.load(input_file_path, sr=None, mono=True)
+    y = _normalize_samples(x, sr, output_file_path, target_rms)
+
+    return np.sqrt(np.mean(np.power(y, 2)))
+
+
+def _normalize_samples(x, sr, output_file_path, target_rms):
+    """
+    Normalize the samples of a file to root mean square `target_rms` and save them at `output_file_path` as a .WAV file
+    (see `_normalize_file`).
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The mono samples
+    sr : int
+        The sampling rate
+    output_file_path : str
+        Output audio file path to where the output audio file should be saved
+    target_rms : float
+        The target RMS value of the audio file, i.e. we normalize to this value.
 
+    Returns
+    -------
+    y : np.ndarray
+        The normalized samples
+    """
     x_rms = np.sqrt(np.mean(np.power(x, 2)))
     y = x * (target_rms / x_rms)
 
     librosa.output.write_wav(output_file_path, y, sr, norm=False)
 
-    return np.sqrt(np.mean(np.power(y, 2)))
+    return y
+
+
+def _open_wav(file_path):
+    """
+    Open the samples of a PCM (8, 16, or 32 bit) or floating point (32 or 64 bit) WAV file as a memory map, without
+    reading them.
+
+    Parameters
+    ----------
+    file_path : str
+
+    Returns
+    -------
+    wav : WavFile
+        None if the file is not a WAV file in one of these formats (e.g. 24 bit PCM), in which case it has to be
+        decoded with librosa.
+    """
+    with open(file_path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != 'RIFF' or header[8:12] != 'WAVE':
+            return None
+
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == 'data':
+                break
+            chunk = f.read(chunk_size + chunk_size % 2)
+            if chunk_id == 'fmt ' and len(chunk) >= 16:
+                fmt = chunk
+        if fmt is None:
+            return None
+        offset = f.tell()
+
+    format_tag, n_channels, sr, _, block_align, bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+    if (format_tag, bits_per_sample) not in WAV_SAMPLE_FORMATS or n_channels == 0 or \
+            block_align != n_channels * bits_per_sample / 8:
+        return None
+    dtype, bias, scale = WAV_SAMPLE_FORMATS[(format_tag, bits_per_sample)]
+
+    # the data chunk size of files that were not finalized may be wrong, so it is bounded by the file size
+    n_frames = min(chunk_size, os.path.getsize(file_path) - offset) / block_align
+    if n_frames == 0:
+        return None
+    samples = np.memmap(file_path, dtype=dtype, mode='r', offset=offset, shape=(n_frames, n_channels))
+    return WavFile(samples, sr, bias, scale)
+
+
+def _read_wav_block(wav, start, stop):
+    """
+    Read the samples `start` to `stop` of a WAV file as mono floating point samples in [-1, 1].
+
+    Parameters
+    ----------
+    wav : WavFile
+    start : int
+    stop : int
+
+    Returns
+    -------
+    x : np.ndarray
+    """
+    x = np.array(wav.samples[start:stop], dtype=np.float64)
+    if wav.bias != 0:
+        x -= wav.bias
+    x /= wav.scale
+    return np.mean(x, axis=1)
+
+
+def _analyze_wav(wav, min_val=0.001, normalize=True, block_size=BLOCK_SIZE):
+    """
+    Calculate the statistics of a WAV file block-wise, in constant memory. The RMS is calculated like
+    `_rms_of_samples`: the active region is found by scanning inwards from both ends of the file, and its sum of squares
+    is assembled from the sums of squares of the blocks of the first pass.
+
+    Parameters
+    ----------
+    wav : WavFile
+    min_val : float
+        When calculating the RMS, the signal will be bounded by the active region that is above this `min_val`
+        threshold. Default is 0.001.
+    normalize : bool
+        Peak normalize before calculating the RMS. Default is True.
+    block_size : int
+        The number of samples per block. Default is 2**18.
+
+    Returns
+    -------
+    n_samples : int
+    peak : float
+        The maximum absolute sample value
+    file_rms : float
+        The RMS of the whole file
+    rms : float
+        The RMS of the active region
+    """
+    n_samples = len(wav.samples)
+    starts = range(0, n_samples, block_size)
+
+    peak = 0.
+    block_sums = []
+    for start in starts:
+        x = _read_wav_block(wav, start, start + block_size)
+        peak = max(peak, np.max(np.abs(x)))
+        block_sums.append(np.dot(x, x))
+    file_rms = np.sqrt(np.sum(block_sums) / n_samples)
+
+    if normalize:
+        if peak == 0:
+            return n_samples, peak, file_rms, 0
+        divisor = peak
+    else:
+        divisor = 1.
+    threshold = min_val * divisor
+
+    first = None
+    for start in starts:
+        idx = np.where(np.abs(_read_wav_block(wav, start, start + block_size)) > threshold)[0]
+        if len(idx) > 0:
+            first = start + idx[0]
+            break
+    if first is None:
+        raise ValueError('No samples above the threshold %r' % min_val)
+
+    last = None
+    for start in reversed(starts):
+        idx = np.where(np.abs(_read_wav_block(wav, start, start + block_size)) > threshold)[0]
+        if len(idx) > 0:
+            last = start + idx[-1]
+            break
+
+    # the sum of squares of the samples `first` to `last` (exclusive)
+    first_block = first // block_size
+    last_block = last // block_size
+    if first_block == last_block:
+        x = _read_wav_block(wav, first, last)
+        active_sum = np.dot(x, x)
+    else:
+        x = _read_wav_block(wav, first, (first_block + 1) * block_size)
+        active_sum = np.dot(x, x) + np.sum(block_sums[first_block + 1:last_block])
+        x = _read_wav_block(wav, last_block * block_size, last)
+        active_sum += np.dot(x, x)
+
+    rms = np.sqrt(active_sum / (last - first)) / divisor
+    return n_samples, peak, file_rms, rms
+
+
+def _normalize_wav(wav, output_file_path, target_rms, block_size=BLOCK_SIZE):
+    """
+    Normalize a WAV file to root mean square `target_rms` block-wise, in constant memory, and save it at
+    `output_file_path` as a mono 32 bit floating point .WAV file. The output is written to a temporary file which then
+    replaces `output_file_path`, so the input may be overwritten.
+
+    Parameters
+    ----------
+    wav : WavFile
+    output_file_path : str
+    target_rms : float
+    block_size : int
+        The number of samples per block. Default is 2**18.
+
+    Returns
+    -------
+    post_norm_rms : float
+        The RMS value after normalizing
+    """
+    n_samples = len(wav.samples)
+    starts = range(0, n_samples, block_size)
+
+    x_sum = 0.
+    for start in starts:
+        x = _read_wav_block(wav, start, start + block_size)
+        x_sum += np.dot(x, x)
+    gain = target_rms / np.sqrt(x_sum / n_samples)
+
+    data_size = n_samples * 4
+    temp_file_path = '%s.%d.tmp' % (output_file_path, os.getpid())
+    y_sum = 0.
+    try:
+        with open(temp_file_path, 'wb') as f:
+            f.write(struct.pack('<4sI4s', 'RIFF', 36 + data_size, 'WAVE'))
+            f.write(struct.pack('<4sIHHIIHH', 'fmt ', 16, WAVE_FORMAT_IEEE_FLOAT, 1, wav.sr, wav.sr * 4, 4, 32))
+            f.write(struct.pack('<4sI', 'data', data_size))
+            for start in starts:
+                y = (_read_wav_block(wav, start, start + block_size) * gain).astype('<f4')
+                y_sum += np.dot(y, y)
+                f.write(y.tostring())
+        os.rename(temp_file_path, output_file_path)
+    except Exception:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+
+    return np.sqrt(y_sum / n_samples)
 
 
-def generate_source_separation_anchors(directory=None, file_list=None):
+def generate_source_separation_anchors(directory=None, file_list=None, seed=None, n_jobs=1, verbose=False):
     """
     Generate the PEASS-style anchors for use in a source separation evaluation.
 
@@ -147,6 +816,14 @@ def generate_source_separation_anchors(directory=None, file_list=None):
         Input directory of audio files to process. Either this or `file_list` must be defined. Default is None.
     file_list : list of str
         List of audio files to process. Either this or `directory` must be defined. Default is None.
+    seed : int
+        The seed of the random time-frequency masks. The anchors of the same files are identical for the same seed,
+        regardless of `n_jobs`. If `None`, the masks are not reproducible. Default is None.
+    n_jobs : int
+        The number of worker processes that process the files. If less than 1, the number of CPUs is used. Default is
+        1, i.e. the files are processed in this process.
+    verbose : bool
+        Print the progress. Default is False.
 
     Returns
     -------
@@ -166,47 +843,226 @@ def generate_source_separation_anchors(directory=None, file_list=None):
             file_list.extend([os.path.join(path, f) for f in files if os.path.splitext(f)[1] == ".wav" or
                               os.path.splitext(f)[1] == ".WAV"])
 
-    for input_file_name in file_list:
-        x, sr = librosa.load(input_file_name, sr=None, mono=False)
-        if x.ndim == 1:
-            x = x.reshape(1, -1)
-        n_fft = int(2**np.round(np.log2(sr * 0.046)))
-
-        # distorted target anchor
-        X = [librosa.stft(x[i], n_fft=n_fft, hop_length=n_fft/2) for i in range(x.shape[0])]
-        cutoff = int(np.ceil((3500.0/sr) * n_fft))
-        for _X in X:
-            _X[cutoff:, :] = 0.0
-            _X[:, np.random.random(_X.shape[1]) <= 0.2] = 0.0
-        x_anch1 = np.array([librosa.istft(_X, hop_length=n_fft/2) for _X in X])
-
-        if x_anch1.shape[0] == 1:
-            x_anch1 = x_anch1.reshape(-1)
-        output_file_name = os.path.splitext(input_file_name)[0] + '_anchorDistTarget' + '.wav'
-        librosa.output.write_wav(output_file_name, x_anch1, sr=sr)
-
-        # artificial noise anchor
-        x_mono = np.mean(x, axis=0)
-        X = librosa.stft(x_mono, n_fft=n_fft, hop_length=n_fft/2)
-        X[np.random.random(X.shape) <= 0.99] = 0.0
-        artifacts = librosa.istft(X, hop_length=n_fft/2)
-        artifacts_rms = np.sqrt(np.mean(np.power(artifacts, 2)))
-        x_rms = np.sqrt(np.mean(np.power(x, 2)))
-        artifacts *= (x_rms / artifacts_rms)
-        if x.shape[0] == 1:
-            artifacts = artifacts.reshape(1, -1)
-        elif x.shape[0] == 2:
-            artifacts = np.array([artifacts, artifacts])
-        else:
-            raise Exception('More than 2 channels.')
-        artifacts_pad = np.zeros_like(x)
-        artifacts_pad[:artifacts.shape[0], :artifacts.shape[1]] = artifacts
-        x_anch2 = x + artifacts_pad
+    # draw a seed for each file up front, so that the anchors do not depend on the order in which files are processed
+    if seed is None:
+        file_seeds = [None] * len(file_list)
+    else:
+        file_seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, len(file_list))
+
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+
+    try:
+        _map(pool, _generate_anchors, zip(file_list, file_seeds), file_list, 'Generating anchors', verbose)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _hann_window(n_fft):
+    """
+    The periodic Hann window, which is the default window of librosa's STFT.
+    """
+    return 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n_fft) / n_fft)
+
+
+def batch_stft(x, n_fft, hop_length):
+    """
+    Compute the STFTs of several signals of equal length. The frames are made with numpy strides and transformed in
+    blocks of `STFT_BLOCK_BYTES` (which stay in the CPU cache), instead of calling `librosa.stft` for each signal. The
+    result equals that of `librosa.stft(x[i], n_fft=n_fft, hop_length=hop_length)` (librosa 0.4), i.e. centered
+    frames, a Hann window, and conjugated coefficients.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The signals, of shape (number of signals, number of samples)
+    n_fft : int
+        FFT size
+    hop_length : int
+        The number of samples between frames
+
+    Returns
+    -------
+    X : np.ndarray
+        The complex STFTs, of shape (number of signals, 1 + n_fft/2, number of frames)
+    """
+    x = np.pad(x, ((0, 0), (n_fft // 2, n_fft // 2)), mode='reflect')
+    n_frames = 1 + (x.shape[1] - n_fft) // hop_length
+    window = _hann_window(n_fft)
+    block_frames = max(1, STFT_BLOCK_BYTES // (n_fft * window.itemsize))
+
+    # the frequencies of each frame are contiguous, which is the axis `batch_istft` transforms
+    X = np.empty((x.shape[0], n_frames, n_fft // 2 + 1), dtype=np.complex64)
+    for i in range(x.shape[0]):
+        frames = np.lib.stride_tricks.as_strided(x[i],
+                                                 shape=(n_frames, n_fft),
+                                                 strides=(x.strides[1] * hop_length, x.strides[1]))
+        for j in range(0, n_frames, block_frames):
+            np.conjugate(np.fft.rfft(frames[j:j + block_frames] * window, axis=1), out=X[i, j:j + block_frames])
+    return X.transpose(0, 2, 1)
+
+
+def batch_istft(X, hop_length):
+    """
+    Compute the inverse STFTs of several STFTs of equal shape, the inverse of `batch_stft`. The frames are
+    transformed and overlap-added in blocks of `STFT_BLOCK_BYTES`, instead of one at a time as `librosa.istft` does.
+    The result equals that of `librosa.istft(X[i], hop_length=hop_length)` (librosa 0.4), i.e. the Hann-windowed
+    frames are overlap-added without normalizing the window.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        The complex STFTs, of shape (number of signals, 1 + n_fft/2, number of frames)
+    hop_length : int
+        The number of samples between frames, which must divide the FFT size
+
+    Returns
+    -------
+    y : np.ndarray
+        The signals, of shape (number of signals, hop_length * (number of frames - 1))
+    """
+    n_signals, n_bins, n_frames = X.shape
+    n_fft = 2 * (n_bins - 1)
+    if n_fft % hop_length != 0:
+        raise Exception('The hop length must divide the FFT size.')
+    window = _hann_window(n_fft)
+    block_frames = max(1, STFT_BLOCK_BYTES // (n_fft * window.itemsize))
 
-        if x_anch2.shape[0] == 1:
-            x_anch2 = x_anch2.reshape(-1)
-        output_file_name = os.path.splitext(input_file_name)[0] + '_anchorArtif' + '.wav'
-        librosa.output.write_wav(output_file_name, x_anch2, sr=sr)
+    # each frame spans n_fft / hop_length consecutive hops of the output
+    hops_per_frame = n_fft // hop_length
+    y = np.zeros((n_signals, n_frames + hops_per_frame - 1, hop_length))
+    for i in range(n_signals):
+        for j in range(0, n_frames, block_frames):
+            frames = np.fft.irfft(X[i, :, j:j + block_frames].T.conj(), n=n_fft, axis=1) * window
+            frames = frames.reshape(frames.shape[0], hops_per_frame, hop_length)
+            for k in range(hops_per_frame):
+                y[i, j + k:j + k + frames.shape[0]] += frames[:, k]
+    y = y.reshape(n_signals, -1)[:, n_fft // 2:-(n_fft // 2)]
+    return y.astype(np.float32)
+
+
+def _generate_anchors(args):
+    """
+    Generate the anchors of a file (see `generate_source_separation_anchors`). The STFTs of all channels are computed
+    together and shared by both anchors, the STFT of the mono mix being the mean of the channel STFTs. The inverse
+    STFTs of both anchors are computed together as well (see `batch_stft` and `batch_istft`).
+
+    Parameters
+    ----------
+    args : tuple
+        The input file path and the seed of the random time-frequency masks
+
+    Returns
+    -------
+    None
+    """
+    input_file_name, seed = args
+    rng = np.random.RandomState(seed)
+
+    x, sr = librosa.load(input_file_name, sr=None, mono=False)
+    if x.ndim == 1:
+        x = x.reshape(1, -1)
+    if x.shape[0] > 2:
+        raise Exception('More than 2 channels.')
+    n_fft = int(2**np.round(np.log2(sr * 0.046)))
+
+    X = batch_stft(x, n_fft, n_fft/2)
+    # the STFT is linear, so this equals the STFT of the mono mix
+    X_mono = np.mean(X, axis=0)
+
+    # distorted target anchor
+    cutoff = int(np.ceil((3500.0/sr) * n_fft))
+    X[:, cutoff:, :] = 0.0
+    for _X in X:
+        _X[:, rng.random_sample(_X.shape[1]) <= 0.2] = 0.0
+
+    # artificial noise anchor
+    X_mono[rng.random_sample(X_mono.shape) <= 0.99] = 0.0
+
+    y = batch_istft(np.concatenate([X, X_mono.reshape((1,) + X_mono.shape)]), n_fft/2)
+    x_anch1 = y[:-1]
+    artifacts = y[-1]
+
+    if x_anch1.shape[0] == 1:
+        x_anch1 = x_anch1.reshape(-1)
+    output_file_name = os.path.splitext(input_file_name)[0] + '_anchorDistTarget' + '.wav'
+    librosa.output.write_wav(output_file_name, x_anch1, sr=sr)
+
+    # scale the artifacts to the loudness of the target
+    artifacts_rms = np.sqrt(np.mean(np.power(artifacts, 2)))
+    x_rms = np.sqrt(np.mean(np.power(x, 2)))
+    artifacts *= (x_rms / artifacts_rms)
+    artifacts_pad = np.zeros_like(x)
+    artifacts_pad[:, :artifacts.shape[0]] = artifacts[:x.shape[1]]
+    x_anch2 = x + artifacts_pad
+
+    if x_anch2.shape[0] == 1:
+        x_anch2 = x_anch2.reshape(-1)
+    output_file_name = os.path.splitext(input_file_name)[0] + '_anchorArtif' + '.wav'
+    librosa.output.write_wav(output_file_name, x_anch2, sr=sr)
+
+
+def transcode_renditions(directory, codecs=('flac',), manifest_name=RENDITION_MANIFEST, ffmpeg='ffmpeg'):
+    """
+    Transcode the .wav files in `directory` into compressed renditions with ffmpeg, and write a manifest of the
+    renditions of each file, which the audio route uses to serve the rendition a client asks for. Renditions that
+    are newer than their .wav file are not transcoded again.
+
+    Parameters
+    ----------
+    directory : str
+        Input directory of audio files to process, i.e. the `AUDIO_FILE_DIRECTORY`.
+    codecs : list of str
+        The codecs of the renditions, any of 'flac' (lossless), 'mp3', and 'ogg'. Default is ('flac',).
+    manifest_name : str
+        The file name of the manifest in `directory`. Default is 'renditions.json'.
+    ffmpeg : str
+        The ffmpeg executable. Default is 'ffmpeg'.
+
+    Returns
+    -------
+    manifest : dict
+        The rendition file paths (relative to `directory`) keyed by codec, keyed by the relative path of each .wav file
+    """
+    for codec in codecs:
+        if codec not in RENDITION_CODECS:
+            raise Exception('Unknown codec %r. Supported codecs are %s.' % (codec, ', '.join(sorted(RENDITION_CODECS))))
+
+    manifest_path = os.path.join(directory, manifest_name)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    else:
+        manifest = {}
+
+    for path, _dirs, files in os.walk(directory):
+        for f in sorted(files):
+            if os.path.splitext(f)[1] not in ('.wav', '.WAV'):
+                continue
+            input_file_path = os.path.join(path, f)
+            input_file_name = os.path.relpath(input_file_path, directory).replace(os.sep, '/')
+            renditions = manifest.setdefault(input_file_name, {})
+
+            for codec in codecs:
+                encoder_args, extension = RENDITION_CODECS[codec]
+                output_file_path = os.path.splitext(input_file_path)[0] + extension
+                if not os.path.exists(output_file_path) or \
+                        os.path.getmtime(output_file_path) < os.path.getmtime(input_file_path):
+                    print('Transcoding %s to %s' % (input_file_path, output_file_path))
+                    subprocess.check_call([ffmpeg, '-y', '-loglevel', 'error', '-i', input_file_path] +
+                                          encoder_args + [output_file_path])
+                renditions[codec] = os.path.relpath(output_file_path, directory).replace(os.sep, '/')
+
+    # write to a temporary file and rename it, so that the web application never reads a partial manifest
+    temp_manifest_path = manifest_path + '.tmp'
+    with open(temp_manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(temp_manifest_path, manifest_path)
+
+    return manifest
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Pre-process audio stimuli.')
@@ -218,14 +1074,33 @@ if __name__ == '__main__':
                                              'input files will be overwritten.', default=None)
     ch.add_argument('--target-rms', type=float, help='The target rms value. If none is given, it will calculate the '
                                                      'max possible without clipping.', default=None)
+    ch.add_argument('--n-jobs', type=int, help='The number of worker processes. If less than 1, the number of CPUs is '
+                                               'used. Default is 1.', default=1)
+    ch.add_argument('--no-manifest', action='store_true', help='Do not use the manifest of cached file statistics, '
+                                                               'i.e. analyze and normalize all files.')
 
     ch = sp.add_parser('generate-ss-anchors', help='Generate anchors for source separation given a directory of '
                                                    '.wav files.')
     ch.add_argument('input_directory', type=str, help='Path to the input directory')
+    ch.add_argument('--seed', type=int, help='The seed of the random time-frequency masks.', default=None)
+    ch.add_argument('--n-jobs', type=int, help='The number of worker processes. If less than 1, the number of CPUs is '
+                                               'used. Default is 1.', default=1)
+
+    ch = sp.add_parser('transcode', help='Transcode .wav files in a directory into compressed renditions and write a '
+                                         'rendition manifest.')
+    ch.add_argument('input_directory', type=str, help='Path to the input directory')
+    ch.add_argument('--codecs', type=str, nargs='+', choices=sorted(RENDITION_CODECS), default=['flac'],
+                    help='The codecs of the renditions. Default is flac.')
+    ch.add_argument('--manifest', type=str, default=RENDITION_MANIFEST,
+                    help='The file name of the rendition manifest. Default is %s.' % RENDITION_MANIFEST)
+    ch.add_argument('--ffmpeg', type=str, default='ffmpeg', help='The ffmpeg executable. Default is ffmpeg.')
 
     args = parser.parse_args()
 
     if args.command == 'rms-normalize':
-        rms_normalize(args.input_directory, suffix=args.suffix, target_rms=args.target_rms)
+        rms_normalize(args.input_directory, suffix=args.suffix, target_rms=args.target_rms, n_jobs=args.n_jobs,
+                      verbose=True, manifest_name=None if args.no_manifest else MANIFEST)
     elif args.command == 'generate-ss-anchors':
-        generate_source_separation_anchors(args.input_directory)
\ No newline at end of file
+        generate_source_separation_anchors(args.input_directory, seed=args.seed, n_jobs=args.n_jobs, verbose=True)
+    elif args.command == 'transcode':
+        transcode_renditions(args.input_directory, codecs=args.codecs, manifest_name=args.manifest, ffmpeg=args.ffmpeg)
\ No newline at end of file
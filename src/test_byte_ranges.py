@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the byte range handling of the audio routes (`caqe.views.parse_byte_ranges` and
+`caqe.views.send_file_partial`), and of the selection of the audio renditions (`caqe.views.select_audio_rendition`).
+
+To run: ::
+
+    $ python -m unittest test_byte_ranges
+
+"""
+import os
+import re
+import json
+import shutil
+import tempfile
+import unittest
+
+os.environ.setdefault('APP_MODE', 'TESTING')
+os.environ.setdefault('CSRF_SECRET_KEY', 'test-csrf-secret-key-0123456789a')
+os.environ.setdefault('SESSION_KEY', 'test-session-key')
+
+from werkzeug.http import http_date
+
+from caqe import app
+import caqe.views as views
+
+DATA = 'RIFF' + ''.join([chr(i % 256) for i in range(996)])
+
+
+class ParseByteRangesTestCase(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(views.parse_byte_ranges('bytes=0-499', 1000), [(0, 499)])
+        self.assertEqual(views.parse_byte_ranges('bytes=500-', 1000), [(500, 999)])
+        self.assertEqual(views.parse_byte_ranges('bytes=900-2000', 1000), [(900, 999)])
+
+    def test_suffix_range(self):
+        self.assertEqual(views.parse_byte_ranges('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(views.parse_byte_ranges('bytes=-2000', 1000), [(0, 999)])
+
+    def test_multiple_ranges(self):
+        self.assertEqual(views.parse_byte_ranges('bytes=0-0, -1', 1000), [(0, 0), (999, 999)])
+        # unsatisfiable ranges are dropped, as long as one is satisfiable
+        self.assertEqual(views.parse_byte_ranges('bytes=0-9,2000-', 1000), [(0, 9)])
+
+    def test_unsatisfiable_ranges(self):
+        self.assertEqual(views.parse_byte_ranges('bytes=1000-', 1000), [])
+        self.assertEqual(views.parse_byte_ranges('bytes=-0', 1000), [])
+
+    def test_invalid_ranges(self):
+        for range_header in (None, '', 'bytes', 'items=0-10', 'bytes=-', 'bytes=a-b', 'bytes=10-5', 'bytes=0-1,x'):
+            self.assertIsNone(views.parse_byte_ranges(range_header, 1000), range_header)
+
+
+class SendFilePartialTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'a.wav')
+        with open(self.path, 'wb') as f:
+            f.write(DATA)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def send(self, headers=None):
+        with app.test_request_context('/', headers=headers):
+            rv = views.send_file_partial(self.path, 'audio/wav')
+            rv.direct_passthrough = False
+            data = rv.get_data()
+            rv.close()
+        return rv, data
+
+    def test_full_response(self):
+        rv, data = self.send()
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(data, DATA)
+        self.assertEqual(rv.headers['Content-Length'], str(len(DATA)))
+        self.assertEqual(rv.headers['Content-Type'], 'audio/wav')
+        self.assertEqual(rv.headers['Accept-Ranges'], 'bytes')
+        self.assertIn('ETag', rv.headers)
+        self.assertIn('Last-Modified', rv.headers)
+
+    def test_range(self):
+        rv, data = self.send({'Range': 'bytes=10-19'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(data, DATA[10:20])
+        self.assertEqual(rv.headers['Content-Range'], 'bytes 10-19/%d' % len(DATA))
+        self.assertEqual(rv.headers['Content-Length'], '10')
+        self.assertEqual(rv.headers['Accept-Ranges'], 'bytes')
+
+    def test_suffix_range(self):
+        rv, data = self.send({'Range': 'bytes=-100'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(data, DATA[-100:])
+        self.assertEqual(rv.headers['Content-Range'], 'bytes 900-999/%d' % len(DATA))
+
+    def test_multiple_ranges(self):
+        rv, data = self.send({'Range': 'bytes=0-3,-10'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(rv.headers['Content-Length'], str(len(data)))
+        boundary = re.match(r'multipart/byteranges; boundary=(\w+)$', rv.headers['Content-Type']).group(1)
+
+        parts = data.split('--%s' % str(boundary))
+        self.assertEqual(parts[0], '')
+        self.assertEqual(parts[-1], '--\r\n')
+        self.assertEqual(parts[1:-1],
+                         ['\r\nContent-Type: audio/wav\r\nContent-Range: bytes 0-3/%d\r\n\r\n%s\r\n' %
+                          (len(DATA), DATA[:4]),
+                          '\r\nContent-Type: audio/wav\r\nContent-Range: bytes 990-999/%d\r\n\r\n%s\r\n' %
+                          (len(DATA), DATA[-10:])])
+
+    def test_unsatisfiable_range(self):
+        rv, data = self.send({'Range': 'bytes=1000-'})
+        self.assertEqual(rv.status_code, 416)
+        self.assertEqual(rv.headers['Content-Range'], 'bytes */%d' % len(DATA))
+
+    def test_invalid_range(self):
+        rv, data = self.send({'Range': 'bytes=10-5'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(data, DATA)
+
+    def test_if_range(self):
+        first, _ = self.send()
+        for validator in (first.headers['ETag'], first.headers['Last-Modified']):
+            rv, data = self.send({'Range': 'bytes=10-19', 'If-Range': validator})
+            self.assertEqual(rv.status_code, 206)
+            self.assertEqual(data, DATA[10:20])
+
+        # the client's copy is outdated, so the whole file is sent
+        for validator in ('"outdated"', http_date(0)):
+            rv, data = self.send({'Range': 'bytes=10-19', 'If-Range': validator})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(data, DATA)
+
+    def test_if_none_match(self):
+        first, _ = self.send()
+        rv, _ = self.send({'If-None-Match': first.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
+    def test_hearing_test_audio(self):
+        rv = app.test_client().get('/hearing_test/audio/0.wav')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Content-Type'], 'audio/wav')
+        self.assertEqual(rv.headers.getlist('Accept-Ranges'), ['bytes'])
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hearing_test_audio', '1000Hz.wav'),
+                  'rb') as f:
+            self.assertEqual(rv.data, f.read())
+
+
+class SelectAudioRenditionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'renditions.json'), 'w') as f:
+            json.dump({'a.wav': {'flac': 'a.flac', 'mp3': 'a.mp3'}}, f)
+        self.old_config = dict(app.config)
+        app.config['AUDIO_RENDITIONS'] = ['flac', 'mp3']
+        app.config['AUDIO_RENDITION_MANIFEST'] = 'renditions.json'
+
+    def tearDown(self):
+        app.config.update(self.old_config)
+        shutil.rmtree(self.directory)
+
+    def select(self, accept, filename='a.wav'):
+        with app.test_request_context('/', headers={'Accept': accept} if accept is not None else None):
+            return views.select_audio_rendition(self.directory, filename)
+
+    def test_wildcards(self):
+        # e.g. the requests of an <audio> element
+        for accept in (None, '*/*', 'audio/*', 'audio/*, */*;q=0.8', 'audio/flac;q=0, */*'):
+            self.assertEqual(self.select(accept), ('a.wav', None), accept)
+
+    def test_explicit_mimetypes(self):
+        self.assertEqual(self.select('audio/flac'), ('a.flac', 'audio/flac'))
+        self.assertEqual(self.select('audio/mpeg, */*;q=0.1'), ('a.mp3', 'audio/mpeg'))
+        self.assertEqual(self.select('audio/mpeg, audio/flac;q=0.5'), ('a.mp3', 'audio/mpeg'))
+        # on equal quality, the order of `AUDIO_RENDITIONS` is preferred
+        self.assertEqual(self.select('audio/mpeg, audio/flac'), ('a.flac', 'audio/flac'))
+        self.assertEqual(self.select('audio/ogg'), ('a.wav', None))
+
+    def test_no_renditions(self):
+        self.assertEqual(self.select('audio/flac', 'b.wav'), ('b.wav', None))
+        app.config['AUDIO_RENDITIONS'] = []
+        self.assertEqual(self.select('audio/flac'), ('a.wav', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
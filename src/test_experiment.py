@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the condition trial counts (`caqe.experiment.record_trial_progress`), condition availability, and the
+per-process condition caches.
+
+To run: ::
+
+    $ python -m unittest test_experiment
+
+"""
+import os
+import unittest
+
+os.environ.setdefault('APP_MODE', 'TESTING')
+# the secret key is also the AES key of the encrypted audio URLs, so it must be 16, 24, or 32 bytes long
+os.environ.setdefault('CSRF_SECRET_KEY', 'test-csrf-secret-key-0123456789a')
+os.environ.setdefault('SESSION_KEY', 'test-session-key')
+
+from caqe import app
+from caqe import db
+import caqe.experiment as experiment
+from caqe.models import Condition, ConditionProgress, Participant, Trial
+
+
+class ConditionProgressTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        experiment.insert_tests_and_conditions()
+        self.condition_id = Condition.query.order_by(Condition.id).first().id
+        self.participant = Participant('mturk', 'W1')
+        db.session.add(self.participant)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def save_trial(self, passed_hearing_test, record_progress=True):
+        db.session.add(Trial(self.participant.id, self.condition_id, '{}', None, passed_hearing_test))
+        if record_progress:
+            experiment.record_trial_progress(self.condition_id, passed_hearing_test)
+        db.session.commit()
+
+    def get_counts(self):
+        progress = ConditionProgress.query.get(self.condition_id)
+        return progress.passed_count, progress.failed_count
+
+    def is_available(self):
+        return self.condition_id in [c.id for c in experiment.get_available_conditions()]
+
+    def test_record_trial_progress(self):
+        self.assertEqual(self.get_counts(), (0, 0))
+        self.save_trial(True)
+        self.save_trial(False)
+        self.save_trial(True)
+        self.assertEqual(self.get_counts(), (2, 1))
+
+    def test_availability(self):
+        for _ in range(app.config['TRIALS_PER_CONDITION'] - 1):
+            self.save_trial(True)
+        self.save_trial(False)
+        self.assertTrue(self.is_available())
+        self.save_trial(True)
+        self.assertFalse(self.is_available())
+
+    def test_missing_progress_row(self):
+        # e.g. a database created before the trial counts were maintained
+        ConditionProgress.query.filter_by(condition_id=self.condition_id).delete()
+        db.session.commit()
+        for _ in range(app.config['TRIALS_PER_CONDITION']):
+            self.save_trial(True, record_progress=False)
+
+        # the trials of the condition are counted in the trial table
+        self.assertFalse(self.is_available())
+        self.assertEqual(experiment.get_available_conditions().count(), Condition.query.count() - 1)
+
+        # the progress row is inserted with the counts of the trial table, including the new trial
+        self.save_trial(False)
+        self.assertEqual(self.get_counts(), (app.config['TRIALS_PER_CONDITION'], 1))
+        self.save_trial(True)
+        self.assertEqual(self.get_counts(), (app.config['TRIALS_PER_CONDITION'] + 1, 1))
+
+    def test_unknown_condition(self):
+        self.assertRaises(Exception, experiment.record_trial_progress, Condition.query.count() + 1, True)
+
+
+class ConditionCacheTestCase(unittest.TestCase):
+    def test_invalidate_condition_cache(self):
+        with app.app_context():
+            encrypted = experiment.encrypt_audio_stimuli([['S1', 'a.wav'], ['reference', 'ref.wav']], 1, 2)
+        self.assertEqual(len(experiment.encrypted_audio_url_cache), 2)
+        self.assertEqual(len(experiment.decrypted_audio_key_cache), 2)
+        invalidations = [experiment.encrypted_audio_url_cache.invalidations,
+                         experiment.decrypted_audio_key_cache.invalidations,
+                         experiment.condition_cache_stats['invalidations']]
+
+        experiment.invalidate_condition_cache()
+        self.assertEqual(len(experiment.encrypted_audio_url_cache), 0)
+        self.assertEqual(len(experiment.decrypted_audio_key_cache), 0)
+        self.assertEqual([experiment.encrypted_audio_url_cache.invalidations,
+                          experiment.decrypted_audio_key_cache.invalidations,
+                          experiment.condition_cache_stats['invalidations']], [n + 1 for n in invalidations])
+
+        # the URLs can still be decrypted
+        self.assertEqual(experiment._decode_url(encrypted[1][1])['URL'], 'a.wav')
+
+
+if __name__ == '__main__':
+    unittest.main()
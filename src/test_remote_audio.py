@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the external file host proxy and cache (`caqe.remote_audio`) against a local stand-in for the file host.
+
+To run: ::
+
+    $ python -m unittest test_remote_audio
+
+"""
+import os
+import re
+import time
+import shutil
+import urllib
+import tempfile
+import unittest
+import threading
+import BaseHTTPServer
+import SocketServer
+
+os.environ.setdefault('APP_MODE', 'TESTING')
+os.environ.setdefault('CSRF_SECRET_KEY', 'test-csrf-secret-key-0123456789a')
+os.environ.setdefault('SESSION_KEY', 'test-session-key')
+
+from caqe import app
+import caqe.remote_audio as remote_audio
+import caqe.views as views
+
+FILES = {'/a.wav': 'RIFF' + ''.join([chr(i % 256) for i in range(1000)]),
+         '/b.wav': 'RIFF' + 'b' * 1000,
+         '/c.wav': 'RIFF' + 'c' * 1000,
+         '/\xc3\xa9t\xc3\xa9.wav': 'RIFF' + 'e' * 1000}
+
+# The modification time of the files on the file host
+LAST_MODIFIED = 'Wed, 01 Jan 2020 00:00:00 GMT'
+LAST_MODIFIED_TIMESTAMP = 1577836800
+
+
+class FileHostHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves `FILES` with byte ranges and ETags like a static file host, and records the headers of the requests.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.request_headers.append(dict(self.headers))
+        time.sleep(self.server.delay)
+        path = urllib.unquote(self.path)
+        if path not in FILES:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        data = FILES[path]
+        etag = '"%x"' % hash(data)
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match is not None and self.headers.get('If-Range', etag) == etag:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'audio/wav')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('X-Not-Passed-Through', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FileHost(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class RemoteAudioTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FileHost(('127.0.0.1', 0), FileHostHandler)
+        cls.server.request_headers = []
+        cls.server.delay = 0.
+        cls.base_url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.request_headers[:] = []
+        self.server.delay = 0.
+        self.cache_directory = tempfile.mkdtemp()
+        self.old_config = dict(app.config)
+        app.config['EXTERNAL_FILE_CACHE_DIRECTORY'] = self.cache_directory
+        app.config['EXTERNAL_FILE_CACHE_MAX_BYTES'] = 1024 ** 2
+
+    def tearDown(self):
+        app.config.update(self.old_config)
+        shutil.rmtree(self.cache_directory)
+
+    def get_proxied(self, path, headers=None):
+        rv = remote_audio.proxy_file(self.base_url + path, headers)
+        return rv, ''.join(rv.response)
+
+    def test_proxy_full_response(self):
+        rv, data = self.get_proxied('/a.wav')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(data, FILES['/a.wav'])
+        self.assertEqual(rv.headers['Content-Length'], str(len(FILES['/a.wav'])))
+        self.assertEqual(rv.headers['Content-Type'], 'audio/wav')
+        self.assertEqual(rv.headers['Accept-Ranges'], 'bytes')
+        self.assertIn('ETag', rv.headers)
+        self.assertNotIn('X-Not-Passed-Through', rv.headers)
+        self.assertEqual(self.server.request_headers[-1]['accept-encoding'], 'identity')
+
+    def test_proxy_range(self):
+        rv, data = self.get_proxied('/a.wav', {'Range': 'bytes=10-19'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(data, FILES['/a.wav'][10:20])
+        self.assertEqual(rv.headers['Content-Range'], 'bytes 10-19/%d' % len(FILES['/a.wav']))
+        self.assertEqual(self.server.request_headers[-1]['range'], 'bytes=10-19')
+
+    def test_proxy_if_range(self):
+        etag = self.get_proxied('/a.wav')[0].headers['ETag']
+
+        # the file has not changed, so the range is served
+        rv, data = self.get_proxied('/a.wav', {'Range': 'bytes=10-', 'If-Range': etag})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(data, FILES['/a.wav'][10:])
+        self.assertEqual(self.server.request_headers[-1]['if-range'], etag)
+
+        # the client's copy is outdated, so the whole file is served
+        rv, data = self.get_proxied('/a.wav', {'Range': 'bytes=10-', 'If-Range': '"outdated"'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(data, FILES['/a.wav'])
+
+    def test_proxy_not_found(self):
+        rv, data = self.get_proxied('/missing.wav')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_fetch_file(self):
+        url = self.base_url + '/a.wav'
+        self.assertIsNone(remote_audio.get_cached_file(url))
+        path = remote_audio.fetch_file(url)
+        self.assertEqual(remote_audio.get_cached_file(url), path)
+        self.assertTrue(path.endswith('.wav'))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), FILES['/a.wav'])
+        self.assertEqual(os.listdir(self.cache_directory), [os.path.basename(path)])
+
+    def test_fetch_file_keeps_modification_time(self):
+        path = remote_audio.fetch_file(self.base_url + '/a.wav')
+        self.assertEqual(os.stat(path).st_mtime, LAST_MODIFIED_TIMESTAMP)
+
+    def test_cache_hit_keeps_validators(self):
+        url = self.base_url + '/a.wav'
+        path = remote_audio.fetch_file(url)
+        os.utime(path, (0, LAST_MODIFIED_TIMESTAMP))
+
+        with app.test_request_context('/'):
+            first = views.send_file_partial(remote_audio.get_cached_file(url))
+        # using the file updates its access time (for the LRU eviction), but not its validators
+        self.assertGreater(os.stat(path).st_atime, 0)
+        self.assertEqual(os.stat(path).st_mtime, LAST_MODIFIED_TIMESTAMP)
+        with app.test_request_context('/', headers={'Range': 'bytes=10-19', 'If-Range': first.headers['ETag']}):
+            rv = views.send_file_partial(remote_audio.get_cached_file(url))
+            self.assertEqual(rv.status_code, 206)
+            self.assertEqual(rv.headers['ETag'], first.headers['ETag'])
+            self.assertEqual(rv.headers['Last-Modified'], first.headers['Last-Modified'])
+        with app.test_request_context('/', headers={'If-None-Match': first.headers['ETag']}):
+            rv = views.send_file_partial(remote_audio.get_cached_file(url))
+            self.assertEqual(rv.status_code, 304)
+
+    def test_fetch_unicode_url(self):
+        url = (self.base_url + '/\xc3\xa9t\xc3\xa9.wav').decode('utf-8')
+        path = remote_audio.fetch_file(url)
+        self.assertEqual(path, remote_audio.get_cache_path(url.encode('utf-8')))
+        self.assertEqual(remote_audio.get_cached_file(url), path)
+
+    def test_fetch_missing_file(self):
+        url = self.base_url + '/missing.wav'
+        self.assertRaises(Exception, remote_audio.fetch_file, url)
+        self.assertIsNone(remote_audio.get_cached_file(url))
+        self.assertEqual(os.listdir(self.cache_directory), [])
+
+    def test_evict_least_recently_used(self):
+        app.config['EXTERNAL_FILE_CACHE_MAX_BYTES'] = 2 * len(FILES['/a.wav'])
+        urls = [self.base_url + path for path in ('/a.wav', '/b.wav', '/c.wav')]
+        now = time.time()
+        for i, url in enumerate(urls[:2]):
+            path = remote_audio.fetch_file(url)
+            os.utime(path, (now - 100 + i, LAST_MODIFIED_TIMESTAMP))
+
+        # using a.wav makes b.wav the least recently used file
+        self.assertIsNotNone(remote_audio.get_cached_file(urls[0]))
+        remote_audio.fetch_file(urls[2])
+        self.assertIsNotNone(remote_audio.get_cached_file(urls[0]))
+        self.assertIsNone(remote_audio.get_cached_file(urls[1]))
+        self.assertIsNotNone(remote_audio.get_cached_file(urls[2]))
+
+    def test_fetch_file_in_background(self):
+        urls = [self.base_url + path for path in ('/a.wav', '/b.wav', '/c.wav')]
+        # slow down the file host, so that the files are still being fetched when they are requested again
+        self.server.delay = 0.2
+        for url in urls + urls:
+            remote_audio.fetch_file_in_background(url)
+        remote_audio._fetch_queue.join()
+
+        self.assertEqual(len(remote_audio._fetch_threads), app.config['EXTERNAL_FILE_FETCH_THREADS'])
+        self.assertEqual(remote_audio._fetching_urls, set())
+        for url in urls:
+            self.assertIsNotNone(remote_audio.get_cached_file(url))
+        # each file is fetched once, even though it was requested twice
+        self.assertEqual(len(self.server.request_headers), len(urls))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the Amazon Mechanical Turk administration (`caqe.turk_admin`) against a local stand-in for the MTurk
+requester API.
+
+To run: ::
+
+    $ python -m unittest test_turk_admin
+
+"""
+import os
+import sys
+import json
+import types
+import shutil
+import tempfile
+import unittest
+import time
+import threading
+import urlparse
+import collections
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape
+
+os.environ.setdefault('APP_MODE', 'TESTING')
+os.environ.setdefault('CSRF_SECRET_KEY', 'test-csrf-secret-key-0123456789a')
+os.environ.setdefault('SESSION_KEY', 'test-session-key')
+
+try:
+    import secret_keys
+except ImportError:
+    # the stand-in does not check the credentials
+    secret_keys = types.ModuleType('secret_keys')
+    secret_keys.AWS_ACCESS_KEY_ID = 'test-access-key-id'
+    secret_keys.AWS_SECRET_KEY = 'test-secret-key'
+    sys.modules['secret_keys'] = secret_keys
+
+from boto.mturk.connection import MTurkRequestError
+
+from caqe import app
+from caqe import db
+import caqe.models as models
+import caqe.turk_admin as turk_admin
+
+HIT_TYPE_ID = 'HITTYPE1'
+
+# The reply to a throttled request. Unlike server errors, it is not retried by boto itself.
+THROTTLED = (400, 'AWS.ServiceUnavailable.Throttled')
+
+
+def comparisons(preferences):
+    """
+    Get comparisons in the format of `turk_admin.calculate_tsr`, where the first stimulus of each pair was preferred.
+    """
+    return dict([('%s_%s' % (a, b), {'stimuli': [a, b], 'selection': 'A'}) for a, b in preferences])
+
+
+def error_response(status, code):
+    return status, '<Errors><Error><Code>%s</Code><Message>%s</Message></Error></Errors>' % (code, code)
+
+
+def fields_xml(fields):
+    return ''.join(['<%s>%s</%s>' % (k, escape(str(v)), k) for k, v in fields.items()])
+
+
+class MTurkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers the requests of `boto.mturk.connection.MTurkConnection` like the MTurk requester API, and records them.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        params = dict([(k, v[0]) for k, v in urlparse.parse_qs(body).items()])
+        operation = params['Operation']
+        server = self.server
+        with server.lock:
+            server.requests.append(params)
+            server.in_flight[operation] += 1
+            server.max_in_flight[operation] = max(server.max_in_flight[operation], server.in_flight[operation])
+        time.sleep(server.latency)
+        with server.lock:
+            server.in_flight[operation] -= 1
+            status, body = self.respond(operation, params)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self, operation, params):
+        """
+        Carry out a request.
+
+        Returns
+        -------
+        status : int
+        body : str
+        """
+        errors = self.server.errors[operation]
+        if len(errors) > 0:
+            return error_response(*errors.pop(0))
+        try:
+            result = getattr(self, 'do_%s' % operation)(params)
+        except KeyError as e:
+            return error_response(400, e.args[0])
+        if self.server.lost_responses[operation] > 0:
+            # the request was carried out, but its response does not reach the client
+            self.server.lost_responses[operation] -= 1
+            return error_response(*THROTTLED)
+        return 200, '<%sResponse><%sResult><Request><IsValid>True</IsValid></Request>%s</%sResult></%sResponse>' % \
+            (operation, operation, result, operation, operation)
+
+    def check_request_token(self, params):
+        token = params.get('UniqueRequestToken')
+        if token is not None:
+            if token in self.server.request_tokens:
+                raise KeyError('AWS.MechanicalTurk.DuplicateRequest')
+            self.server.request_tokens.add(token)
+
+    def do_RegisterHITType(self, params):
+        return '<HITTypeId>%s</HITTypeId>' % HIT_TYPE_ID
+
+    def do_CreateHIT(self, params):
+        self.check_request_token(params)
+        hit_id = self.server.add_hit(params['HITTypeId'], int(params['MaxAssignments']))
+        return self.server.hit_xml(hit_id)
+
+    def do_SearchHITs(self, params):
+        # disposed HITs are no longer listed
+        hit_ids = [hit_id for hit_id, hit in self.server.hits.items() if hit['HITStatus'] != 'Disposed']
+        return self.page_xml(hit_ids, params, self.server.hit_xml)
+
+    def do_GetHIT(self, params):
+        return self.server.hit_xml(params['HITId'])
+
+    def do_GetAssignmentsForHIT(self, params):
+        assignments = [a for a in self.server.assignments.values() if a['HITId'] == params['HITId'] and
+                       params.get('AssignmentStatus', a['AssignmentStatus']) == a['AssignmentStatus']]
+        return self.page_xml(assignments, params, lambda a: '<Assignment>%s</Assignment>' % fields_xml(a))
+
+    @staticmethod
+    def page_xml(items, params, item_xml):
+        page_size = int(params.get('PageSize', 10))
+        page_number = int(params.get('PageNumber', 1))
+        page = items[(page_number - 1) * page_size:page_number * page_size]
+        return '<NumResults>%d</NumResults><TotalNumResults>%d</TotalNumResults><PageNumber>%d</PageNumber>%s' % \
+            (len(page), len(items), page_number, ''.join([item_xml(item) for item in page]))
+
+    def do_GrantBonus(self, params):
+        if params['WorkerId'] in self.server.blocked_workers:
+            raise KeyError('AWS.MechanicalTurk.InvalidAssignmentState')
+        self.check_request_token(params)
+        self.server.bonuses.append(params)
+        return ''
+
+
+class MTurkServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        # the errors to reply to the next requests of each operation, as (HTTP status, error code)
+        self.errors = collections.defaultdict(list)
+        # the number of next requests of each operation whose response is lost
+        self.lost_responses = collections.Counter()
+        self.request_tokens = set()
+        self.blocked_workers = set()
+        self.latency = 0.
+        self.in_flight = collections.Counter()
+        self.max_in_flight = collections.Counter()
+        self.hits = collections.OrderedDict()
+        self.assignments = collections.OrderedDict()
+        self.bonuses = []
+
+    def add_hit(self, hit_type_id=HIT_TYPE_ID, max_assignments=10):
+        hit_id = 'HIT%05d' % (len(self.hits) + 1)
+        self.hits[hit_id] = {'HITId': hit_id, 'HITTypeId': hit_type_id, 'HITStatus': 'Assignable',
+                             'CreationTime': '2016-01-01T00:00:00Z', 'Expiration': '2016-01-08T00:00:00Z',
+                             'MaxAssignments': max_assignments}
+        return hit_id
+
+    def add_assignment(self, hit_id, status='Submitted'):
+        assignment_id = 'ASSIGNMENT%05d' % (len(self.assignments) + 1)
+        self.assignments[assignment_id] = {'AssignmentId': assignment_id, 'HITId': hit_id,
+                                           'WorkerId': 'W%d' % len(self.assignments), 'AssignmentStatus': status,
+                                           'AcceptTime': '2016-01-01T00:00:00Z',
+                                           'SubmitTime': '2016-01-01T00:10:00Z'}
+        return assignment_id
+
+    def hit_xml(self, hit_id):
+        """
+        The HIT with its assignment counts
+        """
+        hit = dict(self.hits[hit_id])
+        statuses = [a['AssignmentStatus'] for a in self.assignments.values() if a['HITId'] == hit_id]
+        hit['NumberOfAssignmentsPending'] = 0
+        hit['NumberOfAssignmentsAvailable'] = hit['MaxAssignments'] - len(statuses) \
+            if hit['HITStatus'] == 'Assignable' else 0
+        hit['NumberOfAssignmentsCompleted'] = len([status for status in statuses if status != 'Submitted'])
+        return '<HIT>%s</HIT>' % fields_xml(hit)
+
+    def count_requests(self, operation):
+        return len([params for params in self.requests if params['Operation'] == operation])
+
+
+class MTurkTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MTurkServer(('127.0.0.1', 0), MTurkHandler)
+        cls.server.reset()
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.reset()
+        self.directory = tempfile.mkdtemp()
+        self.old_config = dict(app.config)
+        app.config['MTURK_HOST'] = '127.0.0.1'
+        app.config['MTURK_PORT'] = self.server.server_address[1]
+        app.config['MTURK_IS_SECURE'] = False
+        app.config['MTURK_CREATE_HITS_JOURNAL'] = os.path.join(self.directory, 'create_hits.jsonl')
+        self.old_backoff = turk_admin.BACKOFF_BASE_SEC, turk_admin.BACKOFF_MAX_SEC
+        turk_admin.BACKOFF_BASE_SEC = turk_admin.BACKOFF_MAX_SEC = 0.001
+        # the connections of the worker threads are kept between tests, so reconnect the current thread
+        turk_admin._thread_local.connection = None
+
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        turk_admin.BACKOFF_BASE_SEC, turk_admin.BACKOFF_MAX_SEC = self.old_backoff
+        app.config.update(self.old_config)
+        shutil.rmtree(self.directory)
+
+
+class CalculateTsrTestCase(unittest.TestCase):
+    def test_transitive(self):
+        tsr, n_pass, n_test, m = turk_admin.calculate_tsr(comparisons([('S1', 'S2'), ('S2', 'S3'), ('S1', 'S3')]))
+        self.assertEqual((tsr, n_pass, n_test), (1., 1, 1))
+
+    def test_intransitive(self):
+        tsr, n_pass, n_test, m = turk_admin.calculate_tsr(comparisons([('S1', 'S2'), ('S2', 'S3'), ('S3', 'S1')]))
+        self.assertEqual((tsr, n_pass, n_test), (0., 0, 3))
+
+    def test_stimuli_of_the_ratings(self):
+        # e.g. the stimuli of a test with more than 8 stimuli, or named after their files
+        ratings_list = [comparisons([('S10', 'S9'), ('S9', 'ref'), ('S10', 'ref')]),
+                        comparisons([('S1', 'S2'), ('S2', 'S3'), ('S3', 'S1')]),
+                        {}]
+        tsr, n_pass, n_test, m = turk_admin.calculate_tsr_batch(ratings_list)
+        self.assertEqual(tsr[:2].tolist(), [1., 0.])
+        self.assertTrue(turk_admin.np.isnan(tsr[2]))
+        self.assertEqual(m.shape, (3, 6, 6))
+
+    def test_unknown_stimulus(self):
+        self.assertRaises(ValueError, turk_admin.calculate_tsr, comparisons([('S1', 'S9')]),
+                          ('S1', 'S2', 'S3', 'S4', 'S5', 'S6', 'S7', 'S8'))
+
+
+class BonusTestCase(MTurkTestCase):
+    REASON = 'Thanks'
+
+    def add_assignment(self, worker_id, assignment_id, preferences, per_trial=True):
+        """
+        Add the trials of an assignment, where the first stimulus of each pair was preferred. Each pair is a pairwise
+        trial, or all the pairs are the comparisons of a single trial if not `per_trial`.
+        """
+        participant = models.Participant('mturk', worker_id)
+        db.session.add(participant)
+        db.session.commit()
+        crowd_data = json.dumps({'assignment_id': assignment_id, 'hit_id': 'HIT1'})
+        if per_trial:
+            trial_ratings = [{a: 1, b: 0} for a, b in preferences]
+        else:
+            trial_ratings = [comparisons(preferences)]
+        for ratings in trial_ratings:
+            db.session.add(models.Trial(participant.id, 1, json.dumps({'ratings': ratings}), crowd_data))
+        db.session.commit()
+        return participant
+
+    def add_consistent_assignment(self, worker_id, assignment_id=None, per_trial=True):
+        return self.add_assignment(worker_id, assignment_id or 'ASSIGNMENT_%s' % worker_id,
+                                   [('S1', 'S2'), ('S2', 'S3'), ('S1', 'S3')], per_trial)
+
+    def compute_bonuses(self, already_bonused_ids=()):
+        return turk_admin.compute_consistency_bonuses(1., 0.5, self.REASON, already_bonused_ids)
+
+    def test_compute_consistency_bonuses(self):
+        consistent = self.add_consistent_assignment('W1')
+        self.add_assignment('W2', 'ASSIGNMENT_W2', [('S1', 'S2'), ('S2', 'S3'), ('S3', 'S1')])
+        # trials without an assignment are scored on their own
+        no_assignment = self.add_consistent_assignment('W3', 'ASSIGNMENT_ID_NOT_AVAILABLE', per_trial=False)
+        # stimuli outside of S1-S8 are scored as well
+        other_stimuli = self.add_assignment('W4', 'ASSIGNMENT_W4', [('S12', 'S10'), ('S10', 'anchor'),
+                                                                    ('S12', 'anchor')])
+
+        bonuses, trial_ids = self.compute_bonuses()
+        self.assertEqual([(b.worker_id, b.assignment_id, b.amount, b.status) for b in bonuses],
+                         [('W1', 'ASSIGNMENT_W1', 1., turk_admin.BONUS_PENDING),
+                          ('W4', 'ASSIGNMENT_W4', 1., turk_admin.BONUS_PENDING)])
+        self.assertEqual(bonuses[0].trial_id, consistent.trials[0].id)
+        self.assertEqual(bonuses[1].trial_id, other_stimuli.trials[0].id)
+        self.assertEqual(trial_ids, [t.id for t in no_assignment.trials])
+        self.assertEqual(models.Bonus.query.count(), 2)
+
+        # the assignments already in the ledger are not bonused again
+        self.assertEqual(self.compute_bonuses(), ([], trial_ids))
+
+    def test_already_bonused_trials(self):
+        participant = self.add_consistent_assignment('W1')
+        bonuses, _ = self.compute_bonuses(already_bonused_ids=set([participant.trials[-1].id]))
+        self.assertEqual(bonuses, [])
+
+    def test_pay_bonuses(self):
+        for worker_id in ('W1', 'W2', 'W3'):
+            self.add_consistent_assignment(worker_id)
+
+        admin = turk_admin.TurkAdmin()
+        total_bonus, trials = admin.give_consistency_bonus(1., 0.5, reason=self.REASON)
+        self.assertEqual((total_bonus, trials), (3., []))
+        self.assertEqual(sorted([(b['WorkerId'], b['AssignmentId'], b['BonusAmount.1.Amount'], b['Reason'])
+                                 for b in self.server.bonuses]),
+                         [('W%d' % i, 'ASSIGNMENT_W%d' % i, '1.0', self.REASON) for i in (1, 2, 3)])
+        self.assertEqual(sorted([b['UniqueRequestToken'] for b in self.server.bonuses]),
+                         sorted([b.request_token for b in models.Bonus.query]))
+        self.assertEqual([(b.status, b.attempts) for b in models.Bonus.query], [(turk_admin.BONUS_PAID, 1)] * 3)
+
+        # nothing is paid twice
+        self.assertEqual(admin.give_consistency_bonus(1., 0.5, reason=self.REASON), (0., []))
+        self.assertEqual(len(self.server.bonuses), 3)
+
+    def test_calculate_amount_only(self):
+        self.add_consistent_assignment('W1')
+        admin = turk_admin.TurkAdmin()
+        self.assertEqual(admin.give_consistency_bonus(1., 0.5, calculate_amt_only=True), (1., []))
+        self.assertEqual(models.Bonus.query.count(), 0)
+        self.assertEqual(self.server.count_requests('GrantBonus'), 0)
+
+    def test_throttled_grant_is_retried(self):
+        self.add_consistent_assignment('W1')
+        self.server.errors['GrantBonus'] = [THROTTLED, THROTTLED]
+        admin = turk_admin.TurkAdmin()
+        self.assertEqual(admin.give_consistency_bonus(1., 0.5), (1., []))
+        self.assertEqual(self.server.count_requests('GrantBonus'), 3)
+        self.assertEqual(len(self.server.bonuses), 1)
+
+    def test_lost_response_is_not_granted_twice(self):
+        self.add_consistent_assignment('W1')
+        # the bonus is granted, but the response is lost, so the retry with the same token is a duplicate request
+        self.server.lost_responses['GrantBonus'] = 1
+        admin = turk_admin.TurkAdmin()
+        self.assertEqual(admin.give_consistency_bonus(1., 0.5), (1., []))
+        self.assertEqual(self.server.count_requests('GrantBonus'), 2)
+        self.assertEqual(len(self.server.bonuses), 1)
+        self.assertEqual(models.Bonus.query.one().status, turk_admin.BONUS_PAID)
+
+    def test_resume_payout(self):
+        for worker_id in ('W1', 'W2'):
+            self.add_consistent_assignment(worker_id)
+        self.server.blocked_workers.add('W2')
+        admin = turk_admin.TurkAdmin()
+        total_bonus, trials = admin.give_consistency_bonus(1., 0.5)
+        self.assertEqual(total_bonus, 1.)
+        failed_bonus = models.Bonus.query.filter_by(worker_id='W2').one()
+        self.assertEqual(trials, [models.Trial.query.get(failed_bonus.trial_id)])
+        self.assertEqual((failed_bonus.status, failed_bonus.attempts), (turk_admin.BONUS_FAILED, 1))
+        self.assertIn('InvalidAssignmentState', failed_bonus.error)
+
+        # the next payout only grants the failed bonus
+        self.server.blocked_workers.clear()
+        self.assertEqual(admin.pay_bonuses(), (1., []))
+        self.assertEqual([b['WorkerId'] for b in self.server.bonuses], ['W1', 'W2'])
+        self.assertEqual((failed_bonus.status, failed_bonus.attempts, failed_bonus.error),
+                         (turk_admin.BONUS_PAID, 2, None))
+
+    def test_max_bonus_attempts(self):
+        self.add_consistent_assignment('W1')
+        self.server.blocked_workers.add('W1')
+        admin = turk_admin.TurkAdmin()
+        admin.give_consistency_bonus(1., 0.5)
+        for _ in range(turk_admin.MAX_BONUS_ATTEMPTS):
+            admin.pay_bonuses()
+        bonus = models.Bonus.query.one()
+        self.assertEqual((bonus.status, bonus.attempts), (turk_admin.BONUS_FAILED, turk_admin.MAX_BONUS_ATTEMPTS))
+        self.assertEqual(self.server.count_requests('GrantBonus'), turk_admin.MAX_BONUS_ATTEMPTS)
+
+
+class CreateHitsTestCase(MTurkTestCase):
+    def read_journal(self):
+        return turk_admin.read_create_hits_journal(app.config['MTURK_CREATE_HITS_JOURNAL'])
+
+    def test_create_hits(self):
+        admin = turk_admin.TurkAdmin()
+        hit_ids = admin.create_hits(12)
+        self.assertEqual(sorted(hit_ids), sorted(self.server.hits.keys()))
+        self.assertEqual(set([hit['HITTypeId'] for hit in self.server.hits.values()]), set([HIT_TYPE_ID]))
+
+        batch, created = self.read_journal()
+        self.assertEqual(batch['num_hits'], 12)
+        self.assertEqual(sorted(created.keys()), range(12))
+        self.assertEqual(sorted(created.values()), sorted(hit_ids))
+        tokens = [params['UniqueRequestToken'] for params in self.server.requests if params['Operation'] == 'CreateHIT']
+        self.assertEqual(sorted(tokens), sorted(['%s-%d' % (batch['batch'], i) for i in range(12)]))
+
+        # the batch is complete, so creating HITs again starts a new batch
+        self.assertEqual(len(admin.create_hits(3)), 3)
+        self.assertNotEqual(self.read_journal()[0]['batch'], batch['batch'])
+
+    def test_resume_batch(self):
+        # the retries of two HITs run out
+        self.server.errors['CreateHIT'] = [THROTTLED] * (2 * turk_admin.MAX_REQUEST_ATTEMPTS)
+        admin = turk_admin.TurkAdmin()
+        self.assertEqual(len(admin.create_hits(10, n_workers=1)), 8)
+        batch, created = self.read_journal()
+        self.assertEqual(len(created), 8)
+
+        self.assertRaises(Exception, admin.create_hits, 5)
+        hit_ids = admin.create_hits(10)
+        self.assertEqual(len(hit_ids), 2)
+        self.assertEqual(len(self.server.hits), 10)
+        resumed_batch, resumed_created = self.read_journal()
+        self.assertEqual(resumed_batch, batch)
+        self.assertEqual(sorted(resumed_created.keys()), range(10))
+        self.assertEqual(dict([(i, resumed_created[i]) for i in created]), created)
+        self.assertEqual(admin.create_hits(0), [])
+
+    def test_resume_after_lost_response(self):
+        admin = turk_admin.TurkAdmin()
+        admin.create_hits(3)
+        # the last HIT was created, but we were interrupted before recording it in the journal
+        path = app.config['MTURK_CREATE_HITS_JOURNAL']
+        with open(path) as f:
+            lines = f.read().splitlines()
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines[:-1]) + '\n{"batch": ')
+
+        self.assertEqual(admin.create_hits(3), [])
+        self.assertEqual(len(self.server.hits), 3)
+        self.assertEqual(self.server.count_requests('CreateHIT'), 4)
+        batch, created = self.read_journal()
+        self.assertEqual(len(created), 3)
+        self.assertEqual(created.values().count(None), 1)
+
+
+class CallWithBackoffTestCase(MTurkTestCase):
+    def grant(self, worker_id='W1', token='token'):
+        params = {'WorkerId': worker_id, 'AssignmentId': 'A1', 'Reason': 'Thanks', 'UniqueRequestToken': token,
+                  'BonusAmount.1.Amount': '0.10', 'BonusAmount.1.CurrencyCode': 'USD'}
+        return turk_admin._call_with_backoff(turk_admin.turk_connect()._process_request, 'GrantBonus', params)
+
+    def test_retry_until_success(self):
+        self.server.errors['GrantBonus'] = [THROTTLED] * (turk_admin.MAX_REQUEST_ATTEMPTS - 1)
+        self.grant()
+        self.assertEqual(self.server.count_requests('GrantBonus'), turk_admin.MAX_REQUEST_ATTEMPTS)
+        self.assertEqual(len(self.server.bonuses), 1)
+
+    def test_give_up(self):
+        self.server.errors['GrantBonus'] = [THROTTLED] * turk_admin.MAX_REQUEST_ATTEMPTS
+        self.assertRaises(MTurkRequestError, self.grant)
+        self.assertEqual(self.server.count_requests('GrantBonus'), turk_admin.MAX_REQUEST_ATTEMPTS)
+        self.assertEqual(self.server.bonuses, [])
+
+    def test_errors_that_are_not_retried(self):
+        self.server.blocked_workers.add('W1')
+        self.assertRaises(MTurkRequestError, self.grant)
+        self.assertEqual(self.server.count_requests('GrantBonus'), 1)
+
+        self.assertRaises(ValueError, turk_admin._call_with_backoff, int, 'x')
+
+    def test_duplicate_request(self):
+        self.grant()
+        try:
+            self.grant()
+        except MTurkRequestError as e:
+            self.assertIn('DuplicateRequest', e.body)
+        else:
+            self.fail('The duplicate request was accepted.')
+        self.assertEqual(len(self.server.bonuses), 1)
+
+
+class FetchTestCase(MTurkTestCase):
+    def setUp(self):
+        super(FetchTestCase, self).setUp()
+        # small pages, so that a few HITs and assignments span several pages
+        self.old_page_size = turk_admin.PAGE_SIZE
+        turk_admin.PAGE_SIZE = 10
+        self.admin = turk_admin.TurkAdmin()
+
+    def tearDown(self):
+        turk_admin.PAGE_SIZE = self.old_page_size
+        super(FetchTestCase, self).tearDown()
+
+    def add_hits(self, n_hits, assignment_statuses=('Submitted', 'Approved')):
+        """
+        Add HITs of two types, with 0, 1, 2, ... assignments of alternating `assignment_statuses`.
+        """
+        hit_ids = []
+        for i in range(n_hits):
+            hit_id = self.server.add_hit(HIT_TYPE_ID if i % 2 == 0 else 'HITTYPE2', max_assignments=100)
+            for j in range(i):
+                self.server.add_assignment(hit_id, assignment_statuses[j % len(assignment_statuses)])
+            hit_ids.append(hit_id)
+        return hit_ids
+
+    def get_requests(self, operation, param):
+        return [params.get(param) for params in self.server.requests if params['Operation'] == operation]
+
+    def test_get_all_hits(self):
+        hit_ids = self.add_hits(45)
+        self.server.hits[hit_ids[0]]['HITStatus'] = 'Disposed'
+        self.server.latency = 0.05
+
+        hits = self.admin.get_all_hits(n_workers=4)
+        self.assertEqual([hit.HITId for hit in hits], hit_ids[1:])
+        self.assertEqual(hits[0].HITTypeId, 'HITTYPE2')
+        self.assertEqual(hits[1].NumberOfAssignmentsAvailable, '98')
+        self.assertEqual(hits[1].NumberOfAssignmentsCompleted, '1')
+        # the pages after the first are fetched concurrently, each once
+        self.assertEqual(sorted(self.get_requests('SearchHITs', 'PageNumber'), key=int), ['1', '2', '3', '4', '5'])
+        self.assertGreater(self.server.max_in_flight['SearchHITs'], 1)
+
+    def test_get_all_hits_on_one_page(self):
+        self.assertEqual(self.admin.get_all_hits(), [])
+        hit_ids = self.add_hits(10)
+        self.assertEqual([hit.HITId for hit in self.admin.get_all_hits()], hit_ids)
+        self.assertEqual(self.get_requests('SearchHITs', 'PageNumber'), ['1', '1'])
+
+    def test_hit_type_cache(self):
+        hit_ids = self.add_hits(15)
+        self.admin.get_all_hits()
+        self.assertEqual([self.admin.get_hit_type(hit_id) for hit_id in hit_ids[:2]], [HIT_TYPE_ID, 'HITTYPE2'])
+        self.assertEqual(self.server.count_requests('GetHIT'), 0)
+
+        # HITs that were not listed are looked up once
+        hit_id = self.server.add_hit('HITTYPE3')
+        self.assertEqual(self.admin.get_hit_type(hit_id), 'HITTYPE3')
+        self.assertEqual(self.admin.get_hit_type(hit_id), 'HITTYPE3')
+        self.assertEqual(self.get_requests('GetHIT', 'HITId'), [hit_id])
+
+    def test_iter_assignments(self):
+        hit_ids = self.add_hits(25)
+        self.server.latency = 0.02
+
+        fetched = dict([(hit.HITId, [a.AssignmentId for a in assignments])
+                        for hit, assignments in self.admin.iter_assignments(n_workers=4)])
+        self.assertEqual(sorted(fetched.keys()), hit_ids)
+        for hit_id in hit_ids:
+            self.assertEqual(fetched[hit_id], [assignment_id for assignment_id, a in self.server.assignments.items()
+                                               if a['HITId'] == hit_id])
+        # the assignments of several HITs are fetched concurrently, and the assignments of a HIT page by page
+        self.assertGreater(self.server.max_in_flight['GetAssignmentsForHIT'], 1)
+        self.assertEqual(self.get_requests('GetAssignmentsForHIT', 'HITId').count(hit_ids[24]), 3)
+
+    def test_iter_assignments_with_status(self):
+        hits = self.admin.get_all_hits()
+        self.assertEqual(list(self.admin.iter_assignments(hits)), [])
+
+        self.add_hits(5)
+        approved = self.admin.get_all_assignments(status='Approved')
+        self.assertEqual(sorted([a.AssignmentId for a in approved]),
+                         [assignment_id for assignment_id, a in self.server.assignments.items()
+                          if a['AssignmentStatus'] == 'Approved'])
+        self.assertEqual(set(self.get_requests('GetAssignmentsForHIT', 'AssignmentStatus')), set(['Approved']))
+
+
+class MirrorTestCase(FetchTestCase):
+    def setUp(self):
+        super(MirrorTestCase, self).setUp()
+        self.mirror = turk_admin.MTurkMirror(os.path.join(self.directory, 'mirror.db'))
+
+    def tearDown(self):
+        self.mirror.close()
+        super(MirrorTestCase, self).tearDown()
+
+    def refresh(self):
+        n_requests = len(self.server.requests)
+        result = self.admin.refresh_mirror(self.mirror, n_workers=4)
+        # the HITs whose assignments were fetched
+        refreshed_hit_ids = set([params['HITId'] for params in self.server.requests[n_requests:]
+                                 if params['Operation'] == 'GetAssignmentsForHIT'])
+        return result, refreshed_hit_ids
+
+    def count_assignments(self):
+        return dict(collections.Counter([a['AssignmentStatus'] for a in self.server.assignments.values()]))
+
+    def test_refresh(self):
+        hit_ids = self.add_hits(12)
+        self.assertEqual(self.refresh(), ((12, 12), set(hit_ids)))
+        self.assertEqual(self.mirror.count_assignments(), self.count_assignments())
+        self.assertEqual(sorted([a['AssignmentId'] for a in self.mirror.get_assignments()]),
+                         list(self.server.assignments.keys()))
+
+        # nothing changed
+        self.assertEqual(self.refresh(), ((12, 0), set()))
+
+        # only the HITs whose assignments changed are fetched again
+        self.server.add_assignment(hit_ids[3])
+        approved_id = [assignment_id for assignment_id, a in self.server.assignments.items()
+                       if a['HITId'] == hit_ids[5] and a['AssignmentStatus'] == 'Submitted'][0]
+        self.server.assignments[approved_id]['AssignmentStatus'] = 'Approved'
+        self.assertEqual(self.refresh(), ((12, 2), set([hit_ids[3], hit_ids[5]])))
+        self.assertEqual(self.mirror.count_assignments(), self.count_assignments())
+        self.assertEqual(self.mirror.count_assignments(), {'Submitted': 36, 'Approved': 31})
+
+    def test_disposed_hits(self):
+        hit_ids = self.add_hits(4)
+        self.refresh()
+        self.server.hits[hit_ids[2]]['HITStatus'] = 'Disposed'
+        self.assertEqual(self.refresh(), ((3, 0), set()))
+        summaries = self.mirror.get_hit_summaries()
+        self.assertEqual(summaries[hit_ids[2]][0], 'Disposed')
+        self.assertEqual(summaries[hit_ids[3]][0], 'Assignable')
+        # the assignments of disposed HITs are kept
+        self.assertEqual(len(self.mirror.get_assignments()), 6)
+        self.assertEqual(self.refresh(), ((3, 0), set()))
+
+    def test_get_assignments(self):
+        hit_ids = self.add_hits(6)
+        self.refresh()
+        assignments = self.mirror.get_assignments('Approved', ['HITTYPE2'])
+        self.assertEqual(sorted([(a['HITId'], a['AssignmentStatus']) for a in assignments]),
+                         [(hit_ids[3], 'Approved'), (hit_ids[5], 'Approved'), (hit_ids[5], 'Approved')])
+        self.assertEqual(len(self.mirror.get_assignments(hit_types=[HIT_TYPE_ID])), 6)
+
+        # the mirror is kept in its database
+        self.mirror.close()
+        self.mirror = turk_admin.MTurkMirror(self.mirror.path)
+        self.assertEqual(len(self.mirror.get_assignments()), 15)
+        self.assertEqual(self.refresh(), ((6, 0), set()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,6 +15,32 @@ if __name__ == '__main__':
 
     ch = sp.add_parser('create-hits', help='Create MTurk HITs')
     ch.add_argument('num_hits', type=int, help='The number of MTurk HITs to create')
+    ch.add_argument('--journal',
+                    help="The path of the progress journal, which is used to resume an interrupted batch of HITs. "
+                         "Default is defined by the CAQE configuration.",
+                    default=app.config['MTURK_CREATE_HITS_JOURNAL'])
+    ch.add_argument('--rate',
+                    type=float,
+                    help="The maximum average number of HIT requests per second.",
+                    default=caqe.turk_admin.CREATE_HITS_RATE)
+    ch.add_argument('--n-workers',
+                    type=int,
+                    help="The number of concurrent HIT requests.",
+                    default=caqe.turk_admin.CREATE_HITS_WORKERS)
+
+    asc = sp.add_parser('autoscale', help='Create and expire MTurk HITs as needed to complete the remaining trials, '
+                                          'until the study is complete.')
+    asc.add_argument('--interval',
+                     type=float,
+                     help="The number of seconds between adjustments.",
+                     default=caqe.turk_admin.AUTOSCALE_INTERVAL_SEC)
+    asc.add_argument('--max-iterations',
+                     type=int,
+                     help="Stop after this many adjustments, even if the study is not complete.")
+    asc.add_argument('--journal',
+                     help="The path of the progress journal of HIT creation. Default is defined by the CAQE "
+                          "configuration.",
+                     default=app.config['MTURK_CREATE_HITS_JOURNAL'])
 
     eah = sp.add_parser('expire-all-hits', help='Expire all MTurk HITs')
 
@@ -22,6 +48,12 @@ if __name__ == '__main__':
 
     aas = sp.add_parser('approve-all-assignments', help='Approve all assignments and pay the assignment reward.')
 
+    rm = sp.add_parser('refresh-mirror', help='Refresh the local mirror of the state of the MTurk HITs and '
+                                              'assignments.')
+    rm.add_argument('--mirror-database',
+                    help="The path of the SQLite mirror database. Default is defined by the CAQE configuration.",
+                    default=app.config['MTURK_MIRROR_DATABASE'])
+
     gftb = sp.add_parser('give-first-trial-bonus', help='Give a bonus to all workers that completed their first trial, '
                                                         'which may have had additional testing.')
     gftb.add_argument('reward',
@@ -52,27 +84,48 @@ if __name__ == '__main__':
                       help="Do not actually pay out the bonus. Just calculate and display the total.",
                       action='store_true')
 
+    pb = sp.add_parser('pay-bonuses', help='Grant the unpaid bonuses in the bonus ledger, e.g. to resume an interrupted '
+                                           'payout or to retry failed bonuses.')
+    pb.add_argument('--kind', help="Only grant bonuses of this kind (e.g. 'consistency').")
+    pb.add_argument('--n-workers',
+                    type=int,
+                    help="The number of concurrent bonus grant requests.",
+                    default=caqe.turk_admin.BONUS_WORKERS)
+
     args = parser.parse_args()
     debug = args.debug
 
     turk_admin = caqe.turk_admin.TurkAdmin(debug=debug)
 
     if args.command == 'create-hits':
-        turk_admin.create_hits(args.num_hits)
+        hit_ids = turk_admin.create_hits(args.num_hits, journal=args.journal, rate=args.rate, n_workers=args.n_workers)
+        print 'Created %d HITs.' % len(hit_ids)
+    elif args.command == 'autoscale':
+        turk_admin.autoscale(args.interval, args.max_iterations, journal=args.journal)
     elif args.command == 'expire-all-hits':
         turk_admin.expire_all_hits()
     elif args.command == 'dispose-all-hits':
         turk_admin.dispose_all_hits()
     elif args.command == 'approve-all-assignments':
         turk_admin.approve_all()
+    elif args.command == 'refresh-mirror':
+        mirror = caqe.turk_admin.MTurkMirror(args.mirror_database)
+        n_hits, n_refreshed = turk_admin.refresh_mirror(mirror)
+        print 'Refreshed %d of %d HITs. Assignments: %s' % (n_refreshed, n_hits, mirror.count_assignments())
+        mirror.close()
     elif args.command == 'give-first-trial-bonus':
         a = vars(args)
-        turk_admin.give_bonus_to_all_first_completed_trials(a['reward'],
-                                                            a['calculate-amt-only'])
+        total_bonus, participants = turk_admin.give_bonus_to_all_first_completed_trials(a['reward'],
+                                                                                        a['display_only'])
+        print 'Total bonus: $%.2f. %d participants without a valid assignment or whose bonus failed.' % \
+              (total_bonus, len(participants))
     elif args.command == 'give-pairwise-consistency-bonus':
         a = vars(args)
-        turk_admin.give_consistency_bonus(a['max-consistency-bonus'],
-                                          a['min-consistency-threshold-for-bonus'],
-                                          a['display-only'])
-
-
+        total_bonus, trials = turk_admin.give_consistency_bonus(a['max-consistency-bonus'],
+                                                                a['min-consistency-threshold-for-bonus'],
+                                                                a['display_only'])
+        print 'Total bonus: $%.2f. %d trials without a valid assignment or whose bonus failed.' % \
+              (total_bonus, len(trials))
+    elif args.command == 'pay-bonuses':
+        total_paid, failed_bonuses = turk_admin.pay_bonuses(args.kind, args.n_workers)
+        print 'Paid $%.2f in bonuses. %d bonuses failed.' % (total_paid, len(failed_bonuses))